@@ -1,609 +1,465 @@
 import streamlit as st
 import requests
+import contextlib
 import json
-import re
-from tenacity import retry, stop_after_attempt, wait_fixed
+import math
+import time
+import uuid
+from functools import partial
+import cancellation
+import hedging
+import http_client
+import bulk_generation
+import chapter_store
+import manuscript_export
+import project_store
+import response_cache
+import context_budget
+import model_router
+import novel_engine
+import prefetch
+import request_scheduler
+import retry_policy
+import telemetry
 
 # API configuration
-api_url = "https://openrouter.ai/api/v1/chat/completions"
-api_model = st.secrets.get("OPENROUTER_MODEL", "mistralai/devstral-small:free")
-headers = {
-    "Content-Type": "application/json",
-    "Authorization": f"Bearer {st.secrets['OPENROUTER_API_KEY']}"
-}
+novel_engine.configure(
+    api_key=st.secrets["OPENROUTER_API_KEY"],
+    model=st.secrets.get("OPENROUTER_MODEL", "mistralai/devstral-small:free"),
+    # JSON-schema structured output for outline/characters/TOC: true, false or "auto" (detect per model)
+    structured=st.secrets.get("OPENROUTER_STRUCTURED_OUTPUT", "auto"),
+    # Overridable so the app can run against benchmarks/mock_openrouter.py
+    url=st.secrets.get("OPENROUTER_API_URL"),
+    # Token budget for the novel context pasted into each prompt
+    token_budget=int(st.secrets.get("CONTEXT_TOKEN_BUDGET", context_budget.DEFAULT_BUDGET)),
+    # Token budget for the continuity memory of earlier chapters in each chapter content prompt
+    continuity_budget=int(st.secrets.get("CONTINUITY_TOKEN_BUDGET", context_budget.DEFAULT_CONTINUITY_BUDGET)),
+    # Words per chapter, and whether chapters are drafted as parallel scene beats: true, false or
+    # "auto" (chapters longer than novel_engine.LONG_FORM_MIN_WORDS words)
+    words=int(st.secrets.get("CHAPTER_WORDS", novel_engine.DEFAULT_CHAPTER_WORDS)),
+    long_form=st.secrets.get("LONG_FORM_CHAPTERS", "auto"),
+    # Persistent response cache shared by every session served by this process
+    cache=response_cache.get_cache(
+        path=st.secrets.get("RESPONSE_CACHE_PATH", response_cache.DEFAULT_PATH),
+        max_bytes=int(float(st.secrets.get("RESPONSE_CACHE_MAX_MB", response_cache.DEFAULT_MAX_BYTES / 2**20)) * 2**20),
+        max_age=float(st.secrets.get("RESPONSE_CACHE_MAX_AGE_DAYS", response_cache.DEFAULT_MAX_AGE / 86400)) * 86400,
+    ),
+)
+
+# HTTP client configuration (shared keep-alive pool, connect/read timeouts)
+http_client.configure(
+    connect_timeout=float(st.secrets.get("OPENROUTER_CONNECT_TIMEOUT", http_client.DEFAULT_CONNECT_TIMEOUT)),
+    read_timeout=float(st.secrets.get("OPENROUTER_READ_TIMEOUT", http_client.DEFAULT_READ_TIMEOUT)),
+)
+
+# Retry policy and circuit breaker shared by every session served by this process
+retry_policy.configure(
+    attempts=int(st.secrets.get("RETRY_MAX_ATTEMPTS", retry_policy.max_attempts)),
+    failure_threshold=int(st.secrets.get("CIRCUIT_FAILURE_THRESHOLD", retry_policy.breaker.failure_threshold)),
+    cooldown=float(st.secrets.get("CIRCUIT_COOLDOWN_SECONDS", retry_policy.breaker.cooldown)),
+)
+
+# Per-stage model routing: MODEL_ROUTES maps a stage (as named under "Rendimiento", e.g.
+# chapter_content or chapter_dialogue; "default" for the rest) to its models in order of preference,
+# or to {models = [...], max_p95_seconds = n}. A model falls back to the next on provider errors,
+# timeouts, or while its rolling p95 latency is over the threshold.
+model_router.configure(
+    stage_routes=dict(st.secrets.get("MODEL_ROUTES", {})),
+    p95_threshold=float(st.secrets.get("MODEL_ROUTE_MAX_P95_SECONDS", 0)),
+)
+
+# Deadline of each generation step (a click, or one chapter job of a bulk run); 0 = none
+cancellation.configure(deadline=float(st.secrets.get("GENERATION_DEADLINE_SECONDS", cancellation.DEFAULT_DEADLINE)))
+
+# Hedged requests: a call still unanswered at its stage's p90 latency (time to first token for
+# streams) gets a duplicate, sent to the next model on its route or to the same model; the first
+# answer wins. HEDGE_BUDGET caps the fraction of calls duplicated (e.g. 0.05; 0 = off).
+hedging.configure(
+    fraction=float(st.secrets.get("HEDGE_BUDGET", 0)),
+    delay=float(st.secrets.get("HEDGE_MIN_DELAY_SECONDS", hedging.DEFAULT_MIN_DELAY)),
+)
+
+# Request scheduler shared by every session: global in-flight cap and the provider's rate limit.
+# Sessions take turns; single clicks go ahead of bulk chapter jobs.
+request_scheduler.configure(
+    max_in_flight=int(st.secrets.get("MAX_IN_FLIGHT_REQUESTS", request_scheduler.DEFAULT_MAX_IN_FLIGHT)),
+    requests_per_minute=float(st.secrets.get("OPENROUTER_REQUESTS_PER_MINUTE", 0)),
+    burst=int(st.secrets["OPENROUTER_REQUEST_BURST"]) if st.secrets.get("OPENROUTER_REQUEST_BURST") else None,
+)
+
+# Optional Prometheus scrape endpoint (/metrics, /metrics.json) for the LLM call telemetry
+if st.secrets.get("METRICS_PORT"):
+    telemetry.serve(int(st.secrets["METRICS_PORT"]))
+
+# Durable project store shared by every session: each artifact is saved as soon as it is generated
+projects = project_store.get_store(st.secrets.get("PROJECT_STORE_PATH", project_store.DEFAULT_PATH))
+# Chapter texts each session keeps in memory (the rest are read from the project store on demand)
+chapter_cache_size = int(st.secrets.get("CHAPTER_CACHE_SIZE", chapter_store.DEFAULT_CACHE_SIZE))
+
+# Chapters shown per page of the table of contents
+CHAPTERS_PER_PAGE = 5
+
+# Opt-in background prefetch of key events and conflicts: chapters ahead of the one being read,
+# and how many prefetch requests may run at once across all sessions
+prefetch_ahead = int(st.secrets.get("PREFETCH_AHEAD_CHAPTERS", prefetch.DEFAULT_AHEAD))
+request_scheduler.configure(
+    max_prefetch_in_flight=int(st.secrets.get("PREFETCH_MAX_IN_FLIGHT", request_scheduler.DEFAULT_MAX_PREFETCH_IN_FLIGHT)))
+
+# Helper function to read the ids of the projects this browser created or opened, kept in the
+# ?projects= URL parameter (the project store is shared: other visitors' projects are never listed)
+def own_project_ids():
+    if "own_projects" not in st.session_state:
+        st.session_state.own_projects = [project_id for project_id in st.query_params.get("projects", "").split(",")
+                                         if project_id]
+    return st.session_state.own_projects
+
+# Helper function to put a project in the session: its saved state (chapter texts as
+# views of the project store), the input widgets' values and the ?project= and ?projects= URL
+# parameters, so a browser refresh or a server restart reopens it and keeps the project list
+def load_project(project):
+    if "prefetcher" in st.session_state:
+        st.session_state.prefetcher.close()
+        del st.session_state.prefetcher
+    project.load(st.session_state)
+    st.session_state.project = project
+    st.session_state.user_theme_input = st.session_state.user_theme
+    st.session_state.num_chapters_input = min(max(int(st.session_state.num_chapters), 9), 30)
+    st.session_state.error = None
+    st.query_params["project"] = project.id
+    own_projects = own_project_ids()
+    if project.id not in own_projects:
+        own_projects.append(project.id)
+    st.query_params["projects"] = ",".join(own_projects)
 
-# Retry decorator for API calls
-@retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
-def make_api_request(payload):
-    response = requests.post(api_url, headers=headers, data=json.dumps(payload))
-    response.raise_for_status()
-    result = response.json()
-    # Debug: Log full API response
-    # st.write(f"Full API response: {result}")
-    return result
+# Helper function to autosave the parts of the novel state that changed since the last save
+def save_project():
+    st.session_state.project.save(st.session_state)
 
-# Initialize session state
+# Initialize session state, reopening the project named in the URL if it exists
 def initialize_session_state():
+    if "project" not in st.session_state:
+        project_id = st.query_params.get("project")
+        project = projects.open_project(project_id, chapter_cache_size) if project_id else None
+        load_project(project or projects.create_project(chapter_cache_size))
     defaults = {
-        "novel_outline_data": None,
-        "characters_data": None,
-        "setting_details": None,
-        "plot_twist_data": None,
-        "chapters_data": None,
-        "chapter_contents": {},
-        "chapter_conflicts": {},
-        "chapter_scene_descriptions": {},
-        "chapter_dialogue_snippets": {},
-        "chapter_sub_plot_ideas": {},
-        "chapter_key_events": {},
+        "scheduler_session": uuid.uuid4().hex[:8],
         "error": None,
         "loading_states": {},
-        "user_theme": "",
-        "num_chapters": 25,
-        "narrative_technique": None,
-        "narrator_pov": None
+        "bypass_cache": False
     }
     for key, value in defaults.items():
         if key not in st.session_state:
             st.session_state[key] = value
-
-# Helper function to validate API response
-def validate_api_response(result):
-    if not (result.get("choices") and isinstance(result["choices"], list) and
-            result["choices"][0].get("message") and
-            result["choices"][0]["message"].get("content")):
-        return None, "Respuesta de la API inválida o vacía."
-    return result["choices"][0]["message"]["content"], None
-
-# Helper function to clean and extract JSON from response
-def clean_json_content(content):
-    # Remove leading/trailing whitespace
-    content = content.strip()
-    
-    # Try to extract JSON from within ```json ... ``` blocks
-    json_pattern = r'```json\s*([\s\S]*?)\s*```'
-    match = re.search(json_pattern, content, re.MULTILINE)
-    if match:
-        content = match.group(1).strip()
-    
-    # Extract JSON by finding first { or [ and last } or ]
+    if "prefetcher" not in st.session_state:
+        st.session_state.prefetcher = prefetch.Prefetcher(st.session_state.scheduler_session)
+
+# Helper function to find the radio option matching a saved value
+def option_index(options, value):
+    return options.index(value) if value in options else 0
+
+# Helper function to run this session's API calls under a request_scheduler priority class
+def scheduled(priority):
+    return request_scheduler.context(st.session_state.scheduler_session, priority)
+
+# Helper function to run generation calls under a cancellation token, with the step deadline
+# unless `deadline` is False. While they wait for the API an elapsed-time note is refreshed every
+# second: each refresh lets Streamlit stop this run if the user clicked something else or left,
+# and leaving the block then cancels the token, which aborts the requests still in flight.
+@contextlib.contextmanager
+def cancellable(deadline=True):
+    placeholder = st.empty()
+    started = time.monotonic()
+    shown = [0]
+
+    def heartbeat():
+        elapsed = int(time.monotonic() - started)
+        if elapsed != shown[0]:
+            shown[0] = elapsed
+            placeholder.caption(f"Esperando respuesta... {elapsed} s")
+
+    token = cancellation.Token(cancellation.deadline_seconds if deadline else None, heartbeat=heartbeat)
+    with cancellation.scope(token):
+        try:
+            yield token
+        finally:
+            placeholder.empty()
+
+# Helper function to prefetch key events and conflicts for the chapters from `start` on, when enabled
+def prefetch_chapters(start):
+    if not st.session_state.get("prefetch_enabled"):
+        return
     try:
-        start = content.find('{') if '{' in content else content.find('[')
-        end = content.rfind('}') if '}' in content else content.rfind(']')
-        if start != -1 and end != -1 and end > start:
-            content = content[start:end + 1]
-        
-        # Attempt to validate JSON
-        json.loads(content)
-        return content
-    except json.JSONDecodeError:
-        # If JSON is invalid, return original content for debugging
-        return content
-
-# Helper function to ensure em-dash dialogue
-def ensure_em_dash_dialogue(text):
-    return text.replace('"', '—')
-
-# Function to generate initial novel outline
-def generate_initial_outline():
-    st.session_state.loading_states["outline"] = True
-    st.session_state.novel_outline_data = None
+        novel_engine.check_chapter_preconditions(st.session_state)
+        st.session_state.prefetcher.schedule(st.session_state, prefetch.targets_ahead(st.session_state, start, prefetch_ahead))
+    except novel_engine.GenerationError:
+        pass
+
+# Helper function to render a streamed generation as it arrives and return the assembled text.
+# The live text is drawn in a temporary placeholder that is cleared once the stream ends,
+# since the stored result is rendered by the main layout.
+def render_stream(chunks):
+    placeholder = st.empty()
+    with placeholder.container():
+        content = st.write_stream(chunks)
+    placeholder.empty()
+    return content
+
+# Helper function to list the entries of a streamed JSON array (characters, chapters) as each one
+# completes. Returns the on_item callback; the list is cleared once the main layout can show the result.
+def render_items(placeholder, item_label):
+    container = placeholder.container()
+    return lambda item, position: container.write(item_label(item, position))
+
+# Helper function to run a novel-level engine step with a spinner, loading flag and error reporting.
+# streamed steps draw their text as it arrives; steps with an item_label list their entries as they complete.
+def run_novel_step(loading_key, spinner, connection_error, step, streamed=False, item_label=None):
+    st.session_state.loading_states[loading_key] = True
     st.session_state.error = None
-
-    theme = st.session_state.user_theme.strip()
-    if not theme:
-        theme = "una novela histórica de aventuras ambientada en la Guerra de Independencia Española (1808-1814), con un protagonista que lucha contra la ocupación napoleónica, intrigas, resistencia popular, y una visión realista de la época."
-    elif len(theme) > 500:
-        st.session_state.error = "El tema de la novela es demasiado largo. Usa menos de 500 caracteres."
-        st.session_state.loading_states["outline"] = False
-        return
-    else:
-        theme = f"una novela histórica de aventuras ambientada en {theme}. La novela debe presentar un protagonista fuerte, intrigas, y una visión realista de la época."
-
-    prompt = f"""
-    Genera la síntesis, la descripción y la trama de {theme}. La respuesta debe ser un objeto JSON válido con las propiedades 'synthesis', 'description' y 'plot'. 
-    Asegúrate de que la respuesta contenga SOLO el objeto JSON, sin texto adicional, explicaciones ni bloques de código (```). Ejemplo:
-    {{"synthesis": "Una novela...", "description": "Ambientada en...", "plot": "La historia sigue..."}}.
-    """
-    payload = {"model": api_model, "messages": [{"role": "user", "content": prompt}]}
-
+    st.session_state.prefetcher.cancel_pending()
+    use_cache = not st.session_state.bypass_cache
     try:
-        with st.spinner("Creando el esquema inicial..."):
-            progress_bar = st.progress(0)
-            result = make_api_request(payload)
-            progress_bar.progress(50)
-            content, error = validate_api_response(result)
-            if error:
-                st.session_state.error = error
+        with st.spinner(spinner), scheduled(request_scheduler.INTERACTIVE), cancellable():
+            if streamed:
+                step(st.session_state, use_cache=use_cache, render=render_stream)
+            elif item_label:
+                placeholder = st.empty()
+                step(st.session_state, use_cache=use_cache, on_item=render_items(placeholder, item_label))
+                placeholder.empty()
             else:
-                cleaned_content = clean_json_content(content)
-                try:
-                    parsed_json = json.loads(cleaned_content)
-                    st.session_state.novel_outline_data = parsed_json
-                except json.JSONDecodeError as e:
-                    st.session_state.error = f"El contenido recibido de la API no es un JSON válido: {str(e)}. Contenido: {cleaned_content}"
-                    st.session_state.novel_outline_data = {"raw_content": content}
-            progress_bar.progress(100)
+                step(st.session_state, use_cache=use_cache, progress=st.progress(0).progress)
+    except (novel_engine.GenerationError, cancellation.Cancelled) as err:
+        st.session_state.error = str(err)
     except requests.exceptions.RequestException as err:
-        st.session_state.error = f"Error al conectar con la API: {str(err)}. Revisa tu conexión."
+        st.session_state.error = f"{connection_error}: {str(err)}. Revisa tu conexión."
     finally:
-        st.session_state.loading_states["outline"] = False
+        st.session_state.loading_states[loading_key] = False
+        save_project()
+
+# Function to generate initial novel outline
+def generate_initial_outline():
+    run_novel_step("outline", "Creando el esquema inicial...", "Error al conectar con la API",
+                   novel_engine.generate_initial_outline)
 
 # Function to generate main characters
 def generate_characters():
-    st.session_state.loading_states["characters"] = True
-    st.session_state.characters_data = None
-    st.session_state.error = None
-
-    if not (st.session_state.novel_outline_data and st.session_state.narrative_technique and st.session_state.narrator_pov):
-        st.session_state.error = "Genera primero el esquema inicial y selecciona la técnica narrativa y el punto de vista."
-        st.session_state.loading_states["characters"] = False
-        return
-
-    if isinstance(st.session_state.novel_outline_data, dict) and "raw_content" in st.session_state.novel_outline_data:
-        st.session_state.error = "El esquema inicial no se generó correctamente (JSON inválido). Genera el esquema nuevamente."
-        st.session_state.loading_states["characters"] = False
-        return
-
-    characters_prompt = f"""
-    Basándote en la siguiente información de la novela:
-    Síntesis General: {st.session_state.novel_outline_data['synthesis']}
-    Trama General: {st.session_state.novel_outline_data['plot']}
-    Técnica Narrativa: {st.session_state.narrative_technique}
-    Punto de Vista del Narrador: {st.session_state.narrator_pov}
-    Genera 3-5 personajes principales para esta novela. Para cada personaje, proporciona su nombre, su rol en la historia (ej. 'protagonista', 'antagonista', 'aliado', 'interés amoroso'), y una breve descripción de su personalidad y su relevancia para la trama. 
-    Responde con un array JSON válido que contenga objetos con las propiedades 'name', 'role' y 'description'. 
-    Asegúrate de que la respuesta contenga SOLO el array JSON, sin texto adicional, explicaciones ni bloques de código (```). Ejemplo:
-    [{{"name": "Juan", "role": "protagonista", "description": "Un joven valiente..."}}, {{"name": "Ana", "role": "aliado", "description": "Una estratega..."}}]
-    """
-    payload = {"model": api_model, "messages": [{"role": "user", "content": characters_prompt}]}
-
-    try:
-        with st.spinner("Generando personajes..."):
-            progress_bar = st.progress(0)
-            result = make_api_request(payload)
-            progress_bar.progress(50)
-            content, error = validate_api_response(result)
-            if error:
-                st.session_state.error = error
-            else:
-                cleaned_content = clean_json_content(content)
-                try:
-                    parsed_json = json.loads(cleaned_content)
-                    if not isinstance(parsed_json, list):
-                        raise ValueError("La respuesta de la API no es un array JSON válido.")
-                    st.session_state.characters_data = parsed_json
-                except (json.JSONDecodeError, ValueError) as e:
-                    st.session_state.error = f"El contenido recibido de la API no es un JSON válido: {str(e)}. Contenido: {cleaned_content}"
-                    st.session_state.characters_data = {"raw_content": content}
-            progress_bar.progress(100)
-    except requests.exceptions.RequestException as err:
-        st.session_state.error = f"Error al generar personajes: {str(err)}. Revisa tu conexión."
-    finally:
-        st.session_state.loading_states["characters"] = False
+    run_novel_step("characters", "Generando personajes...", "Error al generar personajes",
+                   novel_engine.generate_characters,
+                   item_label=lambda char, position: f"**{char.get('name', '')}** ({char.get('role', '')})")
 
 # Function to generate setting details
 def generate_setting_details():
-    st.session_state.loading_states["setting"] = True
-    st.session_state.setting_details = None
-    st.session_state.error = None
-
-    if not (st.session_state.novel_outline_data and st.session_state.characters_data and
-            st.session_state.narrative_technique and st.session_state.narrator_pov):
-        st.session_state.error = "Genera primero el esquema inicial, los personajes y selecciona la técnica narrativa y el punto de vista."
-        st.session_state.loading_states["setting"] = False
-        return
-
-    if isinstance(st.session_state.characters_data, dict) and "raw_content" in st.session_state.characters_data:
-        st.session_state.error = "Los personajes no se generaron correctamente (JSON inválido). Genera los personajes nuevamente."
-        st.session_state.loading_states["setting"] = False
-        return
-
-    setting_prompt = f"""
-    Basándote en el tema de la novela: '{st.session_state.user_theme.strip() or 'Guerra de Independencia Española'}',
-    la descripción general de la novela: '{st.session_state.novel_outline_data['description']}',
-    la técnica narrativa: {st.session_state.narrative_technique} y
-    el punto de vista del narrador: {st.session_state.narrator_pov},
-    genera una descripción detallada de la ambientación o un aspecto histórico/cultural clave de la novela.
-    Incluye detalles sobre la atmósfera, la sociedad, la vida cotidiana, y elementos visuales relevantes. Aproximadamente 500-700 palabras.
-    """
-    payload = {"model": api_model, "messages": [{"role": "user", "content": setting_prompt}]}
-
-    try:
-        with st.spinner("Generando ambientación..."):
-            progress_bar = st.progress(0)
-            result = make_api_request(payload)
-            progress_bar.progress(50)
-            content, error = validate_api_response(result)
-            if error:
-                st.session_state.error = error
-            else:
-                st.session_state.setting_details = content
-            progress_bar.progress(100)
-    except requests.exceptions.RequestException as err:
-        st.session_state.error = f"Error al generar ambientación: {str(err)}. Revisa tu conexión."
-    finally:
-        st.session_state.loading_states["setting"] = False
+    run_novel_step("setting", "Generando ambientación...", "Error al generar ambientación",
+                   novel_engine.generate_setting_details, streamed=True)
 
 # Function to generate plot twist
 def generate_plot_twist():
-    st.session_state.loading_states["plot_twist"] = True
-    st.session_state.plot_twist_data = None
-    st.session_state.error = None
-
-    if not (st.session_state.novel_outline_data and st.session_state.characters_data and
-            st.session_state.setting_details and st.session_state.narrative_technique and
-            st.session_state.narrator_pov):
-        st.session_state.error = "Genera el esquema inicial, los personajes, la ambientación y selecciona la técnica narrativa y el punto de vista antes de generar giros argumentales."
-        st.session_state.loading_states["plot_twist"] = False
-        return
-
-    if isinstance(st.session_state.characters_data, dict) and "raw_content" in st.session_state.characters_data:
-        st.session_state.error = "Los personajes no se generaron correctamente (JSON inválido). Genera los personajes nuevamente."
-        st.session_state.loading_states["plot_twist"] = False
-        return
-
-    plot_twist_prompt = f"""
-    Basándote en la síntesis general: "{st.session_state.novel_outline_data['synthesis']}",
-    la trama general: "{st.session_state.novel_outline_data['plot']}",
-    los personajes: {', '.join([char['name'] for char in st.session_state.characters_data])},
-    la ambientación: "{st.session_state.setting_details}",
-    la técnica narrativa: {st.session_state.narrative_technique} y
-    el punto de vista del narrador: {st.session_state.narrator_pov},
-    sugiere 1-2 giros argumentales sorprendentes y significativos para la novela.
-    Describe cómo podrían impactar la trama y los personajes. Aproximadamente 300-500 palabras.
-    """
-    payload = {"model": api_model, "messages": [{"role": "user", "content": plot_twist_prompt}]}
-
-    try:
-        with st.spinner("Generando giros argumentales..."):
-            progress_bar = st.progress(0)
-            result = make_api_request(payload)
-            progress_bar.progress(50)
-            content, error = validate_api_response(result)
-            if error:
-                st.session_state.error = error
-            else:
-                st.session_state.plot_twist_data = content
-            progress_bar.progress(100)
-    except requests.exceptions.RequestException as err:
-        st.session_state.error = f"Error al generar giros argumentales: {str(err)}. Revisa tu conexión."
-    finally:
-        st.session_state.loading_states["plot_twist"] = False
+    run_novel_step("plot_twist", "Generando giros argumentales...", "Error al generar giros argumentales",
+                   novel_engine.generate_plot_twist, streamed=True)
 
 # Function to generate table of contents
 def generate_table_of_contents():
-    st.session_state.loading_states["chapters"] = True
-    st.session_state.chapters_data = None
-    st.session_state.error = None
-
-    if not (st.session_state.novel_outline_data and st.session_state.characters_data and
-            st.session_state.setting_details and st.session_state.plot_twist_data and
-            st.session_state.narrative_technique and st.session_state.narrator_pov):
-        st.session_state.error = "Genera el esquema inicial, los personajes, la ambientación, los giros argumentales y selecciona la técnica narrativa y el punto de vista antes de generar la tabla de contenidos."
-        st.session_state.loading_states["chapters"] = False
-        return
-
-    if isinstance(st.session_state.characters_data, dict) and "raw_content" in st.session_state.characters_data:
-        st.session_state.error = "Los personajes no se generaron correctamente (JSON inválido). Genera los personajes nuevamente."
-        st.session_state.loading_states["chapters"] = False
-        return
-
-    if not 9 <= st.session_state.num_chapters <= 30:
-        st.session_state.error = "El número de capítulos debe estar entre 9 y 30."
-        st.session_state.loading_states["chapters"] = False
-        return
-
-    chapters_prompt = f"""
-    Basándote en la síntesis general: "{st.session_state.novel_outline_data['synthesis']}",
-    la trama general: "{st.session_state.novel_outline_data['plot']}",
-    la ambientación: "{st.session_state.setting_details}",
-    los personajes principales: {', '.join([char['name'] for char in st.session_state.characters_data])},
-    los giros argumentales: "{st.session_state.plot_twist_data}",
-    la técnica narrativa: {st.session_state.narrative_technique} y
-    el punto de vista del narrador: {st.session_state.narrator_pov},
-    genera una tabla de contenidos para una novela de {st.session_state.num_chapters} capítulos.
-    Cada capítulo debe tener un título y una breve descripción de su contenido, siguiendo el estilo de una novela histórica de aventuras.
-    Responde con un array JSON válido que contenga objetos con las propiedades 'title' y 'description'.
-    Asegúrate de que la respuesta contenga SOLO el array JSON, sin texto adicional, explicaciones ni bloques de código (```). Ejemplo:
-    [{{"title": "El comienzo", "description": "El protagonista descubre..."}}, {{"title": "La traición", "description": "Un aliado revela..."}}]
-    """
-    payload = {"model": api_model, "messages": [{"role": "user", "content": chapters_prompt}]}
-
-    try:
-        with st.spinner("Generando tabla de contenidos..."):
-            progress_bar = st.progress(0)
-            result = make_api_request(payload)
-            progress_bar.progress(50)
-            content, error = validate_api_response(result)
-            if error:
-                st.session_state.error = error
-            else:
-                cleaned_content = clean_json_content(content)
-                try:
-                    parsed_json = json.loads(cleaned_content)
-                    if not isinstance(parsed_json, list):
-                        raise ValueError("La respuesta de la API no es un array JSON válido.")
-                    st.session_state.chapters_data = parsed_json
-                except (json.JSONDecodeError, ValueError) as e:
-                    st.session_state.error = f"El contenido recibido de la API no es un JSON válido: {str(e)}. Contenido: {cleaned_content}"
-                    st.session_state.chapters_data = {"raw_content": content}
-            progress_bar.progress(100)
-    except requests.exceptions.RequestException as err:
-        st.session_state.error = f"Error al generar tabla de contenidos: {str(err)}. Revisa tu conexión."
-    finally:
-        st.session_state.loading_states["chapters"] = False
-
-# Function to generate chapter content
-def generate_chapter_content(chapter, index):
-    st.session_state.loading_states[f"chapter_content_{index}"] = True
+    run_novel_step("chapters", "Generando tabla de contenidos...", "Error al generar tabla de contenidos",
+                   novel_engine.generate_table_of_contents,
+                   item_label=lambda chapter, position: f"**Capítulo {position + 1}:** {chapter.get('title', '')}")
+
+# Function to generate one per-chapter artifact (key events, conflict, sub-plots, scene, dialogue or content)
+def generate_chapter_artifact(artifact, index):
+    noun = novel_engine.CHAPTER_ARTIFACTS[artifact][5]
+    loading_key = f"chapter_{artifact}_{index}"
+    st.session_state.loading_states[loading_key] = True
     st.session_state.error = None
-
-    if not (st.session_state.novel_outline_data and st.session_state.chapters_data and
-            st.session_state.narrative_technique and st.session_state.narrator_pov):
-        st.session_state.error = "Genera primero el esquema de la novela, la tabla de contenidos y selecciona la técnica narrativa y el punto de vista."
-        st.session_state.loading_states[f"chapter_content_{index}"] = False
-        return
-
-    if isinstance(st.session_state.chapters_data, dict) and "raw_content" in st.session_state.chapters_data:
-        st.session_state.error = "La tabla de contenidos no se generó correctamente (JSON inválido). Genera la tabla nuevamente."
-        st.session_state.loading_states[f"chapter_content_{index}"] = False
-        return
-
-    chapter_prompt = f"""
-    Basándote en la siguiente información de la novela:
-    Síntesis General: {st.session_state.novel_outline_data['synthesis']}
-    Trama General: {st.session_state.novel_outline_data['plot']}
-    Ambientación: {st.session_state.setting_details}
-    Personajes Principales: {', '.join([f'{char['name']} ({char['role']})' for char in st.session_state.characters_data])}
-    Giros Argumentales: {st.session_state.plot_twist_data or 'No especificados'}
-    Técnica Narrativa: {st.session_state.narrative_technique}
-    Punto de Vista del Narrador: {st.session_state.narrator_pov}
-    Conflicto del Capítulo: {st.session_state.chapter_conflicts.get(index, 'No especificado')}
-    Descripción de Escena del Capítulo: {st.session_state.chapter_scene_descriptions.get(index, 'No especificado')}
-    Diálogo del Capítulo: {st.session_state.chapter_dialogue_snippets.get(index, 'No especificado')}
-    Subtramas del Capítulo: {st.session_state.chapter_sub_plot_ideas.get(index, 'No especificadas')}
-    Eventos Clave del Capítulo: {st.session_state.chapter_key_events.get(index, 'No especificados')}
-    Escribe el contenido completo para el capítulo '{chapter['title']}' (Capítulo {index + 1}).
-    El capítulo debe tener aproximadamente 1200 palabras y expandir la descripción: '{chapter['description']}'.
-    Asegúrate de que el tono y estilo sean coherentes con una novela histórica de aventuras.
-    Asegúrate de que los diálogos utilicen rayas (guion largo '—') en lugar de comillas.
-    """
-    payload = {"model": api_model, "messages": [{"role": "user", "content": chapter_prompt}]}
-
     try:
-        with st.spinner(f"Generando contenido para el Capítulo {index + 1}..."):
-            progress_bar = st.progress(0)
-            result = make_api_request(payload)
-            progress_bar.progress(50)
-            content, error = validate_api_response(result)
-            if error:
-                st.session_state.error = f"No se pudo generar el contenido para el Capítulo {index + 1}: {error}"
+        with st.spinner(f"Generando {noun} para el Capítulo {index + 1}..."), scheduled(request_scheduler.INTERACTIVE), \
+                cancellable():
+            novel_engine.check_chapter_preconditions(st.session_state)
+            # A prefetched result is stored at once; regenerating without the cache never uses one
+            prefetched = None
+            if st.session_state.get("prefetch_enabled") and not st.session_state.bypass_cache:
+                prefetched = st.session_state.prefetcher.claim(st.session_state, artifact, index)
+            st.session_state.prefetcher.cancel_pending()
+            if prefetched is not None:
+                novel_engine.store_chapter_artifact(st.session_state, artifact, index, prefetched)
             else:
-                st.session_state.chapter_contents[index] = ensure_em_dash_dialogue(content)
-            progress_bar.progress(100)
+                novel_engine.generate_chapter_artifact(st.session_state, artifact, index,
+                                                       use_cache=not st.session_state.bypass_cache, render=render_stream)
+                later = [chapter for chapter in st.session_state.chapter_contents if chapter > index]
+                if artifact == "content" and later:
+                    st.info(f"Los {len(later)} capítulos posteriores ya escritos no se marcan como obsoletos: se escribieron "
+                            f"con la memoria de continuidad anterior. Vuelve a generarlos si deben reflejar este capítulo.")
+    except (novel_engine.GenerationError, cancellation.Cancelled) as err:
+        st.session_state.error = str(err)
     except requests.exceptions.RequestException as err:
-        st.session_state.error = f"Error al generar contenido para el Capítulo {index + 1}: {str(err)}. Revisa tu conexión."
+        st.session_state.error = f"Error al generar {noun} para el Capítulo {index + 1}: {str(err)}. Revisa tu conexión."
     finally:
-        st.session_state.loading_states[f"chapter_content_{index}"] = False
-
-# Function to generate chapter conflict
-def generate_chapter_conflict(chapter, index):
-    st.session_state.loading_states[f"chapter_conflict_{index}"] = True
-    st.session_state.error = None
-
-    if not (st.session_state.novel_outline_data and st.session_state.chapters_data and
-            st.session_state.narrative_technique and st.session_state.narrator_pov):
-        st.session_state.error = "Genera primero el esquema de la novela, la tabla de contenidos y selecciona la técnica narrativa y el punto de vista."
-        st.session_state.loading_states[f"chapter_conflict_{index}"] = False
+        st.session_state.loading_states[loading_key] = False
+        save_project()
+
+# Helper function to run per-chapter generations on the bounded thread pool with progress reporting.
+# `phases` is a list of [(artifact, index), ...] batches run one after another.
+def run_chapter_jobs(phases, concurrency):
+    total = sum(len(phase) for phase in phases)
+    if total == 0:
         return
-
-    if isinstance(st.session_state.chapters_data, dict) and "raw_content" in st.session_state.chapters_data:
-        st.session_state.error = "La tabla de contenidos no se generó correctamente (JSON inválido). Genera la tabla nuevamente."
-        st.session_state.loading_states[f"chapter_conflict_{index}"] = False
-        return
-
-    conflict_prompt = f"""
-    Basándote en la síntesis general de la novela: "{st.session_state.novel_outline_data['synthesis']}",
-    la trama general: "{st.session_state.novel_outline_data['plot']}",
-    la técnica narrativa: {st.session_state.narrative_technique} y
-    el punto de vista del narrador: {st.session_state.narrator_pov},
-    y específicamente en el capítulo '{chapter['title']}' (descripción: '{chapter['description']}'),
-    sugiere un conflicto o un obstáculo significativo que podría surgir en este capítulo.
-    Describe la naturaleza del conflicto, sus posibles implicaciones para el protagonista y la trama dentro de este capítulo, y cómo podría resolverse o evolucionar.
-    Aproximadamente 300-500 palabras.
-    """
-    payload = {"model": api_model, "messages": [{"role": "user", "content": conflict_prompt}]}
-
-    try:
-        with st.spinner(f"Generando conflicto para el Capítulo {index + 1}..."):
-            progress_bar = st.progress(0)
-            result = make_api_request(payload)
-            progress_bar.progress(50)
-            content, error = validate_api_response(result)
-            if error:
-                st.session_state.error = f"No se pudo generar el conflicto para el Capítulo {index + 1}: {error}"
+    failures = []
+    completed = 0
+    progress_bar = st.progress(0)
+    # Each chapter job has its own deadline (see novel_engine.iter_chapter_jobs), the run as a whole none
+    with st.status(f"Generando {total} elementos con {concurrency} peticiones simultáneas...", expanded=True) as status, \
+            scheduled(request_scheduler.BULK), cancellable(deadline=False):
+        for artifact, index, err in novel_engine.iter_chapter_jobs(st.session_state, phases, concurrency,
+                                                                  use_cache=not st.session_state.bypass_cache):
+            label = novel_engine.CHAPTER_ARTIFACTS[artifact][3]
+            completed += 1
+            if err:
+                failures.append(f"Cap. {index + 1} ({label}): {err}")
+                status.write(f"❌ {label} - Cap. {index + 1}: {err}")
             else:
-                st.session_state.chapter_conflicts[index] = content
-            progress_bar.progress(100)
-    except requests.exceptions.RequestException as err:
-        st.session_state.error = f"Error al generar conflicto para el Capítulo {index + 1}: {str(err)}. Revisa tu conexión."
-    finally:
-        st.session_state.loading_states[f"chapter_conflict_{index}"] = False
-
-# Function to generate chapter scene description
-def generate_chapter_scene_description(chapter, index):
-    st.session_state.loading_states[f"chapter_scene_{index}"] = True
+                status.write(f"✅ {label} - Cap. {index + 1}")
+            progress_bar.progress(completed / total)
+            save_project()
+        status.update(label=f"Generación completada: {total - len(failures)}/{total} elementos.",
+                      state="error" if failures else "complete", expanded=bool(failures))
+    if failures:
+        st.session_state.error = "Algunos elementos no se pudieron generar (los demás se conservaron):\n" + "\n".join(failures)
+
+# Function to generate every chapter in one action.
+# Details run first (the content prompt includes them), then chapter contents.
+# The run is recorded in the project until it finishes, so an interrupted one can be resumed.
+def generate_all_chapters(include_details, concurrency, only_missing, in_order=False):
+    st.session_state.loading_states["all_chapters"] = True
     st.session_state.error = None
-
-    if not (st.session_state.novel_outline_data and st.session_state.chapters_data and
-            st.session_state.narrative_technique and st.session_state.narrator_pov):
-        st.session_state.error = "Genera primero el esquema de la novela, la tabla de contenidos y selecciona la técnica narrativa y el punto de vista."
-        st.session_state.loading_states[f"chapter_scene_{index}"] = False
-        return
-
-    if isinstance(st.session_state.chapters_data, dict) and "raw_content" in st.session_state.chapters_data:
-        st.session_state.error = "La tabla de contenidos no se generó correctamente (JSON inválido). Genera la tabla nuevamente."
-        st.session_state.loading_states[f"chapter_scene_{index}"] = False
-        return
-
-    scene_prompt = f"""
-    Basándote en el tema de la novela: '{st.session_state.user_theme.strip() or 'Guerra de Independencia Española'}',
-    la descripción general de la novela: '{st.session_state.novel_outline_data['description']}',
-    la técnica narrativa: {st.session_state.narrative_technique} y
-    el punto de vista del narrador: {st.session_state.narrator_pov},
-    y específicamente en el capítulo '{chapter['title']}' (descripción: '{chapter['description']}'),
-    genera una descripción detallada de una escena clave o un lugar significativo dentro de este capítulo.
-    Enfócate en los detalles sensoriales (vista, sonido, olfato, tacto), la atmósfera, y cómo el entorno influye en los personajes en esta escena.
-    Aproximadamente 500-700 palabras.
-    """
-    payload = {"model": api_model, "messages": [{"role": "user", "content": scene_prompt}]}
-
+    project = st.session_state.project
+    st.session_state.prefetcher.cancel_pending()
     try:
-        with st.spinner(f"Generando descripción de escena para el Capítulo {index + 1}..."):
-            progress_bar = st.progress(0)
-            result = make_api_request(payload)
-            progress_bar.progress(50)
-            content, error = validate_api_response(result)
-            if error:
-                st.session_state.error = f"No se pudo generar la descripción de escena para el Capítulo {index + 1}: {error}"
-            else:
-                st.session_state.chapter_scene_descriptions[index] = content
-            progress_bar.progress(100)
-    except requests.exceptions.RequestException as err:
-        st.session_state.error = f"Error al generar descripción de escena para el Capítulo {index + 1}: {str(err)}. Revisa tu conexión."
+        novel_engine.check_chapter_preconditions(st.session_state)
+        project.set_pending_job({"include_details": include_details, "in_order": in_order})
+        run_chapter_jobs(novel_engine.chapter_phases(st.session_state, include_details, only_missing, in_order), concurrency)
+        project.set_pending_job(None)
+    except novel_engine.GenerationError as err:
+        st.session_state.error = str(err)
     finally:
-        st.session_state.loading_states[f"chapter_scene_{index}"] = False
-
-# Function to generate chapter dialogue snippet
-def generate_chapter_dialogue_snippet(chapter, index):
-    st.session_state.loading_states[f"chapter_dialogue_{index}"] = True
-    st.session_state.error = None
-
-    if not (st.session_state.novel_outline_data and st.session_state.chapters_data and
-            st.session_state.narrative_technique and st.session_state.narrator_pov):
-        st.session_state.error = "Genera primero el esquema de la novela, la tabla de contenidos y selecciona la técnica narrativa y el punto de vista."
-        st.session_state.loading_states[f"chapter_dialogue_{index}"] = False
-        return
-
-    if isinstance(st.session_state.chapters_data, dict) and "raw_content" in st.session_state.chapters_data:
-        st.session_state.error = "La tabla de contenidos no se generó correctamente (JSON inválido). Genera la tabla nuevamente."
-        st.session_state.loading_states[f"chapter_dialogue_{index}"] = False
-        return
-
-    dialogue_prompt = f"""
-    Basándote en la síntesis general de la novela: "{st.session_state.novel_outline_data['synthesis']}",
-    la trama general: "{st.session_state.novel_outline_data['plot']}",
-    la técnica narrativa: {st.session_state.narrative_technique} y
-    el punto de vista del narrador: {st.session_state.narrator_pov},
-    y específicamente en el capítulo '{chapter['title']}' (descripción: '{chapter['description']}'),
-    genera un breve fragmento de diálogo (2-4 líneas) entre dos personajes relevantes para este capítulo.
-    El diálogo debe ser relevante para la trama o los personajes en este punto de la historia, y debe utilizar rayas (guion largo '—') para indicar las intervenciones de los personajes, no comillas.
-    """
-    payload = {"model": api_model, "messages": [{"role": "user", "content": dialogue_prompt}]}
-
-    try:
-        with st.spinner(f"Generando diálogo para el Capítulo {index + 1}..."):
-            progress_bar = st.progress(0)
-            result = make_api_request(payload)
-            progress_bar.progress(50)
-            content, error = validate_api_response(result)
-            if error:
-                st.session_state.error = f"No se pudo generar el diálogo para el Capítulo {index + 1}: {error}"
+        st.session_state.loading_states["all_chapters"] = False
+
+# Function to render one chapter of the table of contents.
+# It is a fragment: a button inside it reruns only this chapter's block, not the whole novel,
+# and the generated texts are only drawn while the chapter's toggle is on.
+@st.fragment
+def render_chapter(index):
+    chapter = st.session_state.chapters_data[index]
+    open_key = f"chapter_open_{index}"
+    with st.container(border=True):
+        st.write(f"**{chapter['title']}**")
+        st.write(chapter['description'])
+
+        # Buttons for generating chapter-specific details
+        requested = None
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            if st.button(f"Eventos Clave - Cap. {index + 1}"):
+                requested = "key_events"
+            if st.button(f"Conflicto - Cap. {index + 1}"):
+                requested = "conflict"
+        with col2:
+            if st.button(f"Subtramas - Cap. {index + 1}"):
+                requested = "sub_plot"
+            if st.button(f"Escena - Cap. {index + 1}"):
+                requested = "scene"
+        with col3:
+            if st.button(f"Diálogo - Cap. {index + 1}"):
+                requested = "dialogue"
+            if st.button(f"Contenido - Cap. {index + 1}"):
+                requested = "content"
+        if requested:
+            generate_chapter_artifact(requested, index)
+            if st.session_state.error:
+                st.error(st.session_state.error)
             else:
-                st.session_state.chapter_dialogue_snippets[index] = ensure_em_dash_dialogue(content)
-            progress_bar.progress(100)
-    except requests.exceptions.RequestException as err:
-        st.session_state.error = f"Error al generar diálogo para el Capítulo {index + 1}: {str(err)}. Revisa tu conexión."
-    finally:
-        st.session_state.loading_states[f"chapter_dialogue_{index}"] = False
-
-# Function to generate chapter sub plot ideas
-def generate_chapter_sub_plot_ideas(chapter, index):
-    st.session_state.loading_states[f"chapter_sub_plot_{index}"] = True
-    st.session_state.error = None
-
-    if not (st.session_state.novel_outline_data and st.session_state.chapters_data and
-            st.session_state.narrative_technique and st.session_state.narrator_pov):
-        st.session_state.error = "Genera primero el esquema de la novela, la tabla de contenidos y selecciona la técnica narrativa y el punto de vista."
-        st.session_state.loading_states[f"chapter_sub_plot_{index}"] = False
-        return
-
-    if isinstance(st.session_state.chapters_data, dict) and "raw_content" in st.session_state.chapters_data:
-        st.session_state.error = "La tabla de contenidos no se generó correctamente (JSON inválido). Genera la tabla nuevamente."
-        st.session_state.loading_states[f"chapter_sub_plot_{index}"] = False
-        return
-
-    sub_plot_prompt = f"""
-    Basándote en la síntesis general de la novela: "{st.session_state.novel_outline_data['synthesis']}",
-    la trama general: "{st.session_state.novel_outline_data['plot']}",
-    la técnica narrativa: {st.session_state.narrative_technique} y
-    el punto de vista del narrador: {st.session_state.narrator_pov},
-    y específicamente en el capítulo '{chapter['title']}' (descripción: '{chapter['description']}'),
-    sugiere 1-2 ideas para subtramas que puedan enriquecer la narrativa principal en este capítulo o en los siguientes.
-    Para cada idea, describe brevemente la subtrama y cómo podría conectarse con la historia principal o los personajes.
-    """
-    payload = {"model": api_model, "messages": [{"role": "user", "content": sub_plot_prompt}]}
-
-    try:
-        with st.spinner(f"Generando ideas de subtramas para el Capítulo {index + 1}..."):
-            progress_bar = st.progress(0)
-            result = make_api_request(payload)
-            progress_bar.progress(50)
-            content, error = validate_api_response(result)
-            if error:
-                st.session_state.error = f"No se pudieron generar ideas de subtramas para el Capítulo {index + 1}: {error}"
-            else:
-                st.session_state.chapter_sub_plot_ideas[index] = content
-            progress_bar.progress(100)
-    except requests.exceptions.RequestException as err:
-        st.session_state.error = f"Error al generar ideas de subtramas para el Capítulo {index + 1}: {str(err)}. Revisa tu conexión."
-    finally:
-        st.session_state.loading_states[f"chapter_sub_plot_{index}"] = False
-
-# Function to generate chapter key events
-def generate_chapter_key_events(chapter, index):
-    st.session_state.loading_states[f"chapter_key_events_{index}"] = True
-    st.session_state.error = None
-
-    if not (st.session_state.novel_outline_data and st.session_state.chapters_data and
-            st.session_state.narrative_technique and st.session_state.narrator_pov):
-        st.session_state.error = "Genera primero el esquema de la novela, la tabla de contenidos y selecciona la técnica narrativa y el punto de vista."
-        st.session_state.loading_states[f"chapter_key_events_{index}"] = False
-        return
-
-    if isinstance(st.session_state.chapters_data, dict) and "raw_content" in st.session_state.chapters_data:
-        st.session_state.error = "La tabla de contenidos no se generó correctamente (JSON inválido). Genera la tabla nuevamente."
-        st.session_state.loading_states[f"chapter_key_events_{index}"] = False
-        return
+                st.session_state[open_key] = True
+                prefetch_chapters(index + 1)
+
+        generated = sum(1 for state_key, *_ in novel_engine.CHAPTER_ARTIFACTS.values() if index in st.session_state[state_key])
+        if not generated or not st.toggle(f"Mostrar lo generado ({generated})", key=open_key):
+            return
+
+        # Display chapter-specific details
+        if st.session_state.chapter_key_events.get(index):
+            st.subheader("Eventos Clave Sugeridos")
+            st.write(st.session_state.chapter_key_events[index])
+
+        if st.session_state.chapter_conflicts.get(index):
+            st.subheader("Conflicto/Obstáculo Sugerido")
+            st.write(st.session_state.chapter_conflicts[index])
+
+        if st.session_state.chapter_sub_plot_ideas.get(index):
+            st.subheader("Ideas para Subtramas")
+            st.write(st.session_state.chapter_sub_plot_ideas[index])
+
+        if st.session_state.chapter_scene_descriptions.get(index):
+            st.subheader("Descripción de Escena Sugerida")
+            st.write(st.session_state.chapter_scene_descriptions[index])
+
+        if st.session_state.chapter_dialogue_snippets.get(index):
+            st.subheader("Fragmento de Diálogo Sugerido")
+            st.write(st.session_state.chapter_dialogue_snippets[index])
+
+        if st.session_state.chapter_contents.get(index):
+            st.subheader("Contenido del Capítulo")
+            st.write(st.session_state.chapter_contents[index])
+
+        memory = st.session_state.continuity_memory.get(str(index))
+        if memory:
+            with st.expander("Memoria de continuidad tras este capítulo"):
+                st.write(memory["memory"])
+
+# Helper function to collect what an export reads. The download callable runs on another
+# thread, outside the session, so it gets these references rather than st.session_state.
+def export_state():
+    keys = ["user_theme", "novel_outline_data", "characters_data", "setting_details", "plot_twist_data", "chapters_data"]
+    keys += [state_key for state_key, *_ in novel_engine.CHAPTER_ARTIFACTS.values()]
+    return {key: st.session_state[key] for key in keys}
+
+# Display names for artifacts and their inputs
+ARTIFACT_LABELS = {
+    "user_theme": "Tema",
+    "narrative_technique": "Técnica narrativa",
+    "narrator_pov": "Punto de vista",
+    "num_chapters": "Número de capítulos",
+    "novel_outline_data": "Esquema inicial",
+    "characters_data": "Personajes",
+    "setting_details": "Ambientación",
+    "plot_twist_data": "Giros argumentales",
+    "chapters_data": "Tabla de contenidos",
+    **{state_key: label for state_key, _, _, label, *_ in novel_engine.CHAPTER_ARTIFACTS.values()},
+}
 
-    key_events_prompt = f"""
-    Basándote en la síntesis general de la novela: "{st.session_state.novel_outline_data['synthesis']}",
-    la trama general: "{st.session_state.novel_outline_data['plot']}",
-    la ambientación: "{st.session_state.setting_details}",
-    la técnica narrativa: {st.session_state.narrative_technique} y
-    el punto de vista del narrador: {st.session_state.narrator_pov},
-    y específicamente en el capítulo '{chapter['title']}' (descripción: '{chapter['description']}'),
-    sugiere 2-3 eventos clave o puntos de inflexión que deberían ocurrir en este capítulo.
-    Describe brevemente cada evento y cómo contribuye al avance de la trama.
-    """
-    payload = {"model": api_model, "messages": [{"role": "user", "content": key_events_prompt}]}
+# App wrappers for the novel-level engine steps, used when rebuilding stale artifacts
+APP_NOVEL_STEPS = {
+    "novel_outline_data": generate_initial_outline,
+    "characters_data": generate_characters,
+    "setting_details": generate_setting_details,
+    "plot_twist_data": generate_plot_twist,
+    "chapters_data": generate_table_of_contents,
+}
 
+# Function to regenerate only the stale artifacts, in dependency order.
+# Staleness is re-evaluated after each step: rebuilding an artifact only stales its
+# dependents if its new value differs where they read it.
+def rebuild_stale_artifacts(concurrency):
+    st.session_state.loading_states["rebuild_stale"] = True
     try:
-        with st.spinner(f"Generando eventos clave para el Capítulo {index + 1}..."):
-            progress_bar = st.progress(0)
-            result = make_api_request(payload)
-            progress_bar.progress(50)
-            content, error = validate_api_response(result)
-            if error:
-                st.session_state.error = f"No se pudieron generar eventos clave para el Capítulo {index + 1}: {error}"
+        for _ in range(len(novel_engine.novel_graph.nodes) + 1):
+            step = novel_engine.next_stale_step(st.session_state)
+            if step is None:
+                break
+            kind, target = step
+            if kind == "novel":
+                APP_NOVEL_STEPS[target]()
             else:
-                st.session_state.chapter_key_events[index] = content
-            progress_bar.progress(100)
-    except requests.exceptions.RequestException as err:
-        st.session_state.error = f"Error al generar eventos clave para el Capítulo {index + 1}: {str(err)}. Revisa tu conexión."
+                run_chapter_jobs([target], concurrency)
+            if st.session_state.error:
+                break
     finally:
-        st.session_state.loading_states[f"chapter_key_events_{index}"] = False
+        st.session_state.loading_states["rebuild_stale"] = False
 
 # Streamlit app layout
 st.title("Generador de Novelas Personalizable")
@@ -612,11 +468,152 @@ st.write("Introduce el tema o la época para tu novela histórica de aventuras,
 # Initialize session state
 initialize_session_state()
 
+# Project selection and response cache controls
+with st.sidebar:
+    st.subheader("Proyectos")
+    current_project = st.session_state.project
+    st.caption(f"Proyecto actual: {current_project.id} · " +
+               ("guardado automáticamente" if current_project.exists else "se guardará al generar el esquema"))
+    saved_projects = [project for project in projects.list_projects(own_project_ids()) if project["id"] != current_project.id]
+    if saved_projects:
+        chosen_project = st.selectbox("Proyectos guardados:", saved_projects, format_func=lambda project: (
+            f"{project['title']} · {project['chapters_written']} cap. · "
+            f"{time.strftime('%d/%m %H:%M', time.localtime(project['updated']))}" +
+            (" · interrumpido" if project["interrupted"] else "")))
+        if st.button("Abrir Proyecto"):
+            reopened = projects.open_project(chosen_project["id"], chapter_cache_size)
+            if reopened:
+                load_project(reopened)
+                st.rerun()
+    if st.button("Nuevo Proyecto"):
+        load_project(projects.create_project(chapter_cache_size))
+        st.rerun()
+
+    st.subheader("Caché de Respuestas")
+    st.session_state.bypass_cache = st.checkbox("Regenerar sin usar la caché")
+    cache_summary = novel_engine.llm_cache.summary()
+    st.caption(f"Aciertos: {cache_summary['hits']} · Fallos: {cache_summary['misses']} · "
+               f"Entradas: {cache_summary['entries']} ({cache_summary['bytes'] / 2**20:.1f} MB)")
+
+    if st.session_state.context_reports:
+        st.subheader("Presupuesto de Contexto")
+        context_reports = st.session_state.context_reports
+        st.caption(f"Presupuesto: {novel_engine.context_token_budget} tokens por llamada · "
+                   f"Ahorrados: {sum(r['tokens_saved'] for r in context_reports.values())} tokens en {len(context_reports)} prompts")
+        with st.expander("Detalle por llamada"):
+            for stage, report in context_reports.items():
+                st.caption(f"{stage}: {report['full_tokens']} → {report['tokens']} tokens (−{report['tokens_saved']})")
+
+    # Memory held by this session's chapter texts
+    store_summary = st.session_state.project.chapters.summary()
+    if store_summary["texts"]:
+        st.subheader("Capítulos de la Sesión")
+        st.caption(f"Textos: {store_summary['texts']} · En memoria: {store_summary['resident_bytes'] / 1024:.0f} KB · "
+                   f"En disco: {store_summary['disk_bytes'] / 1024:.0f} KB (comprimido) · "
+                   f"Lecturas de disco: {store_summary['reads']}")
+
+    # LLM call telemetry for this server process (all sessions)
+    performance = telemetry.snapshot()
+    if performance["stages"]:
+        st.subheader("Rendimiento")
+        stages = performance["stages"]
+        slowest = max(stages, key=lambda row: row["wall_seconds_total"])
+        st.caption(f"Llamadas: {sum(row['calls'] for row in stages)} · "
+                   f"Tokens: {sum(row['prompt_tokens'] for row in stages)} entrada "
+                   f"({sum(row['cached_tokens'] for row in stages)} en caché del proveedor) / "
+                   f"{sum(row['completion_tokens'] for row in stages)} salida · "
+                   f"Coste: ${sum(row['cost'] for row in stages):.4f} · "
+                   f"Etapa más lenta: {slowest['stage']}")
+        events = performance["events"]
+        retries = sum(value for name, value in events.items() if name.startswith("llm_retry_attempts_total"))
+        circuit = {"closed": "cerrado", "open": "abierto", "half_open": "semiabierto"}[retry_policy.breaker.state]
+        coalesced = sum(value for name, value in events.items() if name.startswith("llm_coalesced_requests_total"))
+        fallbacks = sum(value for name, value in events.items() if name.startswith("llm_model_fallbacks_total"))
+        st.caption(f"Reintentos: {retries} · Circuito: {circuit} · "
+                   f"Rechazadas por el circuito: {events.get('llm_circuit_rejected_total', 0)} · "
+                   f"Duplicadas evitadas: {coalesced} · Cambios de modelo: {fallbacks}")
+        cancelled = {reason: sum(value for name, value in events.items()
+                                 if name.startswith("llm_cancelled_calls_total") and f'reason="{reason}"' in name)
+                     for reason in ("cancelled", "deadline")}
+        if any(cancelled.values()):
+            st.caption(f"Canceladas: {cancelled['cancelled']} · Fuera de plazo: {cancelled['deadline']} · "
+                       f"Reintentos omitidos por el plazo: "
+                       f"{sum(value for name, value in events.items() if name.startswith('llm_retries_skipped_total'))} · "
+                       f"Tokens ahorrados (estimados): "
+                       f"{sum(value for name, value in events.items() if name.startswith('llm_cancelled_tokens_saved_total'))}")
+        hedges = hedging.summary()
+        if hedges["hedged"]:
+            st.caption(f"Peticiones duplicadas: {hedges['hedged']} de {hedges['calls']} ({hedges['rate']:.1%}) · "
+                       f"Ganó la duplicada: {hedges['hedge_wins']} · "
+                       f"Latencia recortada: {hedges['saved_seconds']:.1f} s")
+        prefetch_summary = st.session_state.prefetcher.summary()
+        if prefetch_summary["calls"]:
+            hit_rate = prefetch_summary["hit_rate"]
+            st.caption(f"Precarga: {prefetch_summary['calls']} llamadas · Aciertos: {prefetch_summary['hits']} de "
+                       f"{prefetch_summary['hits'] + prefetch_summary['misses']} clics"
+                       f"{f' ({hit_rate:.0%})' if hit_rate is not None else ''} · "
+                       f"Desperdiciadas: {prefetch_summary['wasted']} · Fallidas: {prefetch_summary['failed']} · "
+                       f"Listas: {prefetch_summary['held']} · En curso: {prefetch_summary['pending']}")
+        scheduler = request_scheduler.scheduler
+        waits = {priority: performance["histograms"].get(f'llm_scheduler_wait_seconds{{priority="{priority}"}}')
+                 for priority in request_scheduler.PRIORITIES}
+        st.caption(f"En curso: {scheduler.in_flight}/{scheduler.max_in_flight} · En cola: "
+                   f"{scheduler.queue_depth(request_scheduler.INTERACTIVE)} interactivas, "
+                   f"{scheduler.queue_depth(request_scheduler.BULK)} en lote, "
+                   f"{scheduler.queue_depth(request_scheduler.PREFETCH)} de precarga · Espera p95: " +
+                   ", ".join(f"{(waits[priority] or {}).get('p95') or 0:.2f} s {label}"
+                             for priority, label in ((request_scheduler.INTERACTIVE, "interactivas"),
+                                                     (request_scheduler.BULK, "en lote"))))
+        repairs = {outcome: sum(value for name, value in events.items()
+                                if name.startswith("json_repairs_total") and f'outcome="{outcome}"' in name)
+                   for outcome in ("local", "fix_call", "failed")}
+        if any(repairs.values()):
+            st.caption(f"JSON reparados: {repairs['local']} localmente · {repairs['fix_call']} con llamada de corrección · "
+                       f"{repairs['failed']} sin reparar · Llamadas ahorradas: "
+                       f"{sum(value for name, value in events.items() if name.startswith('json_repair_calls_saved_total'))}")
+        beats = events.get("chapter_beats_drafted_total", 0)
+        continuations = events.get("chapter_continuations_total", 0)
+        if beats or continuations:
+            st.caption(f"Escenas redactadas en paralelo: {beats} · Textos incompletos continuados: {continuations}")
+        with st.expander("Detalle por etapa"):
+            st.dataframe([{
+                "Etapa": row["stage"],
+                "Modelo": row["model"],
+                "Llamadas": row["calls"],
+                "p50 (s)": row["wall_p50"],
+                "p95 (s)": row["wall_p95"],
+                "TTFT p50 (s)": row["ttft_p50"],
+                "Tokens entrada": row["prompt_tokens"],
+                "Tokens salida": row["completion_tokens"],
+                "Tokens en caché": row["cached_tokens"],
+                "Reintentos": row["retries"],
+                "Errores": row["errors"],
+                "Caché local": row["cache_hits"],
+                "Compartidas": row["coalesced"],
+                "Coste ($)": row["cost"],
+            } for row in stages], hide_index=True)
+            st.download_button("Descargar métricas (JSON)", json.dumps(performance, indent=2, ensure_ascii=False),
+                               file_name="metricas.json", mime="application/json")
+        if model_router.routes:
+            with st.expander("Rutas de modelos"):
+                st.caption(f"Latencia de los últimos {model_router.window_seconds / 60:.0f} minutos por etapa y modelo")
+                st.dataframe([{
+                    "Etapa": row["stage"],
+                    "Modelo": row["model"],
+                    "Llamadas": row["calls"],
+                    "Errores": row["errors"],
+                    "Cambios a otro modelo": row["fallbacks"],
+                    "p50 (s)": row["p50"],
+                    "p95 (s)": row["p95"],
+                    "Relegado por lentitud": row["demoted"],
+                } for row in model_router.snapshot()], hide_index=True)
+
 # User input for novel theme
-st.session_state.user_theme = st.text_area("Tema o Época de la Novela:", placeholder="Ej: la Revolución Francesa, el Antiguo Egipto, la Conquista de América, etc.")
+st.session_state.user_theme = st.text_area("Tema o Época de la Novela:", placeholder="Ej: la Revolución Francesa, el Antiguo Egipto, la Conquista de América, etc.",
+                                           key="user_theme_input")
 
 # User input for number of chapters
-st.session_state.num_chapters = st.number_input("Número de Capítulos (9-30):", min_value=9, max_value=30, value=25)
+st.session_state.num_chapters = st.number_input("Número de Capítulos (9-30):", min_value=9, max_value=30, key="num_chapters_input")
 
 # Button to generate initial outline
 if st.button("Generar Esquema Inicial"):
@@ -643,15 +640,28 @@ if st.session_state.novel_outline_data:
 
     # Narrative technique and POV selection
     st.subheader("Selecciona la Técnica Narrativa y el Punto de Vista")
-    st.session_state.narrative_technique = st.radio("Técnica Narrativa:", ["first_person", "third_person_omniscient", "third_person_limited"])
+    techniques = ["first_person", "third_person_omniscient", "third_person_limited"]
+    st.session_state.narrative_technique = st.radio("Técnica Narrativa:", techniques,
+                                                    index=option_index(techniques, st.session_state.narrative_technique))
     
     if st.session_state.narrative_technique == "first_person":
-        st.session_state.narrator_pov = st.radio("Punto de Vista del Narrador:", ["protagonist", "witness"])
+        st.session_state.narrator_pov = st.radio("Punto de Vista del Narrador:", ["protagonist", "witness"],
+                                                 index=option_index(["protagonist", "witness"], st.session_state.narrator_pov))
     elif st.session_state.narrative_technique == "third_person_omniscient":
         st.session_state.narrator_pov = st.radio("Punto de Vista del Narrador:", ["omniscient"])
     elif st.session_state.narrative_technique == "third_person_limited":
         st.session_state.narrator_pov = st.radio("Punto de Vista del Narrador:", ["limited"])
 
+    # Artifacts whose inputs changed since they were generated
+    stale = novel_engine.stale_artifacts(st.session_state)
+    if stale:
+        with st.expander(f"⚠️ {len(stale)} elementos obsoletos"):
+            for key, index, changed in stale:
+                chapter_label = f" - Cap. {index + 1}" if index is not None else ""
+                st.caption(f"{ARTIFACT_LABELS[key]}{chapter_label}: cambió {', '.join(ARTIFACT_LABELS[source] for source in changed)}")
+            if st.button("Reconstruir Solo lo Obsoleto"):
+                rebuild_stale_artifacts(bulk_generation.DEFAULT_CONCURRENCY)
+
     # Buttons for generating characters, setting details, and plot twist
     if st.button("Generar Personajes"):
         generate_characters()
@@ -695,71 +705,49 @@ if st.session_state.novel_outline_data:
             st.write("Contenido crudo (no JSON):")
             st.write(st.session_state.chapters_data["raw_content"])
         else:
-            for index, chapter in enumerate(st.session_state.chapters_data):
-                st.write(f"**{chapter['title']}**")
-                st.write(chapter['description'])
-
-                # Buttons for generating chapter-specific details
-                col1, col2, col3 = st.columns(3)
-                with col1:
-                    if st.button(f"Eventos Clave - Cap. {index + 1}"):
-                        generate_chapter_key_events(chapter, index)
-                    if st.button(f"Conflicto - Cap. {index + 1}"):
-                        generate_chapter_conflict(chapter, index)
-                with col2:
-                    if st.button(f"Subtramas - Cap. {index + 1}"):
-                        generate_chapter_sub_plot_ideas(chapter, index)
-                    if st.button(f"Escena - Cap. {index + 1}"):
-                        generate_chapter_scene_description(chapter, index)
-                with col3:
-                    if st.button(f"Diálogo - Cap. {index + 1}"):
-                        generate_chapter_dialogue_snippet(chapter, index)
-                    if st.button(f"Contenido - Cap. {index + 1}"):
-                        generate_chapter_content(chapter, index)
-
-                # Display chapter-specific details
-                if st.session_state.chapter_key_events.get(index):
-                    st.subheader("Eventos Clave Sugeridos")
-                    st.write(st.session_state.chapter_key_events[index])
-
-                if st.session_state.chapter_conflicts.get(index):
-                    st.subheader("Conflicto/Obstáculo Sugerido")
-                    st.write(st.session_state.chapter_conflicts[index])
-
-                if st.session_state.chapter_sub_plot_ideas.get(index):
-                    st.subheader("Ideas para Subtramas")
-                    st.write(st.session_state.chapter_sub_plot_ideas[index])
-
-                if st.session_state.chapter_scene_descriptions.get(index):
-                    st.subheader("Descripción de Escena Sugerida")
-                    st.write(st.session_state.chapter_scene_descriptions[index])
-
-                if st.session_state.chapter_dialogue_snippets.get(index):
-                    st.subheader("Fragmento de Diálogo Sugerido")
-                    st.write(st.session_state.chapter_dialogue_snippets[index])
-
-                if st.session_state.chapter_contents.get(index):
-                    st.subheader("Contenido del Capítulo")
-                    st.write(st.session_state.chapter_contents[index])
-
-    # Export novel data
-    if st.button("Exportar Novela"):
-        novel_data = {
-            "outline": st.session_state.novel_outline_data,
-            "characters": st.session_state.characters_data,
-            "setting": st.session_state.setting_details,
-            "plot_twist": st.session_state.plot_twist_data,
-            "chapters": st.session_state.chapters_data,
-            "chapter_contents": st.session_state.chapter_contents,
-            "chapter_conflicts": st.session_state.chapter_conflicts,
-            "chapter_scene_descriptions": st.session_state.chapter_scene_descriptions,
-            "chapter_dialogue_snippets": st.session_state.chapter_dialogue_snippets,
-            "chapter_sub_plot_ideas": st.session_state.chapter_sub_plot_ideas,
-            "chapter_key_events": st.session_state.chapter_key_events
-        }
+            pending_job = st.session_state.project.pending_job()
+            if pending_job:
+                st.warning("La generación de todos los capítulos quedó interrumpida; lo ya generado se conservó.")
+                if st.button("Reanudar Generación"):
+                    generate_all_chapters(pending_job["include_details"], bulk_generation.DEFAULT_CONCURRENCY, only_missing=True,
+                                          in_order=pending_job.get("in_order", False))
+
+            with st.expander("Generar todos los capítulos"):
+                bulk_include_details = st.checkbox("Incluir eventos clave, conflicto, subtramas, escena y diálogo", value=False)
+                bulk_only_missing = st.checkbox("Solo elementos aún no generados", value=True)
+                bulk_in_order = st.checkbox("Escribir los capítulos en orden, cada uno con la memoria de los anteriores (más lento)",
+                                            value=False)
+                bulk_concurrency = st.number_input("Peticiones simultáneas:", min_value=1, max_value=bulk_generation.MAX_CONCURRENCY,
+                                                   value=bulk_generation.DEFAULT_CONCURRENCY)
+                if st.button("Generar Todos los Capítulos"):
+                    generate_all_chapters(bulk_include_details, int(bulk_concurrency), bulk_only_missing, bulk_in_order)
+
+            # One page of chapters at a time; each chapter is an isolated fragment
+            chapter_count = len(st.session_state.chapters_data)
+            page_count = math.ceil(chapter_count / CHAPTERS_PER_PAGE)
+            page = 0
+            if page_count > 1:
+                page = st.selectbox("Capítulos:", range(page_count),
+                                    format_func=lambda p: f"{p * CHAPTERS_PER_PAGE + 1}–{min((p + 1) * CHAPTERS_PER_PAGE, chapter_count)}")
+            st.checkbox("Precargar en segundo plano los eventos clave y conflictos de los próximos capítulos",
+                        key="prefetch_enabled")
+            for index in range(page * CHAPTERS_PER_PAGE, min((page + 1) * CHAPTERS_PER_PAGE, chapter_count)):
+                render_chapter(index)
+            prefetch_chapters(page * CHAPTERS_PER_PAGE)
+
+    # Export novel data. The file is written chapter by chapter when the download is
+    # clicked (a callable download), not on every rerun.
+    if st.session_state.novel_outline_data:
+        st.subheader("Exportar Novela")
+        export_format = st.selectbox("Formato:", list(manuscript_export.FORMATS),
+                                     format_func=lambda fmt: manuscript_export.FORMATS[fmt][0])
+        export_notes = st.checkbox("Incluir notas de planificación de cada capítulo", value=False)
         st.download_button(
             label="Descargar Novela",
-            data=json.dumps(novel_data, indent=2, ensure_ascii=False),
-            file_name="novel_data.json",
-            mime="application/json"
+            data=partial(manuscript_export.export_bytes, export_state(), export_format, export_notes),
+            file_name=manuscript_export.file_name(st.session_state, export_format),
+            mime=manuscript_export.FORMATS[export_format][2],
         )
+
+# Autosave whatever else changed in this run (e.g. the theme or the narrative technique)
+save_project()
@@ -0,0 +1,223 @@
+"""Headless batch generation of novels, without Streamlit.
+
+Reads a JSONL file with one novel per line, for example:
+
+    {"id": "trafalgar", "theme": "la batalla de Trafalgar", "num_chapters": 12,
+     "narrative_technique": "third_person_limited", "narrator_pov": "limited"}
+
+and runs the full outline-to-chapters pipeline for each one. Every artifact is
+written to OUT/<id>/ as soon as it completes, together with a checkpoint, so an
+interrupted run picks up where it stopped when started again.
+
+    OPENROUTER_API_KEY=... python batch_cli.py novels.jsonl --out novels/ \\
+        --novel-concurrency 4 --api-concurrency 16
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import cancellation
+import context_budget
+import hedging
+import model_router
+import novel_engine
+import request_scheduler
+import response_cache
+import telemetry
+
+log = logging.getLogger("batch_cli")
+
+DEFAULT_POV = {
+    "first_person": "protagonist",
+    "third_person_omniscient": "omniscient",
+    "third_person_limited": "limited",
+}
+# File names for the novel-level artifacts, in pipeline order
+NOVEL_ARTIFACT_FILES = {
+    "novel_outline_data": "01_outline.json",
+    "characters_data": "02_characters.json",
+    "setting_details": "03_setting.md",
+    "plot_twist_data": "04_plot_twist.md",
+    "chapters_data": "05_table_of_contents.json",
+}
+CHAPTER_STATE_KEYS = [state_key for state_key, *_ in novel_engine.CHAPTER_ARTIFACTS.values()]
+
+
+def read_specs(path):
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            spec = json.loads(line)
+            spec.setdefault("id", f"novel-{line_no:04d}")
+            yield spec
+
+
+# Write a file atomically so a crash never leaves a half-written artifact or checkpoint
+def write_atomic(path, text):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def write_artifact(path, value):
+    if isinstance(value, str):
+        write_atomic(path, value)
+    else:
+        write_atomic(path, json.dumps(value, indent=2, ensure_ascii=False))
+
+
+def save_checkpoint(novel_dir, state):
+    write_atomic(os.path.join(novel_dir, "checkpoint.json"), json.dumps(state, ensure_ascii=False))
+
+
+# Load a checkpoint, restoring the integer chapter indices JSON turned into strings
+def load_checkpoint(novel_dir):
+    path = os.path.join(novel_dir, "checkpoint.json")
+    if not os.path.exists(path):
+        return None
+    # Keys added to the engine since the checkpoint was written start from their defaults
+    with open(path, encoding="utf-8") as f:
+        state = {**novel_engine.new_state(), **json.load(f)}
+    for state_key in CHAPTER_STATE_KEYS:
+        state[state_key] = {int(index): value for index, value in state[state_key].items()}
+    return state
+
+
+def new_novel_state(spec):
+    technique = spec.get("narrative_technique", "third_person_limited")
+    return novel_engine.new_state(
+        theme=spec.get("theme", ""),
+        num_chapters=int(spec.get("num_chapters", 25)),
+        narrative_technique=technique,
+        narrator_pov=spec.get("narrator_pov", DEFAULT_POV.get(technique)),
+    )
+
+
+# Run the whole pipeline for one novel, skipping whatever the checkpoint already holds.
+# Returns the number of chapter jobs that failed; raises GenerationError if a novel-level step fails.
+def run_novel(spec, args):
+    novel_dir = os.path.join(args.out, spec["id"])
+    os.makedirs(os.path.join(novel_dir, "chapters"), exist_ok=True)
+    state = load_checkpoint(novel_dir) or new_novel_state(spec)
+    use_cache = not args.no_cache
+
+    for key, step in novel_engine.ARTIFACT_GENERATORS.items():
+        if state[key] and not novel_engine.is_raw(state[key]):
+            continue
+        log.info("%s: %s", spec["id"], key)
+        try:
+            with cancellation.deadline_scope():
+                step(state, use_cache=use_cache)
+        finally:
+            save_checkpoint(novel_dir, state)
+        write_artifact(os.path.join(novel_dir, NOVEL_ARTIFACT_FILES[key]), state[key])
+
+    include_details = spec.get("include_details", args.include_details)
+    phases = novel_engine.chapter_phases(state, include_details, only_missing=True,
+                                         in_order=spec.get("in_order", args.in_order))
+    failures = 0
+    for artifact, index, err in novel_engine.iter_chapter_jobs(state, phases, args.api_concurrency, use_cache=use_cache):
+        if err:
+            failures += 1
+            log.warning("%s: capítulo %d (%s) falló: %s", spec["id"], index + 1, artifact, err)
+            continue
+        state_key = novel_engine.CHAPTER_ARTIFACTS[artifact][0]
+        write_artifact(os.path.join(novel_dir, "chapters", f"{index + 1:02d}_{artifact}.md"), state[state_key][index])
+        save_checkpoint(novel_dir, state)
+    return failures
+
+
+# Run a novel as its own scheduler session, so concurrent novels share the API in turns
+def run_novel_scheduled(spec, args):
+    with request_scheduler.context(spec["id"], request_scheduler.BULK):
+        return run_novel(spec, args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Genera novelas en lote sin Streamlit.")
+    parser.add_argument("specs", help="JSONL file: one novel per line (id, theme, num_chapters, narrative_technique, narrator_pov, include_details, in_order)")
+    parser.add_argument("--out", default="novels", help="output directory (one subdirectory per novel)")
+    parser.add_argument("--novel-concurrency", type=int, default=2, help="novels generated at the same time")
+    parser.add_argument("--api-concurrency", type=int, default=8, help="maximum in-flight API calls across all novels")
+    parser.add_argument("--requests-per-minute", type=float, default=0, help="provider rate limit for API calls (0 = no limit)")
+    parser.add_argument("--novels-per-hour", type=float, default=0, help="throttle novel starts to this rate (0 = no limit)")
+    parser.add_argument("--include-details", action="store_true", help="also generate key events, conflict, sub-plots, scene and dialogue per chapter")
+    parser.add_argument("--model-routes", help='JSON file mapping stages to models in order of preference, e.g. {"chapter_dialogue": ["small-model", "fallback-model"]}')
+    parser.add_argument("--route-max-p95", type=float, default=0, help="fall back from a model whose rolling p95 latency exceeds this many seconds (0 = off)")
+    parser.add_argument("--hedge-budget", type=float, default=0, help="fraction of calls that may get a duplicate when slower than their stage's p90 (0 = off)")
+    parser.add_argument("--deadline", type=float, default=cancellation.DEFAULT_DEADLINE, help="seconds a generation step (a novel-level step or one chapter job) may take before it is cancelled (0 = no limit)")
+    parser.add_argument("--chapter-words", type=int, default=novel_engine.DEFAULT_CHAPTER_WORDS, help="length of each chapter's content in words")
+    parser.add_argument("--long-form", choices=["auto", "on", "off"], default="auto", help=f"draft chapters as scene beats in parallel, stitched and continued where they stop short (auto = chapters longer than {novel_engine.LONG_FORM_MIN_WORDS} words)")
+    parser.add_argument("--in-order", action="store_true", help="write chapter contents one after another, each with the continuity memory of the earlier ones")
+    parser.add_argument("--cache", default=response_cache.DEFAULT_PATH, help="response cache path")
+    parser.add_argument("--no-cache", action="store_true", help="do not read cached responses")
+    parser.add_argument("--metrics-port", type=int, help="serve Prometheus metrics on this port while running")
+    parser.add_argument("--metrics-json", help="write per-stage call telemetry to this file at the end")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    novel_engine.configure(
+        api_key=os.environ["OPENROUTER_API_KEY"],
+        model=os.environ.get("OPENROUTER_MODEL"),
+        url=os.environ.get("OPENROUTER_API_URL"),
+        structured={"true": True, "false": False}.get(os.environ.get("OPENROUTER_STRUCTURED_OUTPUT", "auto").lower(), "auto"),
+        token_budget=int(os.environ.get("CONTEXT_TOKEN_BUDGET", context_budget.DEFAULT_BUDGET)),
+        continuity_budget=int(os.environ.get("CONTINUITY_TOKEN_BUDGET", context_budget.DEFAULT_CONTINUITY_BUDGET)),
+        cache=response_cache.get_cache(args.cache),
+        max_concurrent_requests=args.api_concurrency,
+        words=args.chapter_words,
+        long_form={"auto": "auto", "on": True, "off": False}[args.long_form],
+    )
+
+    request_scheduler.configure(requests_per_minute=args.requests_per_minute)
+    if args.model_routes:
+        with open(args.model_routes, encoding="utf-8") as f:
+            model_router.configure(stage_routes=json.load(f))
+    model_router.configure(p95_threshold=args.route_max_p95)
+    hedging.configure(fraction=args.hedge_budget)
+    cancellation.configure(deadline=args.deadline)
+
+    if args.metrics_port:
+        telemetry.serve(args.metrics_port)
+
+    specs = list(read_specs(args.specs))
+    start_interval = 3600 / args.novels_per_hour if args.novels_per_hour > 0 else 0
+    results = {"completed": 0, "failed": 0}
+    started = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=args.novel_concurrency, thread_name_prefix="novel") as executor:
+        futures = {}
+        for position, spec in enumerate(specs):
+            # Throughput throttle: novel n may not start before n * interval
+            delay = started + position * start_interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            futures[executor.submit(run_novel_scheduled, spec, args)] = spec["id"]
+        for future in as_completed(futures):
+            novel_id = futures[future]
+            try:
+                failures = future.result()
+            except (novel_engine.GenerationError, cancellation.Cancelled) as err:
+                log.error("%s: %s", novel_id, err)
+                failures = None
+            except Exception:
+                log.exception("%s: error inesperado", novel_id)
+                failures = None
+            results["completed" if failures == 0 else "failed"] += 1
+            log.info("%s: %s", novel_id, "completada" if failures == 0 else "incompleta (se reanudará en la próxima ejecución)")
+
+    elapsed = time.monotonic() - started
+    log.info("%d completadas, %d incompletas en %.1f s (%.2f novelas/hora)",
+             results["completed"], results["failed"], elapsed, results["completed"] / elapsed * 3600 if elapsed else 0)
+    if args.metrics_json:
+        write_atomic(args.metrics_json, json.dumps(telemetry.snapshot(), indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
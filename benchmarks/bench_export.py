@@ -0,0 +1,63 @@
+"""Benchmark of manuscript export time and peak memory against novel length.
+
+Builds a novel of N fully generated chapters in a chapter store (as the app
+keeps it) and exports it in every format, reporting wall time, output size
+and the peak Python memory the export itself allocated:
+
+    python benchmarks/bench_export.py --chapters 10 30 60
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import manuscript_export  # noqa: E402
+import novel_engine  # noqa: E402
+import project_store  # noqa: E402
+
+PARAGRAPH = "La columna avanzó entre los olivares mientras el polvo cubría los uniformes. " * 12
+
+
+def build_state(chapters):
+    store = project_store.ProjectStore(os.path.join(tempfile.mkdtemp(), "projects.sqlite3")).create_project().chapters
+    state = novel_engine.new_state(theme="La batalla de Bailén", num_chapters=chapters)
+    state["novel_outline_data"] = {"synthesis": PARAGRAPH, "description": PARAGRAPH, "plot": PARAGRAPH}
+    state["characters_data"] = [{"name": f"Personaje {i}", "role": "secundario", "description": PARAGRAPH} for i in range(6)]
+    state["setting_details"] = PARAGRAPH
+    state["plot_twist_data"] = PARAGRAPH
+    state["chapters_data"] = [{"title": f"Capítulo {i + 1}", "description": PARAGRAPH} for i in range(chapters)]
+    for state_key, *_ in novel_engine.CHAPTER_ARTIFACTS.values():
+        state[state_key] = store.texts(state_key)
+        paragraphs = 40 if state_key == "chapter_contents" else 4
+        for index in range(chapters):
+            state[state_key][index] = f"{index}\n\n".join([PARAGRAPH] * paragraphs)
+    return state
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chapters", type=int, nargs="+", default=[10, 30, 60])
+    parser.add_argument("--notes", action="store_true", help="include the per-chapter planning notes")
+    args = parser.parse_args()
+
+    print(f"{'formato':<10} {'capítulos':>10} {'tiempo':>10} {'tamaño':>10} {'memoria pico':>14}")
+    for chapters in args.chapters:
+        state = build_state(chapters)
+        for fmt in manuscript_export.FORMATS:
+            tracemalloc.start()
+            started = time.perf_counter()
+            out = manuscript_export.export(state, fmt, args.notes)
+            elapsed = time.perf_counter() - started
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            size = out.seek(0, os.SEEK_END)
+            out.close()
+            print(f"{fmt:<10} {chapters:>10} {elapsed * 1000:>7.0f} ms {size / 1024:>6.0f} KiB {peak / 1024:>10.0f} KiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Micro-benchmark: bare requests.post vs. the pooled keep-alive client.
+
+Starts a local stub chat-completions server and times N sequential calls with
+each strategy. Pass --certfile/--keyfile to serve over TLS and include the TLS
+handshake in the comparison (the certificate must be valid for "localhost"):
+
+    openssl req -x509 -newkey rsa:2048 -nodes -days 1 -keyout key.pem \
+        -out cert.pem -subj /CN=localhost -addext subjectAltName=DNS:localhost
+
+    python benchmarks/bench_http_client.py --calls 200
+"""
+import argparse
+import json
+import os
+import ssl
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import http_client  # noqa: E402
+
+RESPONSE_BODY = json.dumps({
+    "choices": [{"message": {"role": "assistant", "content": "Hola."}}]
+}).encode("utf-8")
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(RESPONSE_BODY)))
+        self.end_headers()
+        self.wfile.write(RESPONSE_BODY)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(certfile=None, keyfile=None):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    scheme = "http"
+    if certfile:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        scheme = "https"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"{scheme}://localhost:{server.server_address[1]}/api/v1/chat/completions"
+
+
+def time_calls(call, calls):
+    timings = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        call()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--certfile")
+    parser.add_argument("--keyfile")
+    args = parser.parse_args()
+
+    server, url = start_server(args.certfile, args.keyfile)
+    verify = args.certfile or True
+    payload = {"model": "stub", "messages": [{"role": "user", "content": "Hola"}]}
+    headers = {"Content-Type": "application/json"}
+
+    session = http_client.get_session()
+    session.trust_env = False  # REQUESTS_CA_BUNDLE would otherwise override verify
+    session.verify = verify
+
+    bare = time_calls(lambda: requests.post(url, headers=headers, data=json.dumps(payload), verify=verify).json(), args.calls)
+    pooled = time_calls(lambda: http_client.post_json(url, headers, payload).json(), args.calls)
+    server.shutdown()
+
+    for name, timings in (("bare requests.post", bare), ("pooled session", pooled)):
+        print(f"{name:20s} mean={statistics.mean(timings):7.3f} ms  median={statistics.median(timings):7.3f} ms")
+    saved = statistics.mean(bare) - statistics.mean(pooled)
+    print(f"handshake savings per call: {saved:.3f} ms ({saved / statistics.mean(bare) * 100:.1f}%)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""End-to-end benchmark of the generation engine against the local mock server.
+
+Times every generate_* function on its own (p50/p95/p99 over --iterations calls)
+and then the full outline-to-chapters pipeline for --novels novels, reporting
+wall time, API calls, bytes transferred and peak Python memory per novel.
+Results are saved as JSON under benchmarks/results/ keyed by git commit, so a
+run can be compared with an earlier one:
+
+    python benchmarks/bench_pipeline.py --novels 3 --chapters 12 --include-details
+    python benchmarks/bench_pipeline.py --compare benchmarks/results/<older>.json
+
+By default an in-process mock is started (see mock_openrouter.py for the fault
+and latency options); --url points the run at an already running one instead.
+"""
+import argparse
+import copy
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from functools import partial
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import novel_engine  # noqa: E402
+import telemetry  # noqa: E402
+from mock_openrouter import MockConfig, start_mock_server  # noqa: E402
+
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+NOVEL_STEPS = list(novel_engine.ARTIFACT_GENERATORS.items())
+
+
+def percentiles(samples):
+    if not samples:
+        return {"n": 0}
+    ordered = sorted(samples)
+    if len(ordered) == 1:
+        cuts = ordered * 99
+    else:
+        cuts = statistics.quantiles(ordered, n=100, method="inclusive")
+    return {"n": len(ordered), "mean": statistics.fmean(ordered),
+            "p50": cuts[49], "p95": cuts[94], "p99": cuts[98], "max": ordered[-1]}
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT,
+                                    capture_output=True, text=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return commit + ("-dirty" if dirty else "")
+
+
+def mock_stats(url):
+    return requests.get(url.split("/api/")[0] + "/stats", timeout=10).json()
+
+
+def stats_delta(before, after):
+    return {key: after[key] - before.get(key, 0) for key in after}
+
+
+def new_novel_state(args, number):
+    return novel_engine.new_state(theme=f"la batalla de Bailén ({number})", num_chapters=args.chapters,
+                                  narrative_technique="third_person_limited", narrator_pov="limited")
+
+
+# Run a novel-level step, retrying when the mock answered with malformed JSON
+def run_step(step, state, attempts=3):
+    for attempt in range(attempts):
+        try:
+            step(state)
+            return attempt
+        except novel_engine.GenerationError:
+            if attempt == attempts - 1:
+                raise
+
+
+# Full pipeline for one novel, as batch_cli.py runs it. Returns (failed chapter jobs, step retries).
+def run_pipeline(state, args):
+    retries = sum(run_step(step, state) for _, step in NOVEL_STEPS)
+    phases = novel_engine.chapter_phases(state, args.include_details, only_missing=True)
+    failures = sum(1 for *_, err in novel_engine.iter_chapter_jobs(state, phases, args.api_concurrency) if err)
+    return failures, retries
+
+
+# Chapter artifacts cycle through the chapters so each call has a different prompt
+def generate_chapter(artifact, state, iteration):
+    novel_engine.generate_chapter_artifact(state, artifact, iteration % len(state["chapters_data"]))
+
+
+# Time each generate_* function on copies of a fully generated novel
+def bench_functions(args, base_state):
+    functions = {key: step for key, step in NOVEL_STEPS}
+    functions.update({f"chapter_{artifact}": partial(generate_chapter, artifact) for artifact in novel_engine.CHAPTER_ARTIFACTS})
+    results = {}
+    for name, function in functions.items():
+        samples, failures = [], 0
+        for iteration in range(args.iterations):
+            state = copy.deepcopy(base_state)
+            started = time.perf_counter()
+            try:
+                function(state) if name in novel_engine.ARTIFACT_GENERATORS else function(state, iteration)
+            except Exception:
+                failures += 1
+                continue
+            samples.append(time.perf_counter() - started)
+        results[name] = {**percentiles(samples), "failures": failures}
+        print(f"  {name:<22} p50 {results[name].get('p50', 0) * 1000:8.1f} ms  "
+              f"p95 {results[name].get('p95', 0) * 1000:8.1f} ms  p99 {results[name].get('p99', 0) * 1000:8.1f} ms  "
+              f"fallos {failures}")
+    return results
+
+
+def bench_pipeline(args, url):
+    durations, novel_failures, chapter_failures, step_retries = [], 0, 0, 0
+    before = mock_stats(url)
+    telemetry.reset()
+    tracemalloc.start()
+    for number in range(args.novels):
+        state = new_novel_state(args, number)
+        started = time.perf_counter()
+        try:
+            failures, retries = run_pipeline(state, args)
+        except Exception as err:
+            novel_failures += 1
+            print(f"  novela {number + 1}: falló ({err})"[:200])
+            continue
+        durations.append(time.perf_counter() - started)
+        chapter_failures += failures
+        step_retries += retries
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    traffic = stats_delta(before, mock_stats(url))
+    novels = max(args.novels, 1)
+    return {
+        "novel_seconds": percentiles(durations),
+        "novels_failed": novel_failures,
+        "chapter_jobs_failed": chapter_failures,
+        "step_retries": step_retries,
+        "calls_per_novel": traffic["requests"] / novels,
+        "bytes_sent_per_novel": traffic["bytes_in"] / novels,
+        "bytes_received_per_novel": traffic["bytes_out"] / novels,
+        "prompt_tokens_per_novel": traffic["prompt_tokens"] / novels,
+        "cached_prompt_share": traffic["cached_tokens"] / traffic["prompt_tokens"] if traffic["prompt_tokens"] else 0.0,
+        "peak_memory_bytes": peak,
+        "mock": traffic,
+        "stages": {row["stage"]: row for row in telemetry.snapshot()["stages"]},
+    }
+
+
+def flatten(value, prefix=""):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from flatten(item, f"{prefix}.{key}" if prefix else key)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield prefix, value
+
+
+def compare(old_path, new):
+    with open(old_path, encoding="utf-8") as f:
+        old = json.load(f)
+    old_values = dict(flatten({"functions": old["functions"], "pipeline": old["pipeline"]}))
+    print(f"\nComparación {old['commit']} -> {new['commit']}")
+    for key, value in flatten({"functions": new["functions"], "pipeline": new["pipeline"]}):
+        previous = old_values.get(key)
+        if previous is None or key.endswith(".n"):
+            continue
+        change = f"{(value - previous) / previous * 100:+7.1f}%" if previous else "    n/a"
+        print(f"  {key:<50} {previous:>14.4f} {value:>14.4f} {change}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="chat-completions URL of a running mock (default: start one in-process)")
+    parser.add_argument("--novels", type=int, default=3)
+    parser.add_argument("--chapters", type=int, default=12)
+    parser.add_argument("--include-details", action="store_true")
+    parser.add_argument("--iterations", type=int, default=20, help="calls per generate_* function")
+    parser.add_argument("--api-concurrency", type=int, default=8)
+    parser.add_argument("--latency", default="lognormal:0.05,0.5")
+    parser.add_argument("--tokens-per-second", type=float, default=0)
+    parser.add_argument("--prefill-tokens-per-second", type=float, default=0)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--rate-5xx", type=float, default=0.0)
+    parser.add_argument("--rate-malformed", type=float, default=0.0)
+    parser.add_argument("--max-completion-words", type=int, default=0, help="mock cuts prose answers off after this many words")
+    parser.add_argument("--chapter-words", type=int, default=1200)
+    parser.add_argument("--long-form", choices=["auto", "on", "off"], default="auto")
+    parser.add_argument("--seed", type=int, default=1808)
+    parser.add_argument("--label", default="", help="free-form note stored with the results")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument("--no-save", action="store_true")
+    args = parser.parse_args()
+
+    url = args.url
+    if not url:
+        _, url = start_mock_server(MockConfig(args.latency, args.tokens_per_second, args.rate_429, args.rate_5xx,
+                                              args.rate_malformed, seed=args.seed,
+                                              prefill_tokens_per_second=args.prefill_tokens_per_second,
+                                              max_completion_words=args.max_completion_words))
+    novel_engine.configure(api_key="benchmark", url=url, max_concurrent_requests=args.api_concurrency,
+                           words=args.chapter_words, long_form={"auto": "auto", "on": True, "off": False}[args.long_form])
+
+    print("Preparando novela base...")
+    base_state = new_novel_state(args, 0)
+    run_pipeline(base_state, argparse.Namespace(**{**vars(args), "include_details": True}))
+
+    print(f"Funciones ({args.iterations} llamadas cada una):")
+    functions = bench_functions(args, base_state)
+    print(f"Pipeline completo ({args.novels} novelas, {args.chapters} capítulos, detalles={args.include_details}):")
+    pipeline = bench_pipeline(args, url)
+    seconds = pipeline["novel_seconds"]
+    print(f"  novela p50 {seconds.get('p50', 0):.2f} s  p95 {seconds.get('p95', 0):.2f} s  "
+          f"llamadas/novela {pipeline['calls_per_novel']:.1f}  "
+          f"KiB enviados/recibidos {pipeline['bytes_sent_per_novel'] / 1024:.0f}/{pipeline['bytes_received_per_novel'] / 1024:.0f}  "
+          f"memoria pico {pipeline['peak_memory_bytes'] / 2**20:.1f} MiB")
+    print(f"  tokens de entrada/novela {pipeline['prompt_tokens_per_novel']:.0f}  "
+          f"en caché del proveedor {pipeline['cached_prompt_share'] * 100:.0f}%")
+
+    results = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "label": args.label,
+        "config": {key: value for key, value in vars(args).items() if key not in ("compare", "no_save")},
+        "functions": functions,
+        "pipeline": pipeline,
+    }
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{results['commit']}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Resultados guardados en {os.path.relpath(path, ROOT)}")
+    if args.compare:
+        compare(args.compare, results)
+
+
+if __name__ == "__main__":
+    main()
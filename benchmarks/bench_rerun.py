@@ -0,0 +1,108 @@
+"""Benchmark of Streamlit rerun cost against the number of generated chapters.
+
+Seeds a session with a novel of N fully generated chapters (details and content)
+and times full script reruns of app.py with Streamlit's AppTest, reporting the
+median rerun time, the number of elements drawn and the bytes of text sent:
+
+    python benchmarks/bench_rerun.py --chapters 0 5 10 20 40
+    python benchmarks/bench_rerun.py --rev HEAD~1      # the app as of another commit
+
+No API calls are made. AppTest always reruns the whole script, so this measures
+the page a full rerun draws; a chapter button runs only that chapter's fragment,
+whose cost is one chapter block whatever N is.
+"""
+import argparse
+import logging
+import os
+import statistics
+import subprocess
+import tempfile
+import time
+
+from streamlit.testing.v1 import AppTest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PARAGRAPH = "La columna avanzó entre los olivares mientras el polvo cubría los uniformes. " * 40
+DETAIL_KEYS = ("chapter_key_events", "chapter_conflicts", "chapter_sub_plot_ideas",
+               "chapter_scene_descriptions", "chapter_dialogue_snippets")
+
+
+# Check out `rev` into a temporary directory and return the path of its app.py
+def app_at_revision(rev):
+    target = tempfile.mkdtemp(prefix="novel-ai-")
+    archive = subprocess.run(["git", "archive", rev], cwd=ROOT, capture_output=True, check=True).stdout
+    subprocess.run(["tar", "-x", "-C", target], input=archive, check=True)
+    return os.path.join(target, "app.py")
+
+
+def seed_session(at, chapters, open_chapters):
+    state = at.session_state
+    state["novel_outline_data"] = {"synthesis": PARAGRAPH, "description": PARAGRAPH, "plot": PARAGRAPH}
+    state["characters_data"] = [{"name": f"Personaje {i}", "role": "secundario", "description": PARAGRAPH}
+                                for i in range(6)]
+    state["setting_details"] = PARAGRAPH
+    state["plot_twist_data"] = PARAGRAPH
+    state["num_chapters"] = max(chapters, 1)
+    state["chapters_data"] = [{"title": f"Capítulo {i + 1}", "description": PARAGRAPH[:300]} for i in range(chapters)]
+    for key in DETAIL_KEYS:
+        state[key] = {i: PARAGRAPH for i in range(chapters)}
+    state["chapter_contents"] = {i: PARAGRAPH * 10 for i in range(chapters)}
+    for i in range(chapters):
+        state[f"chapter_open_{i}"] = open_chapters
+
+
+# Number of elements and bytes of text in the rendered tree
+def measure_tree(node):
+    children = getattr(node, "children", None)
+    if children is None:
+        value = getattr(node, "value", None)
+        return 1, len(value.encode("utf-8")) if isinstance(value, str) else 0
+    elements, size = 0, 0
+    for child in children.values():
+        child_elements, child_size = measure_tree(child)
+        elements += child_elements
+        size += child_size
+    return elements, size
+
+
+def bench(app_path, chapters, runs, open_chapters):
+    at = AppTest.from_file(app_path, default_timeout=120)
+    at.secrets["OPENROUTER_API_KEY"] = "benchmark"
+    scratch = tempfile.mkdtemp()
+    at.secrets["RESPONSE_CACHE_PATH"] = os.path.join(scratch, "cache.sqlite3")
+    at.secrets["PROJECT_STORE_PATH"] = os.path.join(scratch, "projects.sqlite3")
+    at.run()
+    seed_session(at, chapters, open_chapters)
+    at.run()
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        at.run()
+        samples.append(time.perf_counter() - started)
+    if at.exception:
+        raise RuntimeError(at.exception[0].value)
+    elements, size = measure_tree(at.main)
+    return {"chapters": chapters, "rerun_ms_p50": statistics.median(samples) * 1000, "elements": elements,
+            "text_bytes": size}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chapters", type=int, nargs="+", default=[0, 5, 10, 20, 40])
+    parser.add_argument("--runs", type=int, default=5, help="timed reruns per size")
+    parser.add_argument("--closed", action="store_true", help="leave every chapter collapsed")
+    parser.add_argument("--rev", help="benchmark app.py as of this git revision instead of the working tree")
+    args = parser.parse_args()
+    # Bare-mode runs warn about the missing script context on every call
+    logging.disable(logging.WARNING)
+
+    app_path = app_at_revision(args.rev) if args.rev else os.path.join(ROOT, "app.py")
+    print(f"{'capítulos':>10} {'rerun p50':>12} {'elementos':>10} {'KiB texto':>10}")
+    for chapters in args.chapters:
+        result = bench(app_path, chapters, args.runs, not args.closed)
+        print(f"{result['chapters']:>10} {result['rerun_ms_p50']:>9.1f} ms {result['elements']:>10} "
+              f"{result['text_bytes'] / 1024:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
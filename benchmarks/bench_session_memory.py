@@ -0,0 +1,90 @@
+"""Benchmark of the memory a session keeps for its generated chapters.
+
+Builds --sessions sessions, each with a novel of --chapters chapters whose six
+per-chapter texts (key events, conflict, sub-plots, scene, dialogue, content)
+are fully generated, once with plain dicts in the session state (as before
+chapter_store) and once with chapter stores in a shared project database, then
+reads one chapter per session as the app does when it is expanded. Reports the Python
+heap (tracemalloc) and the process resident set size per session:
+
+    python benchmarks/bench_session_memory.py --sessions 20 --chapters 30
+"""
+import argparse
+import gc
+import os
+import sys
+import tempfile
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import chapter_store  # noqa: E402
+import novel_engine  # noqa: E402
+import project_store  # noqa: E402
+
+STATE_KEYS = [state_key for state_key, *_ in novel_engine.CHAPTER_ARTIFACTS.values()]
+DETAIL_WORDS = 250
+CONTENT_WORDS = 3000
+
+
+# Distinct text of roughly `words` words (distinct so nothing is shared between sessions)
+def text(words, seed):
+    return " ".join(f"palabra{(seed * 7919 + i) % 100003}" for i in range(words))
+
+
+def resident_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def fill(session, chapters, seed):
+    for number, state_key in enumerate(STATE_KEYS):
+        words = CONTENT_WORDS if state_key == "chapter_contents" else DETAIL_WORDS
+        for index in range(chapters):
+            session[state_key][index] = text(words, seed * 1000 + number * 100 + index)
+    # Expanding one chapter reads its texts back
+    return [session[state_key].get(0) for state_key in STATE_KEYS]
+
+
+def measure(args, with_store):
+    gc.collect()
+    tracemalloc.start()
+    rss_before = resident_bytes()
+    directory = tempfile.mkdtemp()
+    projects = project_store.ProjectStore(os.path.join(directory, "projects.sqlite3")) if with_store else None
+    sessions = []
+    for number in range(args.sessions):
+        if with_store:
+            store = projects.create_project(args.cache_size).chapters
+            session = {state_key: store.texts(state_key) for state_key in STATE_KEYS}
+        else:
+            session = {state_key: {} for state_key in STATE_KEYS}
+        fill(session, args.chapters, number)
+        sessions.append(session)
+    gc.collect()
+    heap = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    rss = resident_bytes() - rss_before
+    disk = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+    return {"heap": heap / args.sessions, "rss": rss / args.sessions, "disk": disk / args.sessions}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--chapters", type=int, default=30)
+    parser.add_argument("--cache-size", type=int, default=chapter_store.DEFAULT_CACHE_SIZE)
+    args = parser.parse_args()
+
+    print(f"{args.sessions} sesiones, {args.chapters} capítulos cada una (por sesión):")
+    for label, with_store in (("session_state", False), ("chapter_store", True)):
+        result = measure(args, with_store)
+        print(f"  {label:<14} heap {result['heap'] / 1024:8.0f} KiB  RSS {result['rss'] / 1024:8.0f} KiB  "
+              f"disco {result['disk'] / 1024:8.0f} KiB")
+
+
+if __name__ == "__main__":
+    main()
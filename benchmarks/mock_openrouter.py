@@ -0,0 +1,311 @@
+"""Local stand-in for OpenRouter's chat-completions endpoint.
+
+Answers outline, characters, table-of-contents and free-text prompts in the
+shapes novel_engine expects, streamed (SSE) or not, with configurable latency,
+token rate and fault injection. A system message seen before is reported as
+cached prompt tokens (usage.prompt_tokens_details.cached_tokens), as providers with
+prompt caching do, and only uncached prompt tokens pay the prefill rate. Models can be
+given their own latency (--model-latency) or made to always fail with a 503
+(--failing-model), to exercise per-stage model routing. GET /stats returns request counters; GET /api/v1/models
+lists the default model, with structured-output support if --structured-outputs is set.
+
+    python benchmarks/mock_openrouter.py --port 8765 --latency lognormal:0.4,0.5 \\
+        --tokens-per-second 80 --rate-429 0.02 --rate-5xx 0.01 --rate-malformed 0.05
+
+then point the app or batch_cli.py at it with
+OPENROUTER_API_URL=http://127.0.0.1:8765/api/v1/chat/completions.
+"""
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = ("el la de que y en un una los las por con para su sus se al lo como más pero "
+         "capitán sargento río puente ciudad noche espada carta mensaje guerrilla francés "
+         "español camino sierra batalla secreto traición pueblo caballo fuego silencio").split()
+
+
+# Parse a latency spec: "fixed:0.2", "uniform:0.1,0.5" or "lognormal:mu_seconds,sigma"
+def parse_latency(spec):
+    kind, _, params = spec.partition(":")
+    values = [float(v) for v in params.split(",") if v]
+    if kind == "fixed":
+        return lambda rng: values[0]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "lognormal":
+        median, sigma = values
+        return lambda rng: rng.lognormvariate(0, sigma) * median
+    raise ValueError(f"unknown latency distribution: {spec}")
+
+
+class MockConfig:
+    def __init__(self, latency="fixed:0", tokens_per_second=0, rate_429=0.0, rate_5xx=0.0,
+                 rate_malformed=0.0, retry_after=1, seed=None, structured_outputs=False,
+                 prefill_tokens_per_second=0, model_latency=None, failing_models=(), max_completion_words=0):
+        self.latency = parse_latency(latency)
+        self.model_latency = {model: parse_latency(spec) for model, spec in (model_latency or {}).items()}
+        self.failing_models = set(failing_models)
+        # Answers are cut off after this many words, like a small model hitting max_tokens (0 = never)
+        self.max_completion_words = max_completion_words
+        self.tokens_per_second = tokens_per_second
+        self.prefill_tokens_per_second = prefill_tokens_per_second
+        # System prefixes already seen (the simulated prompt cache)
+        self.prefixes = set()
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.rate_malformed = rate_malformed
+        self.retry_after = retry_after
+        self.structured_outputs = structured_outputs
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.stats = {"requests": 0, "streamed": 0, "errors_429": 0, "errors_5xx": 0,
+                      "malformed": 0, "bytes_in": 0, "bytes_out": 0, "prompt_tokens": 0, "cached_tokens": 0, "truncated": 0}
+
+    def roll(self):
+        with self.rng_lock:
+            return self.rng.random()
+
+    def count(self, **deltas):
+        with self.stats_lock:
+            for key, delta in deltas.items():
+                self.stats[key] += delta
+
+
+def prose(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+# Build the completion text for a prompt, in the shape the engine expects.
+# With a JSON-schema response_format arrays come wrapped as {"items": [...]}, as the engine asks.
+def answer(prompt, rng, malformed, structured=False):
+    if "Corrige el siguiente JSON" in prompt:
+        # A fix-up call: answer JSON of the kind the schema describes
+        count = re.search(r"al menos (\d+) elementos", prompt)
+        if '"title"' in prompt:
+            prompt = f"'title' y 'description' novela de {count.group(1) if count else 12} capítulos"
+        elif '"role"' in prompt:
+            prompt = "'name', 'role' y 'description'"
+        else:
+            prompt = "'synthesis', 'description' y 'plot'"
+    if "'synthesis', 'description' y 'plot'" in prompt:
+        value = {"synthesis": prose(rng, 40), "description": prose(rng, 60), "plot": prose(rng, 120)}
+    elif "'name', 'role' y 'description'" in prompt:
+        roles = ["protagonista", "antagonista", "aliado", "interés amoroso"]
+        value = [{"name": f"Personaje {i + 1}", "role": roles[i % len(roles)], "description": prose(rng, 30)}
+                 for i in range(4)]
+    elif "'title' y 'description'" in prompt:
+        match = re.search(r"novela de (\d+) capítulos", prompt)
+        count = int(match.group(1)) if match else 12
+        value = [{"title": f"Capítulo {i + 1}: {prose(rng, 3)}", "description": prose(rng, 40)} for i in range(count)]
+    elif "escenas consecutivas" in prompt:
+        # A long-form chapter's scene plan: one numbered scene per line
+        match = re.search(r"en (\d+) escenas", prompt)
+        return "\n".join(f"{i + 1}. {prose(rng, 20)}" for i in range(int(match.group(1)) if match else 4))
+    else:
+        match = re.search(r"(?:aproximadamente|Aproximadamente|unas) (\d+)(?:-(\d+))? palabras", prompt)
+        words = int(match.group(2) or match.group(1)) if match else 150
+        return prose(rng, words)
+    if structured and isinstance(value, list):
+        value = {"items": value}
+    text = json.dumps(value, ensure_ascii=False)
+    if malformed:
+        # The failure modes seen from small models: prose around the JSON,
+        # a trailing comma, or a truncated array/object
+        mode = rng.randrange(3)
+        if mode == 0:
+            text = f"Aquí tienes el JSON solicitado:\n```json\n{text}\n```\nEspero que te sirva."
+        elif mode == 1:
+            text = text[:-1] + ",]" if text.endswith("]") else text[:-1] + ",}"
+        else:
+            text = text[: int(len(text) * 0.8)]
+    return text
+
+
+def message_text(message):
+    content = message.get("content")
+    if isinstance(content, list):
+        return "".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content or ""
+
+
+def estimate_tokens(text):
+    return max(1, len(text) // 4)
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    config = None
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/api/v1/models":
+            supported = ["max_tokens", "temperature"] + (["response_format", "structured_outputs"] if self.config.structured_outputs else [])
+            self.send_json(200, {"data": [{"id": "mistralai/devstral-small:free", "supported_parameters": supported}]})
+        elif self.path.rstrip("/") == "/stats":
+            with self.config.stats_lock:
+                stats = dict(self.config.stats)
+            self.send_json(200, stats)
+        else:
+            self.send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        config = self.config
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        payload = json.loads(body)
+        stream = bool(payload.get("stream"))
+        config.count(requests=1, bytes_in=len(body), streamed=int(stream))
+
+        model = payload.get("model")
+        with config.rng_lock:
+            latency = config.model_latency.get(model, config.latency)(config.rng)
+        time.sleep(latency)
+        if model in config.failing_models:
+            config.count(errors_5xx=1)
+            self.send_json(503, {"error": {"code": 503, "message": f"No endpoints available for {model}"}})
+            return
+
+        roll = config.roll()
+        if roll < config.rate_429:
+            config.count(errors_429=1)
+            self.send_json(429, {"error": {"code": 429, "message": "Rate limit exceeded"}},
+                           {"Retry-After": str(config.retry_after), "X-RateLimit-Remaining": "0"})
+            return
+        if roll < config.rate_429 + config.rate_5xx:
+            config.count(errors_5xx=1)
+            self.send_json(502, {"error": {"code": 502, "message": "Upstream provider error"}})
+            return
+
+        messages = payload.get("messages", [])
+        # The kind of answer is decided by the last message (the call-specific part)
+        prompt = message_text(messages[-1]) if messages else ""
+        system = "".join(message_text(m) for m in messages if m.get("role") == "system")
+        malformed = config.roll() < config.rate_malformed and "Corrige el siguiente JSON" not in prompt
+        with config.rng_lock:
+            text = answer(prompt, config.rng, malformed, structured="response_format" in payload)
+            cached = estimate_tokens(system) if system and system in config.prefixes else 0
+            config.prefixes.add(system)
+        if malformed:
+            config.count(malformed=1)
+        if (config.max_completion_words and not text.startswith(("{", "[")) and
+                len(text.split(" ")) > config.max_completion_words):
+            text = " ".join(text.split(" ")[:config.max_completion_words])
+            config.count(truncated=1)
+            finish_reason = "length"
+        else:
+            finish_reason = "stop"
+        usage = {"prompt_tokens": estimate_tokens(system + prompt), "completion_tokens": estimate_tokens(text),
+                 "prompt_tokens_details": {"cached_tokens": cached}}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        config.count(prompt_tokens=usage["prompt_tokens"], cached_tokens=cached)
+        if config.prefill_tokens_per_second:
+            time.sleep((usage["prompt_tokens"] - cached) / config.prefill_tokens_per_second)
+
+        if stream:
+            self.send_stream(payload, text, usage, finish_reason)
+        else:
+            if config.tokens_per_second:
+                time.sleep(usage["completion_tokens"] / config.tokens_per_second)
+            self.send_json(200, {
+                "id": "gen-mock", "model": payload.get("model"), "object": "chat.completion",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": finish_reason}],
+                "usage": usage,
+            })
+
+    def send_json(self, status, value, extra_headers=None):
+        data = json.dumps(value, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, header_value in (extra_headers or {}).items():
+            self.send_header(name, header_value)
+        self.end_headers()
+        self.wfile.write(data)
+        self.config.count(bytes_out=len(data))
+
+    # Stream the text as SSE chunks of a few words, paced by the token rate
+    def send_stream(self, payload, text, usage, finish_reason="stop"):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self.write_chunk(": OPENROUTER PROCESSING\n\n")
+        words = text.split(" ")
+        for start in range(0, len(words), 4):
+            piece = " ".join(words[start:start + 4]) + (" " if start + 4 < len(words) else "")
+            event = {"id": "gen-mock", "model": payload.get("model"),
+                     "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+            self.write_chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n")
+            if self.config.tokens_per_second:
+                time.sleep(estimate_tokens(piece) / self.config.tokens_per_second)
+        final = {"id": "gen-mock", "choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}], "usage": usage}
+        self.write_chunk(f"data: {json.dumps(final)}\n\n")
+        self.write_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def write_chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.config.count(bytes_out=len(data))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    # Clients dropping keep-alive connections is normal; only report real handler errors
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+# Start the mock on a background thread; returns (server, chat-completions URL)
+def start_mock_server(config=None, host="127.0.0.1", port=0):
+    handler = type("ConfiguredMockHandler", (MockHandler,), {"config": config or MockConfig()})
+    server = MockServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/api/v1/chat/completions"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", default="fixed:0", help="fixed:S | uniform:A,B | lognormal:MEDIAN,SIGMA (seconds)")
+    parser.add_argument("--tokens-per-second", type=float, default=0, help="completion pacing (0 = instant)")
+    parser.add_argument("--prefill-tokens-per-second", type=float, default=0,
+                        help="pacing of uncached prompt tokens before the answer starts (0 = instant)")
+    parser.add_argument("--model-latency", action="append", default=[], metavar="MODEL=SPEC",
+                        help="latency spec for one model (repeatable)")
+    parser.add_argument("--failing-model", action="append", default=[], help="model that always answers 503 (repeatable)")
+    parser.add_argument("--max-completion-words", type=int, default=0, help="cut answers off after this many words (0 = never)")
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--rate-5xx", type=float, default=0.0)
+    parser.add_argument("--rate-malformed", type=float, default=0.0, help="fraction of JSON answers that are malformed")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--structured-outputs", action="store_true", help="advertise JSON-schema response_format support")
+    args = parser.parse_args()
+    config = MockConfig(args.latency, args.tokens_per_second, args.rate_429, args.rate_5xx,
+                        args.rate_malformed, args.retry_after, args.seed, args.structured_outputs,
+                        args.prefill_tokens_per_second,
+                        dict(item.split("=", 1) for item in args.model_latency), args.failing_model,
+                        args.max_completion_words)
+    server, url = start_mock_server(config, args.host, args.port)
+    print(f"Mock OpenRouter listening on {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
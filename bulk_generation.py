@@ -0,0 +1,36 @@
+import contextvars
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import cancellation
+
+DEFAULT_CONCURRENCY = 8
+MAX_CONCURRENCY = 16
+
+
+# Run a batch of independent jobs on a bounded thread pool.
+# `jobs` maps a key (e.g. ("content", 3)) to a zero-argument callable. Yields
+# (key, result, error) tuples in completion order; a failing job yields its
+# exception instead of aborting the batch, so callers can keep partial results.
+# Jobs run in the caller's context (e.g. its request_scheduler session and priority, and its
+# cancellation token). The caller waits in slices, checking its token; if it stops (cancelled, or
+# the generator is closed) jobs that have not started are dropped and its token, cancelled by
+# its scope, aborts the ones that are running.
+def run_bounded(jobs, concurrency=DEFAULT_CONCURRENCY):
+    if not jobs:
+        return
+    workers = max(1, min(concurrency, MAX_CONCURRENCY, len(jobs)))
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bulk-generation")
+    try:
+        futures = {executor.submit(contextvars.copy_context().run, job): key for key, job in jobs.items()}
+        pending = set(futures)
+        while pending:
+            cancellation.check()
+            done, pending = wait(pending, timeout=cancellation.POLL_SECONDS, return_when=FIRST_COMPLETED)
+            for future in done:
+                key = futures[future]
+                try:
+                    yield key, future.result(), None
+                except Exception as err:
+                    yield key, None, err
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,197 @@
+import contextlib
+import contextvars
+import threading
+import time
+from functools import partial
+
+# Deadline of one interactive generation step, in seconds (see configure)
+DEFAULT_DEADLINE = 600.0
+# How often a caller waiting for an API call checks whether it was cancelled
+POLL_SECONDS = 0.5
+
+deadline_seconds = DEFAULT_DEADLINE
+
+# Token of the work the current context does (see scope); carried into worker threads with
+# the rest of the context, like the request_scheduler one
+_current = contextvars.ContextVar("cancellation_token", default=None)
+
+
+# Raised where a cancelled call was waiting or reading. Not retried, and not a fallback reason.
+class Cancelled(Exception):
+    def __init__(self, message="La generación se canceló."):
+        super().__init__(message)
+
+
+class DeadlineExceeded(Cancelled):
+    def __init__(self, seconds=None):
+        super().__init__(f"La generación superó el plazo de {seconds:g} s." if seconds else
+                         "La generación superó su plazo.")
+
+
+def configure(deadline=None):
+    global deadline_seconds
+    if deadline is not None:
+        deadline_seconds = deadline or None
+
+
+# Cancellation token with an optional deadline.
+# Cancelling it (or its parent) runs the callbacks registered with on_cancel once, e.g. to shut
+# down the socket of an HTTP request still in flight. Its deadline is checked by whoever waits
+# (see check), so it needs no timer thread. `heartbeat` runs on every check made on the thread
+# that created the token: the app uses it to give Streamlit a chance to stop a rerun that was
+# superseded by another click or by the browser going away.
+class Token:
+    def __init__(self, timeout=None, parent=None, heartbeat=None, deadline=None):
+        self.timeout = timeout
+        self.deadline = deadline if deadline is not None else (time.monotonic() + timeout if timeout else None)
+        if parent is not None and parent.deadline is not None:
+            if self.deadline is None or parent.deadline < self.deadline:
+                # Out of time means out of the parent's time
+                self.deadline = parent.deadline
+                self.timeout = parent.timeout
+        self.heartbeat = heartbeat
+        self.owner = threading.get_ident()
+        self.reason = None
+        self._event = threading.Event()
+        self._callbacks = {}
+        self._lock = threading.Lock()
+        self._detach = None
+        if parent is not None:
+            self._detach = parent.on_cancel(self.cancel)
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def expired(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    # Seconds left before the deadline (None = no deadline)
+    def remaining(self):
+        return None if self.deadline is None else max(0.0, self.deadline - time.monotonic())
+
+    def cancel(self, reason="cancelled"):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks = list(self._callbacks.values())
+            self._callbacks.clear()
+        if self._detach is not None:
+            self._detach()
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                pass
+
+    # Run `callback` when the token is cancelled (at once if it already is). Returns a function
+    # that unregisters it.
+    def on_cancel(self, callback):
+        with self._lock:
+            if not self._event.is_set():
+                handle = object()
+                self._callbacks[handle] = callback
+                return lambda: self._callbacks.pop(handle, None)
+        callback()
+        return lambda: None
+
+    # Raise if the work should stop: cancelled, or past the deadline (which cancels the token)
+    def check(self):
+        if self.heartbeat is not None and threading.get_ident() == self.owner:
+            self.heartbeat()
+        self.poll()
+
+    # check without the heartbeat, for callers holding a lock
+    def poll(self):
+        if not self._event.is_set() and self.expired():
+            self.cancel("deadline")
+        self.raise_if_cancelled()
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise DeadlineExceeded(self.timeout) if self.reason == "deadline" else Cancelled()
+
+    # Sleep up to `seconds`, waking early if cancelled; then check
+    def sleep(self, seconds):
+        remaining = self.remaining()
+        self._event.wait(seconds if remaining is None else min(seconds, remaining))
+        self.check()
+
+
+def current():
+    return _current.get()
+
+
+# Run the block under `token`. The token is cancelled when the block ends, however it ends, so
+# any work it started in the background (a hedged duplicate, a stream nobody reads any more,
+# retries) stops then too.
+@contextlib.contextmanager
+def scope(token):
+    reset = _current.set(token)
+    try:
+        yield token
+    finally:
+        _current.reset(reset)
+        if token is not None:
+            token.cancel()
+
+
+# Scope for one generation step: a child of the current token (if any) with the configured deadline
+def deadline_scope(heartbeat=None):
+    return scope(Token(deadline_seconds, parent=_current.get(), heartbeat=heartbeat))
+
+
+# Raise if the current work was cancelled or ran out of time
+def check():
+    token = _current.get()
+    if token is not None:
+        token.check()
+
+
+# Raise if the current work was cancelled: what an error or a cut-off read means once its
+# token has been cancelled (its socket was shut down under it)
+def raise_if_cancelled():
+    token = _current.get()
+    if token is not None:
+        token.raise_if_cancelled()
+
+
+# Sleep that a cancellation cuts short (retry backoff, rate-limit holds)
+def sleep(seconds):
+    token = _current.get()
+    if token is None:
+        time.sleep(seconds)
+    else:
+        token.sleep(seconds)
+
+
+# Wait on `cond` (held by the caller) until predicate() is true, checking the current token
+# every POLL_SECONDS and as soon as it is cancelled
+def wait_for(cond, predicate):
+    token = _current.get()
+    if token is None:
+        cond.wait_for(predicate)
+        return
+    unregister = token.on_cancel(partial(notify, cond))
+    try:
+        while not predicate():
+            cond.release()
+            try:
+                token.check()
+            finally:
+                cond.acquire()
+            cond.wait(POLL_SECONDS)
+    finally:
+        unregister()
+
+
+def notify(cond):
+    with cond:
+        cond.notify_all()
+
+
+# Reason label for metrics
+def reason(err):
+    return "deadline" if isinstance(err, DeadlineExceeded) else "cancelled"
@@ -0,0 +1,136 @@
+import sys
+import zlib
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+import dependency_graph
+
+# Texts kept in memory per project: one chapter's six artifacts, twice over
+DEFAULT_CACHE_SIZE = 12
+
+
+# Store of one project's generated chapter texts.
+# Every text is kept zlib-compressed in its own row of the project database (see
+# project_store); in memory there is only the set of stored (artifact, chapter) keys
+# and an LRU of the `cache_size` most recently read texts, so a session's footprint
+# does not grow with the length of the manuscript. Texts are read when a chapter is shown,
+# and each one is on disk as soon as it is stored.
+# Each row also keeps the text's fingerprint (see dependency_graph), kept in memory with the
+# keys, so checking which artifacts are stale never reads a text.
+class ChapterStore:
+    def __init__(self, conn, lock, project, cache_size=DEFAULT_CACHE_SIZE):
+        self.project = project
+        self.cache_size = cache_size
+        self.stats = {"reads": 0, "hits": 0, "writes": 0}
+        self._recent = OrderedDict()
+        self._conn = conn
+        self._lock = lock
+        with lock:
+            rows = conn.execute("SELECT artifact, chapter, digest FROM chapter_texts WHERE project = ?", (project,)).fetchall()
+        self._keys = {(artifact, chapter) for artifact, chapter, _ in rows}
+        self._digests = {(artifact, chapter): digest for artifact, chapter, digest in rows}
+
+    def get(self, artifact, chapter):
+        key = (artifact, chapter)
+        with self._lock:
+            if key in self._recent:
+                self._recent.move_to_end(key)
+                self.stats["hits"] += 1
+                return self._recent[key]
+            if key not in self._keys:
+                return None
+            row = self._conn.execute("SELECT body FROM chapter_texts WHERE project = ? AND artifact = ? AND chapter = ?",
+                                     (self.project, *key)).fetchone()
+            self.stats["reads"] += 1
+            text = zlib.decompress(row[0]).decode("utf-8")
+            self._remember(key, text)
+        return text
+
+    # Fingerprint of a stored text, or None
+    def fingerprint(self, artifact, chapter):
+        return self._digests.get((artifact, chapter))
+
+    def put(self, artifact, chapter, text):
+        key = (artifact, chapter)
+        body = zlib.compress(text.encode("utf-8"))
+        digest = dependency_graph.fingerprint(text)
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO chapter_texts (project, artifact, chapter, body, size, digest) "
+                               "VALUES (?, ?, ?, ?, ?, ?)", (self.project, artifact, chapter, body, len(body), digest))
+            self._conn.commit()
+            self._keys.add(key)
+            self._digests[key] = digest
+            self._remember(key, text)
+            self.stats["writes"] += 1
+
+    def delete(self, artifact, chapter):
+        key = (artifact, chapter)
+        with self._lock:
+            self._conn.execute("DELETE FROM chapter_texts WHERE project = ? AND artifact = ? AND chapter = ?",
+                               (self.project, *key))
+            self._conn.commit()
+            self._keys.discard(key)
+            self._digests.pop(key, None)
+            self._recent.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def chapters(self, artifact):
+        return sorted(chapter for name, chapter in self._keys if name == artifact)
+
+    def _remember(self, key, text):
+        self._recent[key] = text
+        self._recent.move_to_end(key)
+        while len(self._recent) > self.cache_size:
+            self._recent.popitem(last=False)
+
+    # Dict-like view of one artifact ({chapter index: text}), usable wherever the engine expects a dict
+    def texts(self, artifact):
+        return ChapterTexts(self, artifact)
+
+    # Approximate bytes this store keeps in memory (cached texts and the key set), and on disk
+    def summary(self):
+        with self._lock:
+            resident = sum(sys.getsizeof(text) for text in self._recent.values()) + sys.getsizeof(self._keys)
+            stored = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM chapter_texts WHERE project = ?",
+                                        (self.project,)).fetchone()
+        return {**self.stats, "texts": stored[0], "resident_bytes": resident, "disk_bytes": stored[1]}
+
+
+class ChapterTexts(MutableMapping):
+    def __init__(self, store, artifact):
+        self.store = store
+        self.artifact = artifact
+
+    def __getitem__(self, chapter):
+        text = self.store.get(self.artifact, chapter)
+        if text is None:
+            raise KeyError(chapter)
+        return text
+
+    def __setitem__(self, chapter, text):
+        self.store.put(self.artifact, chapter, text)
+
+    def __delitem__(self, chapter):
+        if (self.artifact, chapter) not in self.store:
+            raise KeyError(chapter)
+        self.store.delete(self.artifact, chapter)
+
+    # Membership is answered from the key set, without reading the text
+    def __contains__(self, chapter):
+        return (self.artifact, chapter) in self.store
+
+    # Input fingerprint of a chapter's text for the dependency graph, without reading it
+    def fingerprint(self, chapter):
+        digest = self.store.fingerprint(self.artifact, chapter)
+        return dependency_graph.Fingerprint(digest) if digest is not None else None
+
+    def __iter__(self):
+        return iter(self.store.chapters(self.artifact))
+
+    def __len__(self):
+        return len(self.store.chapters(self.artifact))
+
+    def __repr__(self):
+        return f"ChapterTexts({self.artifact!r}, {len(self)} textos)"
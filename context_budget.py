@@ -0,0 +1,60 @@
+import hashlib
+import math
+
+# Rough local token estimate: ~4 characters per token for Spanish prose with
+# BPE tokenizers. Good enough to enforce a budget without calling a tokenizer.
+CHARS_PER_TOKEN = 4
+DEFAULT_BUDGET = 2000
+DEFAULT_CONTINUITY_BUDGET = 400
+SUMMARY_WORDS = 150
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text or "") / CHARS_PER_TOKEN)
+
+
+# Stable identifier for a section's text, used to key cached summaries
+def section_fingerprint(name, text):
+    return f"{name}:{hashlib.sha256((text or '').encode('utf-8')).hexdigest()[:16]}"
+
+
+# Fit prompt context sections into a token budget.
+# `sections` is a list of (name, text, summarizable). While the total is over budget,
+# the largest summarizable section still in full form is replaced by summarize(name, text);
+# summarize may return None to keep the full text. Returns ({name: text}, report).
+def fit_sections(sections, budget, summarize):
+    texts = {name: text or "" for name, text, _ in sections}
+    full_tokens = sum(estimate_tokens(text) for text in texts.values())
+    total = full_tokens
+    summarized = []
+    candidates = sorted(
+        (name for name, text, summarizable in sections if summarizable and text),
+        key=lambda name: estimate_tokens(texts[name]),
+        reverse=True,
+    )
+    for name in candidates:
+        if total <= budget:
+            break
+        summary = summarize(name, texts[name])
+        if summary and estimate_tokens(summary) < estimate_tokens(texts[name]):
+            total -= estimate_tokens(texts[name]) - estimate_tokens(summary)
+            texts[name] = summary
+            summarized.append(name)
+    report = {
+        "budget": budget,
+        "full_tokens": full_tokens,
+        "tokens": total,
+        "tokens_saved": full_tokens - total,
+        "summarized": summarized,
+    }
+    return texts, report
+
+
+# Cut a text to about `tokens` tokens, at the last line or sentence break that fits
+def truncate_tokens(text, tokens):
+    limit = tokens * CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text
+    cut = text[:limit]
+    end = max(cut.rfind("\n"), cut.rfind(". "))
+    return cut[:end + 1].rstrip() if end > limit // 2 else cut.rstrip()
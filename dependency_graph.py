@@ -0,0 +1,76 @@
+import hashlib
+import json
+from graphlib import TopologicalSorter
+
+
+# A value's fingerprint computed ahead of time (e.g. stored with a chapter text), standing in
+# for the value as an input so the value itself need not be loaded
+class Fingerprint(str):
+    pass
+
+
+# Stable fingerprint of any JSON-serialisable value (None for missing values)
+def fingerprint(value):
+    if value is None or isinstance(value, Fingerprint):
+        return value
+    encoded = json.dumps(value, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()[:16]
+
+
+def artifact_id(key, index=None):
+    return key if index is None else f"{key}:{index}"
+
+
+# Dependency DAG over session-state keys.
+# Each artifact declares its inputs as (source key, selector) pairs. The selector
+# projects the part of the source the artifact's prompt actually uses, e.g. only
+# the character names, so unrelated edits upstream do not mark it stale.
+# Per-chapter artifacts are stored as {index: value} dicts and get selector(value, index).
+class DependencyGraph:
+    def __init__(self):
+        self.nodes = {}
+
+    def add(self, key, inputs, per_chapter=False):
+        self.nodes[key] = {"inputs": inputs, "per_chapter": per_chapter}
+
+    def order(self):
+        graph = {key: {source for source, _ in node["inputs"] if source in self.nodes}
+                 for key, node in self.nodes.items()}
+        return list(TopologicalSorter(graph).static_order())
+
+    # Fingerprints of an artifact's current inputs
+    def input_fingerprints(self, state, key, index=None):
+        fingerprints = {}
+        for source, selector in self.nodes[key]["inputs"]:
+            value = state.get(source)
+            if selector is not None and value is not None:
+                value = selector(value) if index is None else selector(value, index)
+            fingerprints[source] = fingerprint(value)
+        return fingerprints
+
+    # Existing artifact ids for a key: the key itself, or one per generated chapter
+    def existing(self, state, key, chapter_count):
+        value = state.get(key)
+        if self.nodes[key]["per_chapter"]:
+            # Membership only: chapter texts may live on disk (chapter_store) and are not read here
+            return [index for index in range(chapter_count) if index in (value or {})]
+        return [None] if value else []
+
+    # Record what an artifact was just built from
+    def record(self, records, state, key, index=None):
+        records[artifact_id(key, index)] = self.input_fingerprints(state, key, index)
+
+    # Existing artifacts whose recorded inputs differ from the current ones, in dependency order.
+    # Returns (key, index, changed input keys) tuples; artifacts with no record are not judged.
+    def stale(self, records, state, chapter_count):
+        result = []
+        for key in self.order():
+            for index in self.existing(state, key, chapter_count):
+                recorded = records.get(artifact_id(key, index))
+                if recorded is None:
+                    continue
+                current = self.input_fingerprints(state, key, index)
+                changed = [source for source, fp in current.items() if recorded.get(source) != fp]
+                if changed:
+                    result.append((key, index, changed))
+        return result
@@ -0,0 +1,263 @@
+import contextvars
+import queue
+import threading
+import time
+from collections import deque
+
+import cancellation
+import request_scheduler
+import telemetry
+
+# Quantile of a stage's observed latency after which a call is hedged
+HEDGE_QUANTILE = 0.9
+# Latency samples needed before a stage's threshold is trusted, and samples kept per stage
+MIN_SAMPLES = 10
+SAMPLE_SIZE = 100
+# Recent hedge-eligible calls the budget is measured over
+BUDGET_WINDOW = 200
+DEFAULT_BUDGET = 0.05
+DEFAULT_MIN_DELAY = 1.0
+
+# Fraction of calls that may be duplicated (0 = hedging off)
+budget = 0.0
+# Calls are never hedged sooner than this many seconds, whatever the stage's p90
+min_delay = DEFAULT_MIN_DELAY
+
+_lock = threading.Lock()
+# (stage label, "ttft" or "wall") -> recent latencies of first attempts
+_samples = {}
+# Whether each recent eligible call was hedged
+_window = deque(maxlen=BUDGET_WINDOW)
+stats = {"calls": 0, "hedged": 0, "hedge_wins": 0, "saved_seconds": 0.0}
+
+
+def configure(fraction=None, delay=None):
+    global budget, min_delay
+    if fraction is not None:
+        budget = fraction
+    if delay is not None:
+        min_delay = delay
+
+
+# Seconds after which a call of this stage gets a duplicate: the p90 of its first attempts'
+# time to first token (streams) or wall time (plain calls). None while hedging is off, for
+# prefetches (nobody is waiting for them) and until the stage has enough samples.
+def threshold(stage, kind):
+    if not budget or request_scheduler.current_priority() == request_scheduler.PREFETCH:
+        return None
+    with _lock:
+        samples = _samples.get((telemetry.stage_label(stage), kind))
+        if samples is None or len(samples) < MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+    return max(min_delay, ordered[min(len(ordered) - 1, int(HEDGE_QUANTILE * len(ordered)))])
+
+
+def _record_sample(stage, kind, seconds):
+    with _lock:
+        _samples.setdefault((telemetry.stage_label(stage), kind), deque(maxlen=SAMPLE_SIZE)).append(seconds)
+
+
+# Count an eligible call against the budget; a hedge is only sent while hedged calls stay
+# under `budget` of the recent ones
+def _spend(hedge):
+    with _lock:
+        allowed = hedge and sum(_window) + 1 <= budget * (len(_window) + 1)
+        _window.append(allowed)
+        stats["calls"] += 1
+        if allowed:
+            stats["hedged"] += 1
+        return allowed
+
+
+# One hedged call: the original request (lane 0) and, if it is late, a duplicate (lane 1)
+# racing on background threads. The first lane to answer wins and the other is cancelled, which
+# aborts its upstream request (see cancellation). Each lane runs under a child of the caller's
+# cancellation token and posts its events (a chunk, its end, an error) to one queue, tagged
+# with its number. `won()`, if given, is called when the duplicate wins.
+class Race:
+    def __init__(self, stage, kind, won=None):
+        self.stage = stage
+        self.kind = kind
+        self.won = won
+        self.events = queue.Queue()
+        self.lanes = 0
+        self.running = 0
+        self.winner = None
+        self.counted = False
+        self.started = time.perf_counter()
+        self.tokens = []
+
+    def start(self, body, *args):
+        lane = self.lanes
+        self.lanes += 1
+        self.running += 1
+        token = cancellation.Token(parent=cancellation.current())
+        self.tokens.append(token)
+        run = contextvars.copy_context().run
+        threading.Thread(target=run, args=(_in_scope, token, body, lane, *args), name="hedge", daemon=True).start()
+
+    # Whether a lane should stop: another one won, or the caller is done with the race (winner -1)
+    def lost(self, lane):
+        return self.winner is not None and self.winner != lane
+
+    # Called by the original lane when it has its first chunk or its whole answer
+    def answered_by(self, lane):
+        if lane == 0:
+            _record_sample(self.stage, self.kind, time.perf_counter() - self.started)
+
+    # Next event, sending the duplicate if the original has not answered within `delay`.
+    # An error from one lane is only raised when no other lane is still running.
+    def next_event(self, delay, hedge):
+        while True:
+            try:
+                lane, kind, value = self.events.get(timeout=delay if self.lanes == 1 else None)
+            except queue.Empty:
+                self.counted = True
+                if _spend(True):
+                    self.start(*hedge)
+                else:
+                    delay = None
+                continue
+            if kind == "error":
+                self.running -= 1
+                if self.running:
+                    continue
+            if not self.counted:
+                self.counted = True
+                _spend(False)
+            return lane, kind, value
+
+    def decide(self, lane):
+        self.winner = lane
+        if self.lanes == 1:
+            return
+        for other, token in enumerate(self.tokens):
+            if other != lane:
+                token.cancel()
+        label = telemetry.stage_label(self.stage)
+        telemetry.increment("llm_hedged_requests_total", stage=label, winner="hedge" if lane else "original")
+        if lane == 1:
+            # The original was cancelled unanswered, so the time it would still have taken is
+            # estimated from the stage's samples: it counts as a sample of at least this long
+            elapsed = time.perf_counter() - self.started
+            saved = _expected_beyond(self.stage, self.kind, elapsed)
+            _record_sample(self.stage, self.kind, elapsed)
+            telemetry.observe("llm_hedge_saved_seconds", saved, stage=label)
+            with _lock:
+                stats["hedge_wins"] += 1
+                stats["saved_seconds"] += saved
+            if self.won is not None:
+                self.won()
+
+    # Stop every lane still running (the caller went away or is done)
+    def cancel(self):
+        self.winner = -1
+        for token in self.tokens:
+            token.cancel()
+
+
+def _in_scope(token, body, *args):
+    with cancellation.scope(token):
+        body(*args)
+
+
+# Mean extra time the stage's first attempts that took longer than `elapsed` needed beyond it
+def _expected_beyond(stage, kind, elapsed):
+    with _lock:
+        longer = [seconds for seconds in _samples.get((telemetry.stage_label(stage), kind), ()) if seconds > elapsed]
+    return sum(longer) / len(longer) - elapsed if longer else 0.0
+
+
+def _call_lane(lane, race, send):
+    try:
+        result = send()
+    except Exception as err:
+        race.events.put((lane, "error", err))
+        return
+    race.answered_by(lane)
+    race.events.put((lane, "result", result))
+
+
+def _stream_lane(lane, race, open_chunks):
+    chunks = open_chunks()
+    try:
+        first = True
+        for chunk in chunks:
+            if first:
+                race.answered_by(lane)
+                first = False
+            if race.lost(lane):
+                return
+            race.events.put((lane, "chunk", chunk))
+        race.events.put((lane, "end", None))
+    except Exception as err:
+        race.events.put((lane, "error", err))
+    finally:
+        chunks.close()
+
+
+# Run a plain request, sending `hedge()` as well if `send()` has not answered by the stage's
+# threshold; returns whichever answers first and cancels the other. `won()` is called if the
+# duplicate's answer is the one returned.
+def call(stage, send, hedge, won=None):
+    delay = threshold(stage, "wall")
+    if delay is None:
+        started = time.perf_counter()
+        result = send()
+        _record_sample(stage, "wall", time.perf_counter() - started)
+        return result
+    race = Race(stage, "wall", won)
+    race.start(_call_lane, race, send)
+    lane, kind, value = race.next_event(delay, (_call_lane, race, hedge))
+    if kind == "error":
+        raise value
+    race.decide(lane)
+    return value
+
+
+# Iterator over the chunks of `open_chunks()`, racing `open_hedge()` against it if no chunk
+# came by the stage's time-to-first-token threshold. Hedging only covers the first chunk:
+# from then on the winner's chunks are passed through and the other stream is cancelled.
+# `won()` is called, before the first chunk is yielded, if the duplicate's chunks are.
+def stream(stage, open_chunks, open_hedge, won=None):
+    delay = threshold(stage, "ttft")
+    if delay is None:
+        yield from _timed_stream(stage, open_chunks())
+        return
+    race = Race(stage, "ttft", won)
+    race.start(_stream_lane, race, open_chunks)
+    try:
+        lane, kind, value = race.next_event(delay, (_stream_lane, race, open_hedge))
+        if kind == "error":
+            raise value
+        race.decide(lane)
+        while True:
+            if kind == "error":
+                raise value
+            if kind == "end":
+                return
+            yield value
+            lane, kind, value = race.events.get()
+            while lane != race.winner:
+                lane, kind, value = race.events.get()
+    finally:
+        race.cancel()
+
+
+# Helper generator recording the time to first chunk of an unhedged stream
+def _timed_stream(stage, chunks):
+    started = time.perf_counter()
+    try:
+        for chunk in chunks:
+            if started is not None:
+                _record_sample(stage, "ttft", time.perf_counter() - started)
+                started = None
+            yield chunk
+    finally:
+        chunks.close()
+
+
+def summary():
+    with _lock:
+        return {**stats, "rate": stats["hedged"] / stats["calls"] if stats["calls"] else None}
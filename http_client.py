@@ -0,0 +1,208 @@
+import json
+import socket
+import threading
+from functools import partial
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+import cancellation
+
+# Connection pool configuration. One pool per host is enough: every call goes
+# to openrouter.ai, so pool_maxsize bounds the number of concurrent keep-alive
+# connections kept open to it.
+DEFAULT_POOL_CONNECTIONS = 4
+DEFAULT_POOL_MAXSIZE = 16
+# (connect, read) timeouts in seconds. Long chapters can take minutes on
+# free-tier models, so the read timeout is generous; the connect timeout is not.
+DEFAULT_CONNECT_TIMEOUT = 10.0
+DEFAULT_READ_TIMEOUT = 300.0
+
+_session = None
+_session_lock = threading.Lock()
+_timeout = (DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT)
+
+
+# Helper function to shut a socket down from another thread, which ends a read blocked on it at once
+# (closing it would not wake the reader up)
+def shutdown(sock):
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+# Connections whose wait for a response is cut short when the current cancellation token is
+# cancelled (see cancellation). The socket is only watched while waiting, since it goes back
+# to the pool for other requests afterwards.
+class CancellableMixin:
+    def getresponse(self):
+        token = cancellation.current()
+        if token is None:
+            return super().getresponse()
+        unregister = token.on_cancel(partial(shutdown, self.sock))
+        try:
+            return super().getresponse()
+        finally:
+            unregister()
+
+
+class CancellableHTTPConnection(CancellableMixin, HTTPConnection):
+    pass
+
+
+class CancellableHTTPSConnection(CancellableMixin, HTTPSConnection):
+    pass
+
+
+class CancellableHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = CancellableHTTPConnection
+
+
+class CancellableHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = CancellableHTTPSConnection
+
+
+class CancellableAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": CancellableHTTPConnectionPool,
+                                                   "https": CancellableHTTPSConnectionPool}
+
+
+# Create a requests.Session with a sized connection pool and keep-alive/gzip headers
+def create_session(pool_connections=DEFAULT_POOL_CONNECTIONS, pool_maxsize=DEFAULT_POOL_MAXSIZE):
+    session = requests.Session()
+    adapter = CancellableAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({
+        "Accept-Encoding": "gzip, deflate",
+        "Connection": "keep-alive",
+    })
+    return session
+
+
+# Configure the shared client. Replaces the current session so new pool sizes take effect.
+def configure(connect_timeout=None, read_timeout=None, pool_connections=None, pool_maxsize=None):
+    global _session, _timeout
+    with _session_lock:
+        _timeout = (
+            connect_timeout if connect_timeout is not None else _timeout[0],
+            read_timeout if read_timeout is not None else _timeout[1],
+        )
+        if pool_connections is not None or pool_maxsize is not None:
+            if _session is not None:
+                _session.close()
+            _session = create_session(
+                pool_connections or DEFAULT_POOL_CONNECTIONS,
+                pool_maxsize or DEFAULT_POOL_MAXSIZE,
+            )
+
+
+# Return the process-wide session, creating it on first use.
+# Modules are imported once per process, so the pool survives Streamlit reruns
+# and is shared by every browser session served by the same server.
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = create_session()
+    return _session
+
+
+def get_timeout():
+    return _timeout
+
+
+# POST a JSON payload through the shared pool and return the response.
+# If the current cancellation token is cancelled meanwhile the request is aborted and
+# cancellation.Cancelled raised; a streamed response stays abortable until it is closed.
+def post_json(url, headers, payload, stream=False, timeout=None):
+    cancellation.check()
+    try:
+        response = get_session().post(
+            url,
+            headers=headers,
+            json=payload,
+            stream=stream,
+            timeout=timeout or _timeout,
+        )
+    except Exception:
+        cancellation.raise_if_cancelled()
+        raise
+    token = cancellation.current()
+    if stream and token is not None:
+        response.stop_watching = token.on_cancel(partial(abort, response))
+    return response
+
+
+# Helper function to abort a streamed response that is being read on another thread
+def abort(response):
+    connection = getattr(response.raw, "connection", None)
+    shutdown(getattr(connection, "sock", None))
+
+
+def close():
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+# Raised when a streamed completion reports an error mid-stream
+class StreamError(requests.exceptions.RequestException):
+    pass
+
+
+# Yield the data field of each server-sent event until the [DONE] sentinel.
+# Lines starting with ':' are SSE comments (OpenRouter sends keep-alive ones).
+def iter_sse_data(response):
+    response.encoding = "utf-8"
+    for line in response.iter_lines(decode_unicode=True):
+        if not line or line.startswith(":"):
+            continue
+        if line.startswith("data:"):
+            data = line[5:].strip()
+            if data == "[DONE]":
+                return
+            yield data
+
+
+# Yield the text deltas of a streamed chat completion and release the connection when done.
+# on_usage, if given, receives the `usage` block OpenRouter sends with the last event.
+# A stream aborted by its cancellation token raises cancellation.Cancelled, never a short text.
+def iter_stream_content(response, on_usage=None):
+    try:
+        for data in read_events(response):
+            try:
+                event = json.loads(data)
+            except json.JSONDecodeError as err:
+                raise StreamError(f"Evento SSE inválido: {err}") from err
+            if event.get("error"):
+                raise StreamError(event["error"].get("message", str(event["error"])))
+            if on_usage and event.get("usage"):
+                on_usage(event["usage"])
+            choices = event.get("choices") or []
+            if choices:
+                delta = choices[0].get("delta") or {}
+                if delta.get("content"):
+                    yield delta["content"]
+    finally:
+        getattr(response, "stop_watching", lambda: None)()
+        response.close()
+
+
+# Helper generator over a response's SSE data that reports an abort as a cancellation
+def read_events(response):
+    try:
+        yield from iter_sse_data(response)
+    except Exception:
+        cancellation.raise_if_cancelled()
+        raise
+    cancellation.raise_if_cancelled()
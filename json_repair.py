@@ -0,0 +1,116 @@
+# Local validation and repair of the JSON the model returns, so a slightly broken
+# answer does not cost a full regeneration.
+
+JSON_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "number": (int, float),
+    "integer": int,
+    "boolean": bool,
+    "null": type(None),
+}
+
+
+# Check a value against the JSON-schema subset used for the novel artifacts
+# (type, properties, required, items, minItems, maxItems). Returns a list of problems.
+def validate(value, schema, path="$"):
+    expected = JSON_TYPES.get(schema.get("type"))
+    if expected and (not isinstance(value, expected) or (schema["type"] != "boolean" and isinstance(value, bool))):
+        return [f"{path}: se esperaba {schema['type']}"]
+    errors = []
+    if isinstance(value, dict):
+        errors += [f"{path}: falta '{key}'" for key in schema.get("required", []) if key not in value]
+        for key, subschema in schema.get("properties", {}).items():
+            if key in value:
+                errors += validate(value[key], subschema, f"{path}.{key}")
+    if isinstance(value, list):
+        if len(value) < schema.get("minItems", 0):
+            errors.append(f"{path}: {len(value)} elementos, se esperaban al menos {schema['minItems']}")
+        if "maxItems" in schema and len(value) > schema["maxItems"]:
+            errors.append(f"{path}: {len(value)} elementos, se esperaban como máximo {schema['maxItems']}")
+        if "items" in schema:
+            for position, item in enumerate(value):
+                errors += validate(item, schema["items"], f"{path}[{position}]")
+    return errors
+
+
+def next_significant(text, position):
+    while position < len(text) and text[position].isspace():
+        position += 1
+    return text[position] if position < len(text) else ""
+
+
+# Candidate repairs of a broken JSON text, most faithful first:
+#  - drops prose and fences around the JSON (from the first `expect` bracket, if given)
+#  - removes trailing commas before } and ]
+#  - escapes quotes inside strings that are clearly not closing ones, and raw newlines
+#  - closes a truncated answer: first by closing what is open, then by cutting back to the
+#    last complete array element (a half-written chapter is worse than a missing one)
+def repair_candidates(text, expect=None):
+    starts = [text.find(ch) for ch in (expect or "[{") if ch in text]
+    if not starts:
+        return []
+    out = []
+    stack = []
+    in_string = False
+    escape = False
+    last_element = None
+    position = min(starts)
+    while position < len(text):
+        ch = text[position]
+        if in_string:
+            if escape:
+                escape = False
+                out.append(ch)
+            elif ch == "\\":
+                escape = True
+                out.append(ch)
+            elif ch == '"':
+                if next_significant(text, position + 1) in (",", "}", "]", ":", ""):
+                    in_string = False
+                    out.append(ch)
+                else:
+                    out.append('\\"')
+            elif ch == "\n":
+                out.append("\\n")
+            elif ch in "\r\t":
+                out.append("\\r" if ch == "\r" else "\\t")
+            else:
+                out.append(ch)
+        elif ch == '"':
+            in_string = True
+            out.append(ch)
+        elif ch in "[{":
+            stack.append("]" if ch == "[" else "}")
+            out.append(ch)
+        elif ch in "]}":
+            if stack:
+                out.append(stack.pop())
+            if not stack:
+                break
+            if stack[-1] == "]":
+                last_element = (len(out), list(stack))
+        elif ch == ",":
+            if next_significant(text, position + 1) not in ("]", "}", ""):
+                out.append(ch)
+        else:
+            out.append(ch)
+        position += 1
+
+    if not stack:
+        return ["".join(out)]
+    candidates = []
+    closed = "".join(out)
+    if in_string:
+        closed += '"'
+    closed = closed.rstrip().rstrip(",")
+    if closed.endswith(":"):
+        # Drop a key whose value never arrived
+        key = closed[:-1].rstrip()
+        closed = key[:key.rfind('"', 0, len(key) - 1)].rstrip().rstrip(",")
+    candidates.append(closed + "".join(reversed(stack)))
+    if last_element is not None:
+        length, open_stack = last_element
+        candidates.append("".join(out[:length]).rstrip().rstrip(",") + "".join(reversed(open_stack)))
+    return candidates
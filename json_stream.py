@@ -0,0 +1,104 @@
+import json
+
+
+# Incremental extractor for the JSON the model is asked to return.
+# Text before the first { or [ (prose, a ```json fence) and after the matching close is
+# ignored. For a top-level array each element is parsed, once, as soon as its closing
+# bracket (or separating comma) arrives, so callers can show chapters or characters while
+# the rest is still streaming; the final list is assembled from those elements without
+# parsing the whole text again. A top-level object is parsed once when it closes.
+# expect="[" starts at the first array, skipping an object wrapped around it
+# (structured-output answers come as {"items": [...]}).
+class JsonStreamParser:
+    def __init__(self, expect=None):
+        self.openers = expect or "[{"
+        self.container = None
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.pending = []
+        self.collecting = False
+        self.items = []
+        self.done = False
+        self.value = None
+
+    # Feed the next chunk of text; returns the array elements it completed
+    def feed(self, chunk):
+        completed = []
+        start = 0 if self.collecting else None
+        for i, ch in enumerate(chunk):
+            if self.done:
+                break
+            if self.container is None:
+                if ch in self.openers:
+                    self.container = ch
+                    self.depth = 1
+                    if ch == "{":
+                        start = i
+                        self.collecting = True
+                continue
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+                continue
+            at_element_level = self.container == "[" and self.depth == 1
+            if ch == '"' or ch in "[{":
+                if at_element_level and start is None:
+                    start = i
+                    self.collecting = True
+                if ch == '"':
+                    self.in_string = True
+                else:
+                    self.depth += 1
+            elif ch in "]}":
+                self.depth -= 1
+                if self.depth == 0:
+                    self.done = True
+                    if self.container == "{":
+                        self.value = json.loads("".join(self.pending) + chunk[start:i + 1])
+                    else:
+                        if start is not None:
+                            self._finish(chunk[start:i], completed)
+                        self.value = self.items
+                elif self.container == "[" and self.depth == 1:
+                    self._finish(chunk[start:i + 1], completed)
+                    start = None
+            elif at_element_level:
+                if ch == ",":
+                    if start is not None:
+                        self._finish(chunk[start:i], completed)
+                        start = None
+                elif not ch.isspace() and start is None:
+                    start = i
+                    self.collecting = True
+        if start is not None and not self.done:
+            self.pending.append(chunk[start:])
+        return completed
+
+    # Parse the text collected for one array element (whitespace-only text is a trailing comma)
+    def _finish(self, tail, completed):
+        text = "".join(self.pending) + tail
+        self.pending = []
+        self.collecting = False
+        if text.strip():
+            item = json.loads(text)
+            self.items.append(item)
+            completed.append(item)
+
+    # The parsed value; raises ValueError if no complete JSON value was received
+    def result(self):
+        if not self.done:
+            raise ValueError("JSON incompleto: la respuesta terminó antes de cerrar el " +
+                             ("array" if self.container == "[" else "objeto" if self.container else "JSON"))
+        return self.value
+
+
+# Parse a complete response text in one pass
+def parse(text, expect=None):
+    parser = JsonStreamParser(expect)
+    parser.feed(text)
+    return parser.result()
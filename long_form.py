@@ -0,0 +1,113 @@
+import re
+
+# Words of one scene beat: a long-form chapter gets one beat per this many words
+BEAT_WORDS = 600
+MIN_BEATS = 2
+MAX_BEATS = 8
+# A finished text is still continued if it has under this share of its target length and lacks at
+# least MIN_MISSING_WORDS (small models often end a chapter early on a complete sentence)
+MIN_FRACTION = 0.8
+MIN_MISSING_WORDS = 150
+# Words asked for to close a text that was cut off at about its full length
+FINISH_WORDS = 80
+# Continuation calls one text may get before it is kept as it is
+MAX_CONTINUATIONS = 2
+# Words of the end of a text shown to a continuation, and of each side of a transition
+TAIL_WORDS = 300
+EDGE_WORDS = 120
+# Repeated words looked for where a continuation starts over the end of the text
+MAX_OVERLAP_WORDS = 60
+MIN_OVERLAP_WORDS = 5
+
+SENTENCE_ENDS = (".", "!", "?", "…", "»", '"', "”", ")")
+# Markdown a text may close with after its last sentence: emphasis and code marks
+MARKDOWN_MARKS = "*_`~ "
+# A last line that closes a text on purpose: a heading, an emphasised line such as "*Fin*", or a
+# separator such as "***" or "---"
+CLOSING_LINE = re.compile(r"^(?:#+\s*\S.*|([*_]{1,3})\S(?:.*\S)?\1|[-*_~=·•\s]{3,})$")
+BEAT_MARKER = re.compile(r"^\s*(?:[-*•]\s*|\d+\s*[.)\-:]\s*|escena\s+\d+\s*[.:\-]\s*)+", re.IGNORECASE)
+
+
+def count_words(text):
+    return len((text or "").split())
+
+
+# Number of scene beats for a chapter of `words` words
+def beat_count(words):
+    return min(MAX_BEATS, max(MIN_BEATS, round(words / BEAT_WORDS)))
+
+
+# Whether a text written to about `words` words stopped before its end: the model hit its output
+# limit (finish_reason "length"), the text breaks off mid-sentence, or it falls well short of
+# `words` without closing on an explicit ending such as "*Fin*"
+def stopped_early(text, words, finish_reason=None):
+    return finish_reason == "length" or breaks_off(text) or (falls_short(text, words) and not closes(text))
+
+
+def falls_short(text, words):
+    missing = words - count_words(text)
+    return missing > (1 - MIN_FRACTION) * words and missing >= MIN_MISSING_WORDS
+
+
+# Whether a text's last line ends it on purpose (see CLOSING_LINE)
+def closes(text):
+    text = (text or "").strip()
+    return bool(text) and CLOSING_LINE.match(text.splitlines()[-1].strip()) is not None
+
+
+# Whether a text ends mid-sentence, ignoring markdown closing its last sentence
+def breaks_off(text):
+    text = (text or "").strip()
+    if not text or closes(text):
+        return False
+    return not text.rstrip(MARKDOWN_MARKS).endswith(SENTENCE_ENDS)
+
+
+# Words a continuation of `text` should add to reach about `words`
+def missing_words(text, words):
+    return max(FINISH_WORDS, words - count_words(text))
+
+
+def tail(text, words=TAIL_WORDS):
+    return " ".join(text.split()[-words:])
+
+
+def head(text, words=EDGE_WORDS):
+    return " ".join(text.split()[:words])
+
+
+# Scene beats from a plan (or key events) answered as a list: one per line or paragraph,
+# without numbering or bullets
+def parse_beats(text):
+    beats = []
+    for line in (text or "").splitlines():
+        line = BEAT_MARKER.sub("", line).strip().strip("*").strip()
+        if count_words(line) >= 3:
+            beats.append(line)
+    return beats
+
+
+# Append a continuation to the text it continues. Words it repeats from the end of the text are
+# dropped; it follows in the same paragraph if the text broke off mid-sentence.
+def join_continuation(text, more):
+    text = text.rstrip()
+    words = more.split()
+    ending = text.split()[-MAX_OVERLAP_WORDS:]
+    for size in range(min(len(ending), len(words)), MIN_OVERLAP_WORDS - 1, -1):
+        if ending[-size:] == words[:size]:
+            more = more.strip().split(None, size)[size] if len(words) > size else ""
+            break
+    more = more.strip()
+    if not more:
+        return text
+    return f"{text} {more}" if breaks_off(text) else f"{text}\n\n{more}"
+
+
+# Chapter text from its drafted beats and the transitions between them (None = no transition)
+def stitch(beats, bridges):
+    parts = [beats[0].strip()]
+    for bridge, beat in zip(bridges, beats[1:]):
+        if bridge:
+            parts.append(bridge.strip())
+        parts.append(beat.strip())
+    return "\n\n".join(part for part in parts if part)
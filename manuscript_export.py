@@ -0,0 +1,259 @@
+import gzip
+import json
+import re
+import tempfile
+import time
+import uuid
+import zipfile
+from xml.sax.saxutils import escape
+
+import novel_engine
+
+# Exports up to this size stay in memory; larger ones spill to a temporary file
+SPOOL_MAX_BYTES = 1024 * 1024
+# Characters XML 1.0 does not allow (model output occasionally contains them)
+XML_INVALID = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+
+# Paragraphs of a generated text: blank-line separated blocks, single line breaks kept as spaces
+def paragraphs(text):
+    return [" ".join(line.strip() for line in block.splitlines()) for block in re.split(r"\n\s*\n", text or "")
+            if block.strip()]
+
+
+def xml_text(text):
+    return escape(XML_INVALID.sub("", text))
+
+
+def novel_title(state):
+    return (state.get("user_theme") or "").strip() or "Novela"
+
+
+# Front matter sections as (heading, [paragraphs]); skipped when missing or not parsed
+def front_matter(state):
+    sections = []
+    outline = state.get("novel_outline_data")
+    if outline and not novel_engine.is_raw(outline):
+        sections += [("Sinopsis", paragraphs(outline.get("synthesis"))),
+                     ("Descripción", paragraphs(outline.get("description"))),
+                     ("Trama", paragraphs(outline.get("plot")))]
+    characters = state.get("characters_data")
+    if isinstance(characters, list):
+        sections.append(("Personajes", [f"{char.get('name', '')} ({char.get('role', '')}): {char.get('description', '')}"
+                                        for char in characters]))
+    if state.get("setting_details"):
+        sections.append(("Ambientación", paragraphs(state["setting_details"])))
+    if state.get("plot_twist_data"):
+        sections.append(("Giro Argumental", paragraphs(state["plot_twist_data"])))
+    return [(heading, body) for heading, body in sections if body]
+
+
+# Chapters one at a time: (number, title, description, [(note label, paragraphs)], content paragraphs).
+# Texts are read from the state only when their chapter is reached.
+def iter_chapters(state, include_notes):
+    chapters = state.get("chapters_data")
+    if not isinstance(chapters, list):
+        return
+    for index, chapter in enumerate(chapters):
+        notes = []
+        if include_notes:
+            for artifact in novel_engine.CHAPTER_DETAIL_ARTIFACTS:
+                state_key, *_, label = novel_engine.CHAPTER_ARTIFACTS[artifact][:4]
+                text = state[state_key].get(index)
+                if text:
+                    notes.append((label, paragraphs(text)))
+        content = paragraphs(state["chapter_contents"].get(index))
+        yield index + 1, chapter.get("title", f"Capítulo {index + 1}"), chapter.get("description", ""), notes, content
+
+
+def write_markdown(state, out, include_notes=False):
+    def write(text):
+        out.write(text.encode("utf-8"))
+
+    write(f"# {novel_title(state)}\n\n")
+    for heading, body in front_matter(state):
+        write(f"## {heading}\n\n" + "".join(f"{paragraph}\n\n" for paragraph in body))
+    for number, title, description, notes, content in iter_chapters(state, include_notes):
+        write(f"## Capítulo {number}: {title}\n\n")
+        if include_notes:
+            write(f"*{description}*\n\n")
+            for label, body in notes:
+                write(f"### {label}\n\n" + "".join(f"{paragraph}\n\n" for paragraph in body))
+        write("".join(f"{paragraph}\n\n" for paragraph in content))
+
+
+# Same layout as the previous JSON export (always with every artifact), written one value
+# at a time and gzip-compressed
+def write_json_gz(state, out, include_notes=True):
+    with gzip.GzipFile(fileobj=out, mode="wb") as gz:
+        def write(text):
+            gz.write(text.encode("utf-8"))
+
+        write("{")
+        for position, (name, key) in enumerate((("outline", "novel_outline_data"), ("characters", "characters_data"),
+                                                ("setting", "setting_details"), ("plot_twist", "plot_twist_data"),
+                                                ("chapters", "chapters_data"))):
+            write(f'{"," if position else ""}"{name}": {json.dumps(state.get(key), ensure_ascii=False)}')
+        for state_key, *_ in novel_engine.CHAPTER_ARTIFACTS.values():
+            write(f', "{state_key}": {{')
+            for position, index in enumerate(sorted(state[state_key])):
+                write(f'{"," if position else ""}"{index}": {json.dumps(state[state_key][index], ensure_ascii=False)}')
+            write("}")
+        write("}")
+
+
+def xhtml_page(title, body):
+    return ('<?xml version="1.0" encoding="utf-8"?>\n'
+            '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="es" xml:lang="es">\n'
+            f"<head><title>{xml_text(title)}</title></head>\n<body>\n{body}</body>\n</html>\n")
+
+
+def html_paragraphs(body):
+    return "".join(f"<p>{xml_text(paragraph)}</p>\n" for paragraph in body)
+
+
+# EPUB 3: one XHTML document per chapter, each written and compressed as its chapter is read
+def write_epub(state, out, include_notes=False):
+    title = novel_title(state)
+    documents = []
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as epub:
+        # The mimetype entry must come first and be stored uncompressed
+        epub.writestr(zipfile.ZipInfo("mimetype"), "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        epub.writestr("META-INF/container.xml",
+                      '<?xml version="1.0" encoding="utf-8"?>\n'
+                      '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">\n'
+                      '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>\n'
+                      "</container>\n")
+        sections = front_matter(state)
+        if sections:
+            body = f"<h1>{xml_text(title)}</h1>\n" + "".join(f"<h2>{xml_text(heading)}</h2>\n{html_paragraphs(section)}"
+                                                             for heading, section in sections)
+            epub.writestr("OEBPS/front.xhtml", xhtml_page(title, body))
+            documents.append(("front.xhtml", title))
+        for number, chapter_title, description, notes, content in iter_chapters(state, include_notes):
+            heading = f"Capítulo {number}: {chapter_title}"
+            body = f"<h2>{xml_text(heading)}</h2>\n"
+            if include_notes:
+                body += f"<p><em>{xml_text(description)}</em></p>\n" + "".join(
+                    f"<h3>{xml_text(label)}</h3>\n{html_paragraphs(note)}" for label, note in notes)
+            body += html_paragraphs(content)
+            name = f"chapter_{number:03d}.xhtml"
+            with epub.open(f"OEBPS/{name}", "w") as document:
+                document.write(xhtml_page(heading, body).encode("utf-8"))
+            documents.append((name, heading))
+
+        nav = "<nav epub:type=\"toc\" id=\"toc\"><h1>Índice</h1>\n<ol>\n" + "".join(
+            f'<li><a href="{name}">{xml_text(heading)}</a></li>\n' for name, heading in documents) + "</ol></nav>\n"
+        epub.writestr("OEBPS/nav.xhtml", xhtml_page("Índice", nav))
+        manifest = "".join(f'<item id="doc{i}" href="{name}" media-type="application/xhtml+xml"/>\n'
+                           for i, (name, _) in enumerate(documents))
+        spine = "".join(f'<itemref idref="doc{i}"/>\n' for i in range(len(documents)))
+        epub.writestr("OEBPS/content.opf",
+                      '<?xml version="1.0" encoding="utf-8"?>\n'
+                      '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="book-id">\n'
+                      '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">\n'
+                      f'<dc:identifier id="book-id">urn:uuid:{uuid.uuid4()}</dc:identifier>\n'
+                      f"<dc:title>{xml_text(title)}</dc:title>\n<dc:language>es</dc:language>\n"
+                      f'<meta property="dcterms:modified">{time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}</meta>\n'
+                      "</metadata>\n<manifest>\n"
+                      '<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>\n'
+                      f"{manifest}</manifest>\n<spine>\n{spine}</spine>\n</package>\n")
+
+
+DOCX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+    '<Override PartName="/word/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.styles+xml"/>'
+    "</Types>"
+)
+DOCX_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>'
+    "</Relationships>"
+)
+DOCX_DOCUMENT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+    "</Relationships>"
+)
+DOCX_STYLES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<w:styles xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+    '<w:style w:type="paragraph" w:default="1" w:styleId="Normal"><w:name w:val="Normal"/>'
+    '<w:pPr><w:spacing w:after="160"/><w:jc w:val="both"/></w:pPr></w:style>'
+    '<w:style w:type="paragraph" w:styleId="Title"><w:name w:val="Title"/><w:basedOn w:val="Normal"/>'
+    '<w:pPr><w:jc w:val="center"/></w:pPr><w:rPr><w:b/><w:sz w:val="48"/></w:rPr></w:style>'
+    '<w:style w:type="paragraph" w:styleId="Heading1"><w:name w:val="heading 1"/><w:basedOn w:val="Normal"/>'
+    '<w:pPr><w:keepNext/><w:spacing w:before="360"/><w:outlineLvl w:val="0"/></w:pPr><w:rPr><w:b/><w:sz w:val="32"/></w:rPr></w:style>'
+    '<w:style w:type="paragraph" w:styleId="Heading2"><w:name w:val="heading 2"/><w:basedOn w:val="Normal"/>'
+    '<w:pPr><w:keepNext/><w:outlineLvl w:val="1"/></w:pPr><w:rPr><w:b/><w:sz w:val="26"/></w:rPr></w:style>'
+    "</w:styles>"
+)
+
+
+def docx_paragraph(text, style=None, italic=False, page_break=False):
+    properties = f'<w:pPr><w:pStyle w:val="{style}"/>{"<w:pageBreakBefore/>" if page_break else ""}</w:pPr>' if style else ""
+    run_properties = "<w:rPr><w:i/></w:rPr>" if italic else ""
+    return f'<w:p>{properties}<w:r>{run_properties}<w:t xml:space="preserve">{xml_text(text)}</w:t></w:r></w:p>'
+
+
+# DOCX: a single document.xml streamed into the archive chapter by chapter
+def write_docx(state, out, include_notes=False):
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as docx:
+        docx.writestr("[Content_Types].xml", DOCX_CONTENT_TYPES)
+        docx.writestr("_rels/.rels", DOCX_RELS)
+        docx.writestr("word/_rels/document.xml.rels", DOCX_DOCUMENT_RELS)
+        docx.writestr("word/styles.xml", DOCX_STYLES)
+        with docx.open("word/document.xml", "w") as document:
+            def write(text):
+                document.write(text.encode("utf-8"))
+
+            write('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                  '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>')
+            write(docx_paragraph(novel_title(state), "Title"))
+            for heading, body in front_matter(state):
+                write(docx_paragraph(heading, "Heading1") + "".join(docx_paragraph(paragraph) for paragraph in body))
+            for number, title, description, notes, content in iter_chapters(state, include_notes):
+                write(docx_paragraph(f"Capítulo {number}: {title}", "Heading1", page_break=True))
+                if include_notes:
+                    write(docx_paragraph(description, italic=True))
+                    for label, body in notes:
+                        write(docx_paragraph(label, "Heading2") + "".join(docx_paragraph(paragraph) for paragraph in body))
+                write("".join(docx_paragraph(paragraph) for paragraph in content))
+            write("<w:sectPr/></w:body></w:document>")
+
+
+# Export formats: label, file extension, MIME type and writer(state, binary file, include_notes)
+FORMATS = {
+    "markdown": ("Markdown", "md", "text/markdown", write_markdown),
+    "epub": ("EPUB", "epub", "application/epub+zip", write_epub),
+    "docx": ("Word (DOCX)", "docx",
+             "application/vnd.openxmlformats-officedocument.wordprocessingml.document", write_docx),
+    "json": ("JSON comprimido", "json.gz", "application/gzip", write_json_gz),
+}
+
+
+# Write the novel in `fmt` to a spooled temporary file, rewound and ready to be read
+def export(state, fmt, include_notes=False):
+    writer = FORMATS[fmt][3]
+    out = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    writer(state, out, include_notes)
+    out.seek(0)
+    return out
+
+
+# The novel in `fmt` as bytes, for st.download_button's deferred data: Streamlit only accepts
+# bytes, str or a few io classes from it, and a spooled temporary file is none of them
+def export_bytes(state, fmt, include_notes=False):
+    with export(state, fmt, include_notes) as out:
+        return out.read()
+
+
+def file_name(state, fmt):
+    slug = re.sub(r"[^\w]+", "_", novel_title(state).lower()).strip("_") or "novela"
+    return f"{slug[:60]}.{FORMATS[fmt][1]}"
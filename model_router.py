@@ -0,0 +1,172 @@
+import threading
+import time
+from collections import deque
+
+import requests
+
+import retry_policy
+import telemetry
+
+# Rolling latency window per route: samples older than this are forgotten, so a model that
+# was demoted for being slow gets tried again later
+DEFAULT_WINDOW_SECONDS = 300.0
+# Samples needed before a route's p95 is trusted
+MIN_SAMPLES = 5
+# Attempts a model gets before falling back to the next one (the last model gets the full retry policy)
+DEFAULT_FALLBACK_ATTEMPTS = 2
+# Statuses that mean "this model cannot serve the request" rather than "the request is wrong":
+# out of credits for a paid model, or no provider currently serving it
+FALLBACK_STATUSES = {402, 404}
+
+# Stage -> route: {"models": [model, ...], "max_p95_seconds": seconds or None}.
+# Stages are the telemetry stage names (outline, characters, setting, plot_twist,
+# table_of_contents, chapter_content, chapter_conflict, chapter_scene, chapter_dialogue,
+# chapter_sub_plot, chapter_key_events, ...); "default" applies to every other stage.
+# Stages without a route use the engine's model.
+routes = {}
+# p95 threshold for routes that do not set their own (None = no latency-based fallback)
+max_p95_seconds = None
+window_seconds = DEFAULT_WINDOW_SECONDS
+fallback_attempts = DEFAULT_FALLBACK_ATTEMPTS
+
+
+# Accept a route as a model name, a list of model names, or {"models": [...], "max_p95_seconds": n}
+def parse_route(value):
+    if isinstance(value, str):
+        value = [value]
+    if isinstance(value, (list, tuple)):
+        value = {"models": list(value)}
+    models = [model for model in value.get("models", []) if model]
+    if not models:
+        raise ValueError("Una ruta de modelos necesita al menos un modelo.")
+    threshold = value.get("max_p95_seconds")
+    return {"models": models, "max_p95_seconds": float(threshold) if threshold else None}
+
+
+def configure(stage_routes=None, p95_threshold=None, window=None, attempts=None):
+    global routes, max_p95_seconds, window_seconds, fallback_attempts
+    if stage_routes is not None:
+        routes = {stage: parse_route(value) for stage, value in stage_routes.items()}
+    if p95_threshold is not None:
+        max_p95_seconds = p95_threshold or None
+    if window is not None:
+        window_seconds = window
+    if attempts is not None:
+        fallback_attempts = attempts
+
+
+def route_for(stage):
+    label = telemetry.stage_label(stage)
+    return routes.get(label) or routes.get("default")
+
+
+# Rolling latency and outcome record of one (stage, model) route
+class RouteStats:
+    def __init__(self):
+        self.samples = deque()
+        self.calls = 0
+        self.errors = 0
+        self.fallbacks = 0
+
+    def _expire(self, now):
+        while self.samples and now - self.samples[0][0] > window_seconds:
+            self.samples.popleft()
+
+    def p95(self, now):
+        self._expire(now)
+        if len(self.samples) < MIN_SAMPLES:
+            return None
+        ordered = sorted(seconds for _, seconds in self.samples)
+        return ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))]
+
+
+_stats = {}
+_lock = threading.Lock()
+
+
+def _route_stats(stage, model):
+    return _stats.setdefault((telemetry.stage_label(stage), model), RouteStats())
+
+
+# Models to try for a stage, in order. A model whose rolling p95 is over the route's threshold
+# goes behind the others (it is still used if every model is over it).
+def candidates(stage, default_model):
+    route = route_for(stage)
+    if route is None:
+        return [default_model]
+    threshold = route["max_p95_seconds"] or max_p95_seconds
+    if not threshold:
+        return list(route["models"])
+    now = time.monotonic()
+    with _lock:
+        slow = {model for model in route["models"] if (_route_stats(stage, model).p95(now) or 0) > threshold}
+    if slow:
+        for model in slow:
+            telemetry.increment("llm_route_demotions_total", stage=telemetry.stage_label(stage), model=model)
+    return [model for model in route["models"] if model not in slow] + [model for model in route["models"] if model in slow]
+
+
+# Model a hedged duplicate of a call to `model` is sent to (see hedging): the next model on
+# the stage's route, or the same model when the route has no other
+def hedge_model(stage, model):
+    route = route_for(stage)
+    models = route["models"] if route else []
+    if model in models and len(models) > 1:
+        return models[(models.index(model) + 1) % len(models)]
+    return model
+
+
+# Record a call that went upstream: its wall time, including retries, and whether it failed.
+# Failures count as samples too, so a model timing out is also a slow model.
+def observe(stage, model, seconds, error=None):
+    now = time.monotonic()
+    with _lock:
+        stats = _route_stats(stage, model)
+        stats.calls += 1
+        if error is not None:
+            stats.errors += 1
+        stats.samples.append((now, seconds))
+        stats._expire(now)
+
+
+# Whether a failed call should go on to the next model: the provider kept failing (after this
+# model's retries) or cannot serve this model. Not when the circuit is open (every model would
+# be rejected too) or the request itself is wrong.
+def should_fall_back(err):
+    if isinstance(err, retry_policy.CircuitOpenError):
+        return False
+    if retry_policy.is_retryable(err):
+        return True
+    return isinstance(err, requests.exceptions.HTTPError) and retry_policy.error_status(err) in FALLBACK_STATUSES
+
+
+def record_fallback(stage, model, err):
+    with _lock:
+        _route_stats(stage, model).fallbacks += 1
+    telemetry.increment("llm_model_fallbacks_total", stage=telemetry.stage_label(stage), model=model,
+                        reason=retry_policy.error_reason(err))
+
+
+# Per-route rolling latency figures for display
+def snapshot():
+    now = time.monotonic()
+    with _lock:
+        rows = []
+        for (stage, model), stats in sorted(_stats.items()):
+            stats._expire(now)
+            ordered = sorted(seconds for _, seconds in stats.samples)
+            route = routes.get(stage) or routes.get("default")
+            threshold = (route or {}).get("max_p95_seconds") or max_p95_seconds
+            p95 = stats.p95(now)
+            rows.append({
+                "stage": stage,
+                "model": model,
+                "calls": stats.calls,
+                "errors": stats.errors,
+                "fallbacks": stats.fallbacks,
+                "window_samples": len(ordered),
+                "p50": ordered[len(ordered) // 2] if ordered else None,
+                "p95": p95,
+                "demoted": bool(threshold and p95 is not None and p95 > threshold),
+            })
+    return rows
@@ -0,0 +1,1271 @@
+import json
+from functools import partial
+
+import requests
+from tenacity import retry
+
+import bulk_generation
+import cancellation
+import context_budget
+import dependency_graph
+import hedging
+import http_client
+import json_repair
+import json_stream
+import long_form
+import model_router
+import prompt_layout
+import request_scheduler
+import response_cache
+import retry_policy
+import single_flight
+import telemetry
+
+# Novel generation engine.
+# Everything here works on a plain mapping `state` with the keys below, so the same
+# functions drive the Streamlit app (which passes st.session_state) and the headless
+# batch CLI (which passes a dict). Nothing in this module imports Streamlit.
+
+# API configuration (see configure)
+api_url = "https://openrouter.ai/api/v1/chat/completions"
+api_model = "mistralai/devstral-small:free"
+headers = {"Content-Type": "application/json"}
+context_token_budget = context_budget.DEFAULT_BUDGET
+# Size of the continuity memory added to each chapter content prompt
+continuity_token_budget = context_budget.DEFAULT_CONTINUITY_BUDGET
+CONTINUITY_MEMORY_WORDS = 250
+# Length of a chapter's content, in words
+DEFAULT_CHAPTER_WORDS = 1200
+chapter_words = DEFAULT_CHAPTER_WORDS
+# Whether chapters are written as scene beats drafted in parallel (see write_long_chapter):
+# True, False or "auto" (chapters longer than LONG_FORM_MIN_WORDS words)
+LONG_FORM_MIN_WORDS = 2000
+long_form_chapters = "auto"
+# Length of the transition written between two beats
+BRIDGE_WORDS = 40
+llm_cache = None
+# JSON-schema response_format for outline/characters/TOC: True, False or "auto" (ask OpenRouter
+# whether the model supports structured outputs)
+structured_output = "auto"
+_structured_support = {}
+
+DEFAULT_THEME = "Guerra de Independencia Española"
+
+
+# Raised when a generation step cannot run or the API returned unusable content.
+# The message is ready to show to the user.
+class GenerationError(Exception):
+    pass
+
+
+# Configure the engine. Only the given settings change, so this is cheap to call on every rerun.
+def configure(api_key=None, model=None, url=None, token_budget=None, cache=None, max_concurrent_requests=None,
+              structured=None, continuity_budget=None, words=None, long_form=None):
+    global api_url, api_model, context_token_budget, llm_cache, structured_output, continuity_token_budget
+    global chapter_words, long_form_chapters
+    if api_key is not None:
+        headers["Authorization"] = f"Bearer {api_key}"
+    if model is not None:
+        api_model = model
+    if url is not None:
+        api_url = url
+    if token_budget is not None:
+        context_token_budget = token_budget
+    if cache is not None:
+        llm_cache = cache
+    if max_concurrent_requests is not None:
+        request_scheduler.configure(max_in_flight=max_concurrent_requests)
+    if structured is not None:
+        structured_output = structured
+    if continuity_budget is not None:
+        continuity_token_budget = continuity_budget
+    if words is not None:
+        chapter_words = words
+    if long_form is not None:
+        long_form_chapters = long_form
+
+
+# Novel state with every key the engine reads or writes
+def new_state(theme="", num_chapters=25, narrative_technique=None, narrator_pov=None):
+    return {
+        "novel_outline_data": None,
+        "characters_data": None,
+        "setting_details": None,
+        "plot_twist_data": None,
+        "chapters_data": None,
+        "chapter_contents": {},
+        "chapter_conflicts": {},
+        "chapter_scene_descriptions": {},
+        "chapter_dialogue_snippets": {},
+        "chapter_sub_plot_ideas": {},
+        "chapter_key_events": {},
+        "user_theme": theme,
+        "num_chapters": num_chapters,
+        "narrative_technique": narrative_technique,
+        "narrator_pov": narrator_pov,
+        "context_summaries": {},
+        "context_reports": {},
+        "artifact_inputs": {},
+        "continuity_memory": {},
+    }
+
+
+# Retry decorator for API calls (policy in retry_policy: only transient errors are retried,
+# with jittered exponential backoff or the provider's Retry-After, behind a circuit breaker)
+# With stream=True the request is sent with OpenRouter's `stream: true` and a generator
+# of text deltas is returned; retries only cover opening the stream.
+# `call` (a telemetry.Call) receives the attempt count and the usage block, which
+# OpenRouter includes (with cost) when asked for usage accounting.
+# Each attempt waits its turn in the request scheduler; backoff sleeps do not hold a slot.
+@retry(retry=retry_policy.should_retry, stop=retry_policy.should_stop, wait=retry_policy.wait_time,
+       sleep=retry_policy.sleep, before_sleep=retry_policy.before_sleep, retry_error_callback=retry_policy.give_up)
+def send_api_request(payload, stream=False, call=None):
+    if call is not None:
+        call.attempts += 1
+    payload = {**payload, "usage": {"include": True}}
+    if stream:
+        response = retry_policy.guarded_call(partial(scheduled_post, {**payload, "stream": True}, stream=True))
+        return request_scheduler.scheduler.hold_stream(
+            http_client.iter_stream_content(response, on_usage=call.record_usage if call is not None else None))
+    response = retry_policy.guarded_call(partial(scheduled_post, payload))
+    result = response.json()
+    if call is not None:
+        call.record_usage(result.get("usage"))
+    return result
+
+
+# Helper function to post a payload and raise for HTTP error statuses
+def post_checked(payload, stream=False):
+    response = http_client.post_json(api_url, headers, payload, stream=stream)
+    try:
+        response.raise_for_status()
+    except requests.exceptions.HTTPError:
+        response.close()
+        raise
+    return response
+
+
+# Helper function to post one attempt once the request scheduler dispatches it.
+# A streamed response keeps its scheduler slot until the stream is read to the end or closed
+# (see send_api_request); a plain one has been read in full when post_checked returns.
+def scheduled_post(payload, stream=False):
+    request_scheduler.scheduler.acquire()
+    try:
+        response = post_checked(payload, stream=stream)
+    except BaseException:
+        request_scheduler.scheduler.release()
+        raise
+    if not stream:
+        request_scheduler.scheduler.release()
+    return response
+
+
+# Helper generator that opens a stream on first iteration, so that opening errors surface
+# (and are recorded) where the chunks are read
+def open_stream(payload, call=None):
+    yield from send_api_request(payload, stream=True, call=call)
+
+
+# Identical requests running at the same time (a double click, two tabs of one project,
+# every session's default outline) share one upstream call
+in_flight = single_flight.SingleFlight()
+
+
+# Function to make an API call for a stage, on the models its route lists (see model_router).
+# Each model is tried in turn while the failure is one another model could avoid; a stream
+# only falls back if it failed before its first chunk.
+# use_cache=False skips the lookup (explicit "regenerate") but still stores the fresh response.
+# `stage` names the call in telemetry and routing, e.g. "characters" or "chapter_content_7".
+def make_api_request(payload, stream=False, use_cache=True, stage=None):
+    models = model_router.candidates(stage, payload["model"])
+    if stream:
+        return stream_with_fallback(payload, models, use_cache, stage)
+    for position, model in enumerate(models):
+        call = telemetry.start_call(stage, model)
+        try:
+            with retry_policy.limit_attempts(model_router.fallback_attempts if position < len(models) - 1 else None):
+                result = make_model_request(model_payload(payload, model), call, use_cache=use_cache)
+        except Exception as err:
+            observe_route(stage, model, call, err)
+            if position == len(models) - 1 or not model_router.should_fall_back(err):
+                raise
+            model_router.record_fallback(stage, model, err)
+            continue
+        observe_route(stage, model, call)
+        return result
+
+
+def stream_with_fallback(payload, models, use_cache, stage):
+    for position, model in enumerate(models):
+        call = telemetry.start_call(stage, model, streamed=True)
+        with retry_policy.limit_attempts(model_router.fallback_attempts if position < len(models) - 1 else None):
+            chunks = make_model_request(model_payload(payload, model), call, stream=True, use_cache=use_cache)
+        started = False
+        try:
+            for chunk in chunks:
+                started = True
+                yield chunk
+        except Exception as err:
+            observe_route(stage, model, call, err)
+            if started or position == len(models) - 1 or not model_router.should_fall_back(err):
+                raise
+            model_router.record_fallback(stage, model, err)
+            continue
+        finally:
+            chunks.close()
+        observe_route(stage, model, call)
+        return
+
+
+# Helper function to feed a finished call's latency to its route (calls answered locally,
+# by another caller's request or given up by their caller say nothing about the model)
+def observe_route(stage, model, call, error=None):
+    if isinstance(error, cancellation.Cancelled):
+        return
+    if not (call.cache_hit or call.coalesced) and call.wall is not None:
+        model_router.observe(stage, model, call.wall, error)
+
+
+# The payload as sent to one model: without the response_format if the model cannot honour
+# it, and with a prompt-cache breakpoint if its provider needs one
+def model_payload(payload, model):
+    payload = {**payload, "model": model}
+    if "response_format" in payload and not uses_structured_output(model):
+        del payload["response_format"]
+    if prompt_layout.uses_cache_control(model):
+        payload["messages"] = prompt_layout.with_cache_hint(payload["messages"])
+    return payload
+
+
+# Function to make an API call to the payload's model through the response cache and
+# in-flight deduplication, recording it on `call`. A call slower than its stage usually is
+# may be raced against a duplicate (see hedging).
+def make_model_request(payload, call, stream=False, use_cache=True):
+    key = response_cache.request_key(payload)
+    if llm_cache is not None:
+        if use_cache:
+            cached = llm_cache.get(key)
+            if cached is not None:
+                call.cache_hit = True
+                call.finish()
+                content = cached["choices"][0]["message"]["content"]
+                return (chunk for chunk in [content]) if stream else cached
+        else:
+            llm_cache.record_bypass()
+    if stream:
+        open_chunks = partial(hedging.stream, call.stage, partial(open_stream, payload, call),
+                              partial(open_hedge_stream, payload, call), partial(hedge_won, payload, call))
+        chunks, call.coalesced = in_flight.stream(key, open_chunks,
+                                                  on_complete=partial(cache_streamed_content, payload, call))
+        return telemetry.instrument_stream(call, chunks)
+    try:
+        send = partial(hedging.call, call.stage, partial(send_api_request, payload, call=call),
+                       partial(send_hedge, payload, call), partial(hedge_won, payload, call))
+        result, call.coalesced = in_flight.call(key, send)
+    except Exception as err:
+        call.finish(err)
+        raise
+    call.finish()
+    if llm_cache is not None and not call.coalesced and validate_api_response(result)[1] is None:
+        llm_cache.put(answer_key(payload, call), result)
+    return result
+
+
+# Helper function to send the duplicate of a late call (see hedging) to the model its route
+# names for hedges; the duplicate is recorded as a call of its own
+def send_hedge(payload, call):
+    hedge = telemetry.start_call(call.stage, model_router.hedge_model(call.stage, payload["model"]))
+    try:
+        result = send_api_request(model_payload(payload, hedge.model), call=hedge)
+    except Exception as err:
+        hedge.finish(err)
+        raise
+    hedge.finish()
+    return result
+
+
+def open_hedge_stream(payload, call):
+    hedge = telemetry.start_call(call.stage, model_router.hedge_model(call.stage, payload["model"]), streamed=True)
+    return telemetry.instrument_stream(hedge, open_stream(model_payload(payload, hedge.model), hedge))
+
+
+# Helper function to note that a call was answered by its duplicate, which may have gone to
+# another model
+def hedge_won(payload, call):
+    call.answered_by = model_router.hedge_model(call.stage, payload["model"])
+
+
+# Cache key of a call's answer: a duplicate that won on another model answered its own payload,
+# so the answer is cached under that payload's key rather than as the original model's
+def answer_key(payload, call):
+    if call.answered_by == payload["model"]:
+        return response_cache.request_key(payload)
+    return response_cache.request_key(model_payload(payload, call.answered_by))
+
+
+# Helper function to cache the text of a stream that completed (an abandoned or failed one is not)
+def cache_streamed_content(payload, call, content):
+    if content.strip() and llm_cache is not None:
+        llm_cache.put(answer_key(payload, call), {"choices": [{"message": {"role": "assistant", "content": content}}]})
+
+
+# Chat payload for a prompt. With a schema (and structured output enabled) the answer is
+# constrained with a JSON-schema response_format, dropped for models without support (see
+# model_payload); arrays are wrapped as {"items": [...]} since providers require an object at the root.
+# `prefix` is context shared by many calls (see novel_bible), sent first so the provider can
+# reuse its cached prefill (see prompt_layout).
+def chat_payload(prompt, schema=None, schema_name="respuesta", prefix=None):
+    payload = {"model": api_model, "messages": prompt_layout.layout(prompt, prefix)}
+    if schema is not None and structured_output:
+        if schema["type"] == "array":
+            schema = {"type": "object", "properties": {"items": schema}, "required": ["items"], "additionalProperties": False}
+        payload["response_format"] = {"type": "json_schema",
+                                      "json_schema": {"name": schema_name, "strict": True, "schema": provider_schema(schema)}}
+    return payload
+
+
+# Helper function to drop the schema keywords strict mode rejects (item counts are checked locally)
+def provider_schema(schema):
+    if isinstance(schema, dict):
+        return {key: provider_schema(value) for key, value in schema.items() if key not in ("minItems", "maxItems")}
+    return schema
+
+
+# Helper function to tell whether a model (by default the configured one) accepts a JSON-schema
+# response_format. In "auto" mode OpenRouter's model list is asked once per model; any failure means no.
+def uses_structured_output(model=None):
+    model = model or api_model
+    if structured_output != "auto":
+        return bool(structured_output)
+    if model not in _structured_support:
+        try:
+            models_url = api_url.rsplit("/chat/completions", 1)[0] + "/models"
+            response = http_client.get_session().get(models_url, headers=headers, timeout=http_client.get_timeout())
+            response.raise_for_status()
+            listed = next((m for m in response.json().get("data", []) if m.get("id") == model), {})
+            _structured_support[model] = "structured_outputs" in (listed.get("supported_parameters") or [])
+        except (requests.exceptions.RequestException, ValueError, AttributeError):
+            _structured_support[model] = False
+    return _structured_support[model]
+
+
+# Helper function to validate API response
+def validate_api_response(result):
+    if not (result.get("choices") and isinstance(result["choices"], list) and
+            result["choices"][0].get("message") and
+            result["choices"][0]["message"].get("content")):
+        return None, "Respuesta de la API inválida o vacía."
+    return result["choices"][0]["message"]["content"], None
+
+
+# Helper function to ensure em-dash dialogue
+def ensure_em_dash_dialogue(text):
+    return text.replace('"', '—')
+
+
+# Helper function to run a non-streamed request and return its validated content.
+# Safe to call from worker threads: it does not touch the novel state.
+def request_content(payload, use_cache=True, stage=None):
+    return request_completion(payload, use_cache=use_cache, stage=stage)[0]
+
+
+# Helper function like request_content that also returns the response's finish_reason
+# ("length" if the model hit its output limit; None if the provider did not say)
+def request_completion(payload, use_cache=True, stage=None):
+    result = make_api_request(payload, use_cache=use_cache, stage=stage)
+    content, error = validate_api_response(result)
+    if error:
+        raise ValueError(error)
+    return content, result["choices"][0].get("finish_reason")
+
+
+def request_within_deadline(payload, use_cache=True, stage=None):
+    with cancellation.deadline_scope():
+        return request_content(payload, use_cache=use_cache, stage=stage)
+
+
+# Helper function to get the text of a streamed generation.
+# `render` receives the chunk iterator and returns the assembled text (the app draws it
+# as it arrives); without it the stream is simply joined.
+def stream_content(payload, use_cache=True, transform=None, render=None, stage=None):
+    return render_chunks(make_api_request(payload, stream=True, use_cache=use_cache, stage=stage), transform, render)
+
+
+def render_chunks(chunks, transform=None, render=None):
+    if transform:
+        chunks = (transform(chunk) for chunk in chunks)
+    content = render(chunks) if render else "".join(chunks)
+    if not isinstance(content, str) or not content.strip():
+        raise GenerationError("Respuesta de la API inválida o vacía.")
+    return content
+
+
+def is_raw(value):
+    return isinstance(value, dict) and "raw_content" in value
+
+
+# Context sections shared by several prompts that may be condensed when over budget
+CONTEXT_SECTION_LABELS = {
+    "plot": "la trama general de la novela",
+    "setting": "la ambientación de la novela",
+    "twists": "los giros argumentales de la novela",
+}
+
+
+# Helper function to condense a long context section once and reuse the summary for every later prompt
+def summarize_context_section(state, name, text):
+    key = context_budget.section_fingerprint(name, text)
+    summaries = state["context_summaries"]
+    if key not in summaries:
+        prompt = f"""
+    Resume el siguiente texto sobre {CONTEXT_SECTION_LABELS[name]} en unas {context_budget.SUMMARY_WORDS} palabras.
+    Conserva nombres, lugares, fechas y hechos relevantes para la trama. Responde solo con el resumen, sin introducciones.
+    Texto: {text}
+    """
+        try:
+            summaries[key] = request_content(chat_payload(prompt), stage=f"context_summary_{name}")
+        except cancellation.Cancelled:
+            raise
+        except Exception:
+            # Fall back to the full text; the prompt is over budget but still correct
+            return None
+    return summaries[key]
+
+
+# Helper function to assemble the shared novel context within the per-call token budget.
+# Returns {section name: text} and records the tokens saved for `stage`.
+def budget_novel_context(state, stage):
+    sections = [
+        ("synthesis", state["novel_outline_data"]["synthesis"], False),
+        ("plot", state["novel_outline_data"]["plot"], True),
+        ("setting", state["setting_details"] or "", True),
+        ("twists", state["plot_twist_data"] or "", True),
+    ]
+    texts, report = context_budget.fit_sections(sections, context_token_budget, partial(summarize_context_section, state))
+    state["context_reports"][stage] = report
+    return texts
+
+
+# Schemas of the JSON artifacts, used for the response_format and for local validation
+OUTLINE_SCHEMA = {
+    "type": "object",
+    "properties": {"synthesis": {"type": "string"}, "description": {"type": "string"}, "plot": {"type": "string"}},
+    "required": ["synthesis", "description", "plot"],
+    "additionalProperties": False,
+}
+CHARACTERS_SCHEMA = {
+    "type": "array",
+    "minItems": 1,
+    "items": {
+        "type": "object",
+        "properties": {"name": {"type": "string"}, "role": {"type": "string"}, "description": {"type": "string"}},
+        "required": ["name", "role", "description"],
+        "additionalProperties": False,
+    },
+}
+
+
+def table_of_contents_schema(num_chapters):
+    return {
+        "type": "array",
+        "minItems": num_chapters,
+        "items": {
+            "type": "object",
+            "properties": {"title": {"type": "string"}, "description": {"type": "string"}},
+            "required": ["title", "description"],
+            "additionalProperties": False,
+        },
+    }
+
+
+# Opening bracket to look for in a response: array artifacts may come wrapped in {"items": [...]}
+def json_expect(schema):
+    return "[" if schema["type"] == "array" else "{"
+
+
+# Helper function to parse a JSON response and check it against its schema; raises ValueError
+def parse_valid_json(content, schema):
+    value = json_stream.parse(content, json_expect(schema))
+    errors = json_repair.validate(value, schema)
+    if errors:
+        raise ValueError("; ".join(errors[:5]))
+    return value
+
+
+# Helper function to try the local repairs of a broken JSON text; returns the first valid value or None
+def repair_json_locally(content, schema):
+    for candidate in json_repair.repair_candidates(content, json_expect(schema)):
+        try:
+            return parse_valid_json(candidate, schema)
+        except ValueError:
+            continue
+    return None
+
+
+# Helper function to recover a JSON artifact that failed to parse or validate, cheapest way first:
+# local repairs of the text, then one small "fix this JSON" call instead of re-running the whole
+# prompt. Outcomes are counted in telemetry (json_repairs_total by outcome, calls and tokens saved).
+# Returns the value, or None if nothing worked.
+def repair_json_artifact(content, schema, error, payload, stage, use_cache):
+    value = repair_json_locally(content, schema)
+    if value is not None:
+        telemetry.increment("json_repairs_total", stage=stage, outcome="local")
+        telemetry.increment("json_repair_calls_saved_total", stage=stage)
+        return value
+
+    fix_prompt = f"""
+    El siguiente texto debía ser un JSON válido conforme al esquema indicado, pero tiene errores: {error}.
+    Esquema: {json.dumps(provider_schema(schema), ensure_ascii=False)}{f" Debe contener al menos {schema['minItems']} elementos." if schema.get('minItems', 0) > 1 else ""}
+    Corrige el siguiente JSON sin cambiar su contenido: completa lo que falte, corrige la sintaxis y devuelve SOLO el JSON corregido, sin texto adicional ni bloques de código (```).
+    JSON: {content}
+    """
+    try:
+        fixed = request_content(chat_payload(fix_prompt, schema), use_cache=use_cache, stage=f"{stage}_json_fix")
+    except (ValueError, requests.exceptions.RequestException):
+        fixed = None
+    value = None
+    if fixed is not None:
+        try:
+            value = parse_valid_json(fixed, schema)
+        except ValueError:
+            value = repair_json_locally(fixed, schema)
+    if value is None:
+        telemetry.increment("json_repairs_total", stage=stage, outcome="failed")
+        return None
+    original_tokens = context_budget.estimate_tokens(prompt_layout.prompt_text(payload)) if payload else 0
+    telemetry.increment("json_repairs_total", stage=stage, outcome="fix_call")
+    telemetry.increment("json_repair_prompt_tokens_saved_total",
+                        max(0, original_tokens - context_budget.estimate_tokens(fix_prompt)), stage=stage)
+    return value
+
+
+# Helper function to store a JSON response that matches `schema`, repairing it if needed.
+# If it cannot be recovered the raw text is kept under `key` and GenerationError is raised.
+# `parse` returns the parsed value or raises ValueError (json.JSONDecodeError included).
+def store_json_artifact(state, key, content, schema, payload=None, stage=None, use_cache=True, parse=None):
+    try:
+        parsed_json = parse(content) if parse else json_stream.parse(content, json_expect(schema))
+        errors = json_repair.validate(parsed_json, schema)
+        if errors:
+            raise ValueError("; ".join(errors[:5]))
+    except ValueError as e:
+        parsed_json = repair_json_artifact(content, schema, e, payload, stage or key, use_cache)
+        if parsed_json is None:
+            state[key] = {"raw_content": content}
+            raise GenerationError(f"El contenido recibido de la API no es un JSON válido: {str(e)}. Contenido: {content}")
+    state[key] = parsed_json
+    record_artifact(state, key)
+
+
+# Helper function to stream a JSON array response, passing each element to on_item(item, position)
+# as soon as it is complete, then store it like store_json_artifact (without parsing it again)
+def stream_json_artifact(state, key, payload, schema, use_cache=True, on_item=None, stage=None):
+    parser = json_stream.JsonStreamParser("[")
+    parts = []
+    parse_error = None
+    for chunk in make_api_request(payload, stream=True, use_cache=use_cache, stage=stage):
+        parts.append(chunk)
+        if parse_error is None:
+            try:
+                items = parser.feed(chunk)
+            except ValueError as err:
+                # Keep reading so the raw text is complete for the user
+                parse_error = err
+                continue
+            for item in items:
+                if on_item:
+                    on_item(item, len(parser.items) - 1)
+    content = "".join(parts)
+    if not content.strip():
+        raise GenerationError("Respuesta de la API inválida o vacía.")
+
+    def parsed_value(_):
+        if parse_error is not None:
+            raise parse_error
+        return parser.result()
+    store_json_artifact(state, key, content, schema, payload, stage, use_cache, parse=parsed_value)
+
+
+# Function to generate initial novel outline
+def generate_initial_outline(state, use_cache=True, progress=None):
+    state["novel_outline_data"] = None
+
+    theme = state["user_theme"].strip()
+    if not theme:
+        theme = "una novela histórica de aventuras ambientada en la Guerra de Independencia Española (1808-1814), con un protagonista que lucha contra la ocupación napoleónica, intrigas, resistencia popular, y una visión realista de la época."
+    elif len(theme) > 500:
+        raise GenerationError("El tema de la novela es demasiado largo. Usa menos de 500 caracteres.")
+    else:
+        theme = f"una novela histórica de aventuras ambientada en {theme}. La novela debe presentar un protagonista fuerte, intrigas, y una visión realista de la época."
+
+    prompt = f"""
+    Genera la síntesis, la descripción y la trama de {theme}. La respuesta debe ser un objeto JSON válido con las propiedades 'synthesis', 'description' y 'plot'.
+    Asegúrate de que la respuesta contenga SOLO el objeto JSON, sin texto adicional, explicaciones ni bloques de código (```). Ejemplo:
+    {{"synthesis": "Una novela...", "description": "Ambientada en...", "plot": "La historia sigue..."}}.
+    """
+    payload = chat_payload(prompt, OUTLINE_SCHEMA, "esquema")
+    result = make_api_request(payload, use_cache=use_cache, stage="outline")
+    if progress:
+        progress(50)
+    content, error = validate_api_response(result)
+    if error:
+        raise GenerationError(error)
+    store_json_artifact(state, "novel_outline_data", content, OUTLINE_SCHEMA, payload, "outline", use_cache)
+    if progress:
+        progress(100)
+
+
+# Function to generate main characters.
+# The response is streamed; on_item(character, position) is called as each character completes.
+def generate_characters(state, use_cache=True, on_item=None):
+    state["characters_data"] = None
+
+    if not (state["novel_outline_data"] and state["narrative_technique"] and state["narrator_pov"]):
+        raise GenerationError("Genera primero el esquema inicial y selecciona la técnica narrativa y el punto de vista.")
+
+    if is_raw(state["novel_outline_data"]):
+        raise GenerationError("El esquema inicial no se generó correctamente (JSON inválido). Genera el esquema nuevamente.")
+
+    outline = state["novel_outline_data"]
+    characters_prompt = f"""
+    Basándote en la siguiente información de la novela:
+    Síntesis General: {outline['synthesis']}
+    Trama General: {outline['plot']}
+    Técnica Narrativa: {state['narrative_technique']}
+    Punto de Vista del Narrador: {state['narrator_pov']}
+    Genera 3-5 personajes principales para esta novela. Para cada personaje, proporciona su nombre, su rol en la historia (ej. 'protagonista', 'antagonista', 'aliado', 'interés amoroso'), y una breve descripción de su personalidad y su relevancia para la trama.
+    Responde con un array JSON válido que contenga objetos con las propiedades 'name', 'role' y 'description'.
+    Asegúrate de que la respuesta contenga SOLO el array JSON, sin texto adicional, explicaciones ni bloques de código (```). Ejemplo:
+    [{{"name": "Juan", "role": "protagonista", "description": "Un joven valiente..."}}, {{"name": "Ana", "role": "aliado", "description": "Una estratega..."}}]
+    """
+    stream_json_artifact(state, "characters_data", chat_payload(characters_prompt, CHARACTERS_SCHEMA, "personajes"),
+                         CHARACTERS_SCHEMA, use_cache=use_cache, on_item=on_item, stage="characters")
+
+
+# Function to generate setting details
+def generate_setting_details(state, use_cache=True, render=None):
+    state["setting_details"] = None
+
+    if not (state["novel_outline_data"] and state["characters_data"] and
+            state["narrative_technique"] and state["narrator_pov"]):
+        raise GenerationError("Genera primero el esquema inicial, los personajes y selecciona la técnica narrativa y el punto de vista.")
+
+    if is_raw(state["characters_data"]):
+        raise GenerationError("Los personajes no se generaron correctamente (JSON inválido). Genera los personajes nuevamente.")
+
+    setting_prompt = f"""
+    Basándote en el tema de la novela: '{state['user_theme'].strip() or DEFAULT_THEME}',
+    la descripción general de la novela: '{state['novel_outline_data']['description']}',
+    la técnica narrativa: {state['narrative_technique']} y
+    el punto de vista del narrador: {state['narrator_pov']},
+    genera una descripción detallada de la ambientación o un aspecto histórico/cultural clave de la novela.
+    Incluye detalles sobre la atmósfera, la sociedad, la vida cotidiana, y elementos visuales relevantes. Aproximadamente 500-700 palabras.
+    """
+    state["setting_details"] = stream_content(chat_payload(setting_prompt), use_cache=use_cache, render=render, stage="setting")
+    record_artifact(state, "setting_details")
+
+
+# Function to generate plot twist
+def generate_plot_twist(state, use_cache=True, render=None):
+    state["plot_twist_data"] = None
+
+    if not (state["novel_outline_data"] and state["characters_data"] and
+            state["setting_details"] and state["narrative_technique"] and
+            state["narrator_pov"]):
+        raise GenerationError("Genera el esquema inicial, los personajes, la ambientación y selecciona la técnica narrativa y el punto de vista antes de generar giros argumentales.")
+
+    if is_raw(state["characters_data"]):
+        raise GenerationError("Los personajes no se generaron correctamente (JSON inválido). Genera los personajes nuevamente.")
+
+    context = budget_novel_context(state, "plot_twist")
+    plot_twist_prompt = f"""
+    Basándote en la síntesis general: "{context['synthesis']}",
+    la trama general: "{context['plot']}",
+    los personajes: {', '.join([char['name'] for char in state['characters_data']])},
+    la ambientación: "{context['setting']}",
+    la técnica narrativa: {state['narrative_technique']} y
+    el punto de vista del narrador: {state['narrator_pov']},
+    sugiere 1-2 giros argumentales sorprendentes y significativos para la novela.
+    Describe cómo podrían impactar la trama y los personajes. Aproximadamente 300-500 palabras.
+    """
+    state["plot_twist_data"] = stream_content(chat_payload(plot_twist_prompt), use_cache=use_cache, render=render,
+                                               stage="plot_twist")
+    record_artifact(state, "plot_twist_data")
+
+
+# Function to generate table of contents.
+# The response is streamed; on_item(chapter, position) is called as each chapter completes.
+def generate_table_of_contents(state, use_cache=True, on_item=None):
+    state["chapters_data"] = None
+
+    if not (state["novel_outline_data"] and state["characters_data"] and
+            state["setting_details"] and state["plot_twist_data"] and
+            state["narrative_technique"] and state["narrator_pov"]):
+        raise GenerationError("Genera el esquema inicial, los personajes, la ambientación, los giros argumentales y selecciona la técnica narrativa y el punto de vista antes de generar la tabla de contenidos.")
+
+    if is_raw(state["characters_data"]):
+        raise GenerationError("Los personajes no se generaron correctamente (JSON inválido). Genera los personajes nuevamente.")
+
+    if not 9 <= state["num_chapters"] <= 30:
+        raise GenerationError("El número de capítulos debe estar entre 9 y 30.")
+
+    chapters_prompt = f"""
+    Genera una tabla de contenidos para esta novela de {state['num_chapters']} capítulos.
+    Cada capítulo debe tener un título y una breve descripción de su contenido, siguiendo el estilo de una novela histórica de aventuras.
+    Responde con un array JSON válido que contenga objetos con las propiedades 'title' y 'description'.
+    Asegúrate de que la respuesta contenga SOLO el array JSON, sin texto adicional, explicaciones ni bloques de código (```). Ejemplo:
+    [{{"title": "El comienzo", "description": "El protagonista descubre..."}}, {{"title": "La traición", "description": "Un aliado revela..."}}]
+    """
+    schema = table_of_contents_schema(state["num_chapters"])
+    payload = chat_payload(chapters_prompt, schema, "tabla_de_contenidos", prefix=novel_bible(state))
+    stream_json_artifact(state, "chapters_data", payload, schema, use_cache=use_cache, on_item=on_item, stage="table_of_contents")
+
+
+# Function to build the novel bible: everything the table of contents and the chapter prompts
+# share, as one system prefix. It depends only on novel-level state (never on the chapter being
+# asked about), so it is byte-identical across every chapter call and the provider can serve its
+# prefill from the prompt cache. Long sections are condensed to the token budget once, and the
+# summaries are reused, so the text stays the same from call to call.
+def novel_bible(state):
+    context = budget_novel_context(state, "novel_bible")
+    characters = state["characters_data"]
+    characters = ', '.join(f"{char['name']} ({char['role']})" for char in characters) if isinstance(characters, list) else ''
+    return f"""
+    Eres el autor de una novela histórica de aventuras. Esta es la información de la novela:
+    Descripción General: {state['novel_outline_data']['description']}
+    Síntesis General: {context['synthesis']}
+    Trama General: {context['plot']}
+    Ambientación: {context['setting'] or 'No especificada'}
+    Personajes Principales: {characters or 'No especificados'}
+    Giros Argumentales: {context['twists'] or 'No especificados'}
+    Técnica Narrativa: {state['narrative_technique']}
+    Punto de Vista del Narrador: {state['narrator_pov']}
+    Mantén el tono y estilo coherentes con una novela histórica de aventuras y con esta información.
+    """
+
+
+# Helper function to describe the chapter a prompt is about; goes last in the prompt
+def chapter_heading(chapter, index):
+    return f"Capítulo {index + 1}: '{chapter['title']}' (descripción: '{chapter['description']}')"
+
+
+# Helper function to fold one written chapter into the continuity memory; None if the call fails
+def update_continuity_memory(state, index, memory, content):
+    chapter = chapter_entry(state["chapters_data"], index) or {"title": "", "description": ""}
+    prompt = f"""
+    Actualiza la memoria de continuidad de la novela con lo que ocurre en el capítulo indicado a continuación.
+    Conserva solo lo necesario para escribir los capítulos siguientes sin contradicciones, en unas {CONTINUITY_MEMORY_WORDS} palabras como máximo, con tres apartados:
+    Personajes y ubicación: dónde está y en qué situación queda cada personaje relevante.
+    Hilos abiertos: conflictos, promesas, misterios y objetivos pendientes.
+    Hechos establecidos: hechos, nombres, fechas y objetos que no deben contradecirse.
+    Responde solo con la memoria actualizada, sin introducciones.
+    Memoria anterior: {memory or 'Ninguna (es el primer capítulo escrito).'}
+    {chapter_heading(chapter, index)}
+    Texto del capítulo: {content}
+    """
+    try:
+        updated = request_content(chat_payload(prompt, prefix=novel_bible(state)), stage=f"continuity_memory_{index}")
+    except cancellation.Cancelled:
+        raise
+    except Exception:
+        return None
+    return context_budget.truncate_tokens(updated.strip(), continuity_token_budget)
+
+
+# Function to get the continuity memory of the chapters written before `index`: who is where,
+# open threads and established facts, kept as a rolling summary that each written chapter updates
+# in turn, so the content prompt carries a bounded memory instead of the earlier chapters and
+# stays the same size from the first chapter to the last. Each chapter's update is saved with
+# a fingerprint of what it was made from (the memory before it and its text), so only chapters
+# that changed, and the ones after them, are folded in again. Texts are only read to fold them.
+def continuity_before(state, index):
+    memory = ""
+    contents = state["chapter_contents"]
+    memories = state["continuity_memory"]
+    for previous in range(index):
+        if previous not in contents:
+            continue
+        source = dependency_graph.fingerprint([memory, dependency_graph.fingerprint(chapter_text(contents, previous))])
+        entry = memories.get(str(previous))
+        if entry is None or entry["source"] != source:
+            updated = update_continuity_memory(state, previous, memory, contents[previous])
+            if updated is None:
+                # Keep going with the memory so far; this chapter is folded in on a later call
+                continue
+            entry = memories[str(previous)] = {"source": source, "memory": updated}
+        memory = entry["memory"]
+    return memory
+
+
+# Function to fold written chapters into the continuity memory as soon as they are stored, so
+# building a later chapter's prompt finds the memory ready instead of folding every chapter
+# before it first. Folds the chapters before `before`: by default the ones before the first
+# chapter not written yet (a parallel run writes them out of order, and a chapter folded ahead
+# of the ones before it would have to be folded again). No prompt reads the memory after the
+# last chapter, so that one is never folded.
+def advance_continuity(state, before=None):
+    chapters = state["chapters_data"]
+    count = len(chapters) if isinstance(chapters, list) else 0
+    if before is None:
+        before = next((index for index in range(count) if index not in state["chapter_contents"]), count)
+    continuity_before(state, min(before, count - 1))
+
+
+# Helper function to list a chapter's notes (its generated details) for the prompts that write it
+def chapter_notes(state, index):
+    return "\n    ".join([
+        f"Conflicto del Capítulo: {state['chapter_conflicts'].get(index, 'No especificado')}",
+        f"Descripción de Escena del Capítulo: {state['chapter_scene_descriptions'].get(index, 'No especificado')}",
+        f"Diálogo del Capítulo: {state['chapter_dialogue_snippets'].get(index, 'No especificado')}",
+        f"Subtramas del Capítulo: {state['chapter_sub_plot_ideas'].get(index, 'No especificadas')}",
+        f"Eventos Clave del Capítulo: {state['chapter_key_events'].get(index, 'No especificados')}",
+    ])
+
+
+# Function to build the chapter content prompt
+def build_chapter_content_prompt(state, chapter, index):
+    return f"""
+    Escribe el contenido completo del capítulo indicado a continuación. El capítulo debe tener aproximadamente {chapter_words} palabras y expandir su descripción, teniendo en cuenta sus apuntes.
+    Asegúrate de que el tono y estilo sean coherentes con una novela histórica de aventuras.
+    Asegúrate de que los diálogos utilicen rayas (guion largo '—') en lugar de comillas.
+    Continúa la historia de forma coherente con la memoria de lo ocurrido en los capítulos anteriores.
+    Memoria de continuidad: {continuity_before(state, index) or 'Es el primer capítulo escrito.'}
+    {chapter_heading(chapter, index)}
+    {chapter_notes(state, index)}
+    """
+
+
+# Function to build the chapter conflict prompt
+def build_chapter_conflict_prompt(state, chapter, index):
+    return f"""
+    Sugiere un conflicto o un obstáculo significativo que podría surgir en el capítulo indicado a continuación.
+    Describe la naturaleza del conflicto, sus posibles implicaciones para el protagonista y la trama dentro de este capítulo, y cómo podría resolverse o evolucionar.
+    Aproximadamente 300-500 palabras.
+    {chapter_heading(chapter, index)}
+    """
+
+
+# Function to build the chapter scene description prompt
+def build_chapter_scene_prompt(state, chapter, index):
+    return f"""
+    Genera una descripción detallada de una escena clave o un lugar significativo dentro del capítulo indicado a continuación.
+    Enfócate en los detalles sensoriales (vista, sonido, olfato, tacto), la atmósfera, y cómo el entorno influye en los personajes en esta escena.
+    Aproximadamente 500-700 palabras.
+    {chapter_heading(chapter, index)}
+    """
+
+
+# Function to build the chapter dialogue snippet prompt
+def build_chapter_dialogue_prompt(state, chapter, index):
+    return f"""
+    Genera un breve fragmento de diálogo (2-4 líneas) entre dos personajes relevantes para el capítulo indicado a continuación.
+    El diálogo debe ser relevante para la trama o los personajes en este punto de la historia, y debe utilizar rayas (guion largo '—') para indicar las intervenciones de los personajes, no comillas.
+    {chapter_heading(chapter, index)}
+    """
+
+
+# Function to build the chapter sub plot ideas prompt
+def build_chapter_sub_plot_prompt(state, chapter, index):
+    return f"""
+    Sugiere 1-2 ideas para subtramas que puedan enriquecer la narrativa principal en el capítulo indicado a continuación o en los siguientes.
+    Para cada idea, describe brevemente la subtrama y cómo podría conectarse con la historia principal o los personajes.
+    {chapter_heading(chapter, index)}
+    """
+
+
+# Function to build the chapter key events prompt
+def build_chapter_key_events_prompt(state, chapter, index):
+    return f"""
+    Sugiere 2-3 eventos clave o puntos de inflexión que deberían ocurrir en el capítulo indicado a continuación.
+    Describe brevemente cada evento y cómo contribuye al avance de la trama.
+    {chapter_heading(chapter, index)}
+    """
+
+
+# Per-chapter artifacts: session state dict, prompt builder, post-processing, button label,
+# whether it is streamed, what it is called in messages, and the failure message
+CHAPTER_ARTIFACTS = {
+    "key_events": ("chapter_key_events", build_chapter_key_events_prompt, None, "Eventos Clave", False,
+                   "eventos clave", "No se pudieron generar eventos clave"),
+    "conflict": ("chapter_conflicts", build_chapter_conflict_prompt, None, "Conflicto", False,
+                 "conflicto", "No se pudo generar el conflicto"),
+    "sub_plot": ("chapter_sub_plot_ideas", build_chapter_sub_plot_prompt, None, "Subtramas", False,
+                 "ideas de subtramas", "No se pudieron generar ideas de subtramas"),
+    "scene": ("chapter_scene_descriptions", build_chapter_scene_prompt, None, "Escena", True,
+              "descripción de escena", "No se pudo generar la descripción de escena"),
+    "dialogue": ("chapter_dialogue_snippets", build_chapter_dialogue_prompt, ensure_em_dash_dialogue, "Diálogo", False,
+                 "diálogo", "No se pudo generar el diálogo"),
+    "content": ("chapter_contents", build_chapter_content_prompt, ensure_em_dash_dialogue, "Contenido", True,
+                "contenido", "No se pudo generar el contenido"),
+}
+CHAPTER_DETAIL_ARTIFACTS = ["key_events", "conflict", "sub_plot", "scene", "dialogue"]
+
+
+# Helper function to check the shared preconditions of every per-chapter generation
+def check_chapter_preconditions(state):
+    if not (state["novel_outline_data"] and state["chapters_data"] and
+            state["narrative_technique"] and state["narrator_pov"]):
+        raise GenerationError("Genera primero el esquema de la novela, la tabla de contenidos y selecciona la técnica narrativa y el punto de vista.")
+
+    if is_raw(state["chapters_data"]):
+        raise GenerationError("La tabla de contenidos no se generó correctamente (JSON inválido). Genera la tabla nuevamente.")
+
+
+def chapter_payload(state, artifact, index):
+    build_prompt = CHAPTER_ARTIFACTS[artifact][1]
+    return chat_payload(build_prompt(state, state["chapters_data"][index], index), prefix=novel_bible(state))
+
+
+def store_chapter_artifact(state, artifact, index, content):
+    state_key, _, transform = CHAPTER_ARTIFACTS[artifact][:3]
+    state[state_key][index] = transform(content) if transform else content
+    record_artifact(state, state_key, index)
+
+
+# Whether chapter contents are written as scene beats (see write_long_chapter)
+def uses_long_form():
+    if long_form_chapters == "auto":
+        return chapter_words > LONG_FORM_MIN_WORDS
+    return bool(long_form_chapters)
+
+
+# What writing one chapter's content needs from the state, gathered on the calling thread so
+# that the API calls can run on workers
+class ChapterBrief:
+    def __init__(self, state, index):
+        chapter = state["chapters_data"][index]
+        self.index = index
+        self.words = chapter_words
+        self.long_form = uses_long_form()
+        self.prefix = novel_bible(state)
+        self.heading = chapter_heading(chapter, index)
+        self.memory = continuity_before(state, index) or 'Es el primer capítulo escrito.'
+        self.notes = chapter_notes(state, index)
+        self.key_events = state["chapter_key_events"].get(index)
+
+    def payload(self, prompt):
+        return chat_payload(prompt, prefix=self.prefix)
+
+
+# Helper function to bring a text that stopped early (cut off at the model's output limit or
+# mid-sentence, or well short of about `words` words, see long_form) to its end by asking for its
+# continuation from where it stopped, instead of writing it again. `finish_reason` is the one of
+# the response that gave the text (None for streams). A failed continuation, or one that adds
+# nothing, keeps the text as it is.
+def complete_text(brief, text, words, use_cache=True, focus=None, finish_reason=None):
+    for _ in range(long_form.MAX_CONTINUATIONS):
+        if not long_form.stopped_early(text, words, finish_reason):
+            break
+        prompt = f"""
+    Continúa el texto del capítulo indicado a continuación exactamente donde se interrumpe, sin repetir ni resumir lo ya escrito, con aproximadamente {long_form.missing_words(text, words)} palabras más.
+    Asegúrate de que los diálogos utilicen rayas (guion largo '—') en lugar de comillas.
+    Responde solo con la continuación, sin introducciones.
+    {brief.heading}
+    {focus or 'Termina cerrando el capítulo.'}
+    Final del texto escrito hasta ahora: {long_form.tail(text)}
+    """
+        try:
+            more, finish_reason = request_completion(brief.payload(prompt), use_cache=use_cache,
+                                                     stage=f"chapter_continuation_{brief.index}")
+        except cancellation.Cancelled:
+            raise
+        except Exception:
+            break
+        telemetry.increment("chapter_continuations_total")
+        joined = long_form.join_continuation(text, more)
+        if joined == text:
+            break
+        text = joined
+    return text
+
+
+# Helper function to split a chapter into scene beats: planned by a short call around its key
+# events, or its key events themselves if the plan is unusable. None if neither gives enough beats.
+def plan_beats(brief, use_cache=True):
+    prompt = f"""
+    Divide el capítulo indicado a continuación en {long_form.beat_count(brief.words)} escenas consecutivas que juntas cuenten el capítulo completo{', repartiendo entre ellas sus eventos clave' if brief.key_events else ''}.
+    Para cada escena indica en una o dos frases qué ocurre, dónde y con qué personajes.
+    Responde solo con la lista de escenas, una por línea y numeradas, sin introducciones.
+    Memoria de continuidad: {brief.memory}
+    {brief.heading}
+    {brief.notes}
+    """
+    try:
+        beats = long_form.parse_beats(request_content(brief.payload(prompt), use_cache=use_cache,
+                                                      stage=f"chapter_beats_{brief.index}"))
+    except cancellation.Cancelled:
+        raise
+    except Exception:
+        beats = []
+    if len(beats) < long_form.MIN_BEATS:
+        beats = long_form.parse_beats(brief.key_events)
+    return beats[:long_form.MAX_BEATS] if len(beats) >= long_form.MIN_BEATS else None
+
+
+# Helper function to draft one scene beat, continued where it stopped if it was cut off or came out short
+def draft_beat(brief, beats, position, use_cache=True):
+    words = round(brief.words / len(beats))
+    scenes = "\n    ".join(f"{number}. {beat}" for number, beat in enumerate(beats, 1))
+    ending = "cerrando el capítulo" if position == len(beats) - 1 else "sin concluir el capítulo, que sigue con la escena siguiente"
+    prompt = f"""
+    Escribe una de las escenas del capítulo indicado a continuación, que se redacta escena a escena.
+    Escribe solo esa escena: empieza directamente en ella, sin títulos ni resúmenes, y no cuentes lo que ocurre en las demás.
+    Asegúrate de que el tono y estilo sean coherentes con una novela histórica de aventuras.
+    Asegúrate de que los diálogos utilicen rayas (guion largo '—') en lugar de comillas.
+    Memoria de continuidad: {brief.memory}
+    {brief.heading}
+    {brief.notes}
+    Escenas del capítulo:
+    {scenes}
+    Escribe ahora la escena {position + 1}, con aproximadamente {words} palabras, terminando {ending}: {beats[position]}
+    """
+    text, finish_reason = request_completion(brief.payload(prompt), use_cache=use_cache, stage=f"chapter_beat_{brief.index}")
+    return complete_text(brief, text, words, use_cache,
+                         focus=f"El texto es la escena {position + 1}, que debe terminar {ending}: {beats[position]}",
+                         finish_reason=finish_reason)
+
+
+# Helper function to write the short transition between two drafted beats; None if the call fails
+def bridge_beats(brief, before, after, use_cache=True):
+    prompt = f"""
+    Escribe un breve párrafo de transición, de unas {BRIDGE_WORDS} palabras, que enlace el final de una escena del capítulo indicado a continuación con el comienzo de la siguiente, sin repetir lo que ya cuentan.
+    Responde solo con el párrafo.
+    {brief.heading}
+    Final de la escena anterior: {long_form.tail(before, long_form.EDGE_WORDS)}
+    Comienzo de la escena siguiente: {long_form.head(after)}
+    """
+    try:
+        return request_content(brief.payload(prompt), use_cache=use_cache, stage=f"chapter_bridge_{brief.index}")
+    except cancellation.Cancelled:
+        raise
+    except Exception:
+        return None
+
+
+# Helper function to run calls of one chapter side by side; yields (key, result) in completion
+# order. A failure cancels the calls still running and is raised.
+def run_side_by_side(jobs):
+    with cancellation.scope(cancellation.Token(parent=cancellation.current())):
+        for key, result, err in bulk_generation.run_bounded(jobs, len(jobs)):
+            if err is not None:
+                raise err
+            yield key, result
+
+
+# Function to write a long chapter without asking one completion for all of it: the chapter is
+# split into scene beats (see plan_beats), the beats are drafted in parallel, each continued where
+# it stopped if it was cut off or came out short, and short transitions written in parallel stitch them together.
+# Latency grows with the length of one beat rather than of the chapter.
+# Returns None if the chapter could not be split into beats.
+def write_long_chapter(brief, use_cache=True):
+    beats = plan_beats(brief, use_cache)
+    if beats is None:
+        return None
+    drafts = dict(run_side_by_side({position: partial(draft_beat, brief, beats, position, use_cache)
+                                    for position in range(len(beats))}))
+    drafts = [drafts[position] for position in range(len(beats))]
+    bridges = dict(run_side_by_side({position: partial(bridge_beats, brief, drafts[position], drafts[position + 1], use_cache)
+                                     for position in range(len(drafts) - 1)}))
+    telemetry.increment("chapter_beats_drafted_total", len(beats))
+    return long_form.stitch(drafts, [bridges[position] for position in range(len(drafts) - 1)])
+
+
+# Function to write a chapter's content on a worker (see iter_chapter_jobs): as scene beats in
+# long-form mode, otherwise in one call continued where it stopped if it was cut off or came out short
+def write_chapter_content(brief, payload, use_cache=True):
+    with cancellation.deadline_scope():
+        content = write_long_chapter(brief, use_cache) if brief.long_form else None
+        if content is None:
+            content, finish_reason = request_completion(payload, use_cache=use_cache, stage=f"chapter_content_{brief.index}")
+            content = complete_text(brief, content, brief.words, use_cache, finish_reason=finish_reason)
+        return content
+
+
+# Helper generator of a chapter's content for the app: the stitched beats in long-form mode,
+# otherwise the streamed chapter, followed by its continuation if it stopped early
+def chapter_content_chunks(state, index, payload, use_cache=True):
+    brief = ChapterBrief(state, index)
+    if brief.long_form:
+        content = write_long_chapter(brief, use_cache)
+        if content is not None:
+            yield content
+            return
+    parts = []
+    for chunk in make_api_request(payload, stream=True, use_cache=use_cache, stage=f"chapter_content_{index}"):
+        parts.append(chunk)
+        yield chunk
+    text = "".join(parts).rstrip()
+    if text:
+        yield complete_text(brief, text, brief.words, use_cache)[len(text):]
+
+
+# Function to generate one per-chapter artifact (key events, conflict, scene, dialogue, sub-plots or content)
+def generate_chapter_artifact(state, artifact, index, use_cache=True, render=None):
+    check_chapter_preconditions(state)
+    state_key, _, transform, _, streamed, _, failure = CHAPTER_ARTIFACTS[artifact]
+    payload = chapter_payload(state, artifact, index)
+    stage = f"chapter_{artifact}_{index}"
+    try:
+        if artifact == "content":
+            content = render_chunks(chapter_content_chunks(state, index, payload, use_cache), transform, render)
+        elif streamed:
+            # Transformed chunk by chunk so the rendered text is already final
+            content = stream_content(payload, use_cache=use_cache, transform=transform, render=render, stage=stage)
+        else:
+            content, error = validate_api_response(make_api_request(payload, use_cache=use_cache, stage=stage))
+            if error:
+                raise GenerationError(error)
+            if transform:
+                content = transform(content)
+    except (GenerationError, ValueError) as err:
+        raise GenerationError(f"{failure} para el Capítulo {index + 1}: {err}") from err
+    state[state_key][index] = content
+    record_artifact(state, state_key, index)
+    if artifact == "content":
+        advance_continuity(state, index + 1)
+
+
+# Per-chapter (artifact, index) phases for a bulk run. Details come first because the
+# content prompt includes them; with only_missing, artifacts that already exist are skipped.
+# With in_order, chapter contents are written one after another, so each prompt carries the
+# continuity memory of every chapter before it; otherwise they run in parallel and each one sees
+# the memory of the chapters that were already written when the run started.
+def chapter_phases(state, include_details, only_missing, in_order=False):
+    artifact_phases = [CHAPTER_DETAIL_ARTIFACTS, ["content"]] if include_details else [["content"]]
+    phases = [
+        [(artifact, index) for artifact in phase for index in range(len(state["chapters_data"]))
+         if not (only_missing and index in state[CHAPTER_ARTIFACTS[artifact][0]])]
+        for phase in artifact_phases
+    ]
+    if in_order:
+        phases = phases[:-1] + [[job] for job in phases[-1]]
+    return [phase for phase in phases if phase]
+
+
+def chapter_job(state, artifact, index, use_cache=True):
+    payload = chapter_payload(state, artifact, index)
+    if artifact == "content":
+        return partial(write_chapter_content, ChapterBrief(state, index), payload, use_cache)
+    return partial(request_within_deadline, payload, use_cache=use_cache, stage=f"chapter_{artifact}_{index}")
+
+
+# Run per-chapter generations on a bounded thread pool, phase by phase.
+# Prompts are built and results stored on the calling thread; workers only call the API.
+# Each job has the generation deadline of its own (see cancellation), counted from its start.
+# Chapter contents are folded into the continuity memory as they are stored (see advance_continuity).
+# Yields (artifact, index, error) as each job finishes (error is None on success).
+def iter_chapter_jobs(state, phases, concurrency, use_cache=True):
+    for phase in phases:
+        jobs = {(artifact, index): chapter_job(state, artifact, index, use_cache) for artifact, index in phase}
+        for (artifact, index), content, err in bulk_generation.run_bounded(jobs, concurrency):
+            if err is None:
+                store_chapter_artifact(state, artifact, index, content)
+                if artifact == "content":
+                    # While the other jobs are still running
+                    advance_continuity(state)
+            yield artifact, index, err
+    if any(artifact == "content" for phase in phases for artifact, _ in phase):
+        advance_continuity(state, len(state["chapters_data"]))
+
+
+# Dependency graph over the state artifacts. Each input is projected to the
+# fields the artifact's prompt actually reads, so e.g. editing a character description
+# (never used in prompts) does not invalidate anything.
+def chapter_entry(chapters, index):
+    return chapters[index] if isinstance(chapters, list) and index < len(chapters) else None
+
+
+def character_names(characters):
+    return [char.get("name") for char in characters] if isinstance(characters, list) else characters
+
+
+novel_graph = dependency_graph.DependencyGraph()
+novel_graph.add("novel_outline_data", [("user_theme", str.strip)])
+novel_graph.add("characters_data", [
+    ("novel_outline_data", lambda outline: [outline.get("synthesis"), outline.get("plot")]),
+    ("narrative_technique", None), ("narrator_pov", None),
+])
+novel_graph.add("setting_details", [
+    ("user_theme", str.strip),
+    ("novel_outline_data", lambda outline: outline.get("description")),
+    ("narrative_technique", None), ("narrator_pov", None),
+])
+novel_graph.add("plot_twist_data", [
+    ("novel_outline_data", lambda outline: [outline.get("synthesis"), outline.get("plot")]),
+    ("characters_data", character_names),
+    ("setting_details", None), ("narrative_technique", None), ("narrator_pov", None),
+])
+# What the novel bible (the shared prefix of the TOC and chapter prompts) is built from
+BIBLE_INPUTS = [
+    ("novel_outline_data", lambda outline: [outline.get("description"), outline.get("synthesis"), outline.get("plot")]),
+    ("setting_details", None),
+    ("characters_data", lambda characters: [[char.get("name"), char.get("role")] for char in characters] if isinstance(characters, list) else characters),
+    ("plot_twist_data", None), ("narrative_technique", None), ("narrator_pov", None),
+]
+
+
+def chapter_bible_input(selector, value, index):
+    return selector(value) if selector else value
+
+
+CHAPTER_BIBLE_INPUTS = [(source, partial(chapter_bible_input, selector)) for source, selector in BIBLE_INPUTS]
+
+novel_graph.add("chapters_data", BIBLE_INPUTS + [("num_chapters", None)])
+for state_key in ("chapter_conflicts", "chapter_scene_descriptions", "chapter_dialogue_snippets",
+                  "chapter_sub_plot_ideas", "chapter_key_events"):
+    novel_graph.add(state_key, CHAPTER_BIBLE_INPUTS + [("chapters_data", chapter_entry)], per_chapter=True)
+
+
+# Helper function to select one chapter's text as an input. Texts kept in the chapter store
+# give the fingerprint saved with them, so checking for stale artifacts reads no text.
+def chapter_text(values, index):
+    if hasattr(values, "fingerprint"):
+        return values.fingerprint(index)
+    return values.get(index)
+
+
+novel_graph.add("chapter_contents", CHAPTER_BIBLE_INPUTS + [
+    ("chapters_data", chapter_entry),
+    ("chapter_conflicts", chapter_text),
+    ("chapter_scene_descriptions", chapter_text),
+    ("chapter_dialogue_snippets", chapter_text),
+    ("chapter_sub_plot_ideas", chapter_text),
+    ("chapter_key_events", chapter_text),
+], per_chapter=True)
+
+# Generators for the novel-level artifacts, in pipeline order
+ARTIFACT_GENERATORS = {
+    "novel_outline_data": generate_initial_outline,
+    "characters_data": generate_characters,
+    "setting_details": generate_setting_details,
+    "plot_twist_data": generate_plot_twist,
+    "chapters_data": generate_table_of_contents,
+}
+CHAPTER_ARTIFACT_BY_STATE_KEY = {state_key: artifact for artifact, (state_key, *_) in CHAPTER_ARTIFACTS.items()}
+
+
+# Helper function to record the inputs an artifact was just built from
+def record_artifact(state, key, index=None):
+    novel_graph.record(state["artifact_inputs"], state, key, index)
+
+
+# Helper function to list stale artifacts (inputs changed since they were generated)
+def stale_artifacts(state):
+    chapters = state["chapters_data"]
+    chapter_count = len(chapters) if isinstance(chapters, list) else 0
+    return novel_graph.stale(state["artifact_inputs"], state, chapter_count)
+
+
+# Next step to bring stale artifacts up to date: ("novel", key) for a novel-level artifact,
+# ("chapters", [(artifact, index), ...]) for a batch of per-chapter ones, or None.
+# Novel-level artifacts go first; chapter details before the contents that read them.
+def next_stale_step(state):
+    stale = stale_artifacts(state)
+    novel_level = [key for key, index, _ in stale if index is None]
+    if novel_level:
+        return "novel", novel_level[0]
+    details = [(CHAPTER_ARTIFACT_BY_STATE_KEY[key], index) for key, index, _ in stale if key != "chapter_contents"]
+    contents = [("content", index) for key, index, _ in stale if key == "chapter_contents"]
+    if details or contents:
+        return "chapters", details or contents
+    return None
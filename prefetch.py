@@ -0,0 +1,168 @@
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import cancellation
+import novel_engine
+import request_scheduler
+import response_cache
+import telemetry
+
+# Chapter artifacts worth guessing: short, cheap, and the first ones asked for when reading a chapter
+PREFETCH_ARTIFACTS = ["key_events", "conflict"]
+# Chapters ahead of the one being read that get their artifacts prefetched
+DEFAULT_AHEAD = 3
+WORKERS = 4
+
+# Worker threads shared by every session's prefetcher; the request scheduler decides when they may call the API
+_executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="prefetch")
+
+
+# One speculative generation: the request it was made for, its result when done, and the
+# cancellation token that aborts it when it is thrown away
+class Job:
+    def __init__(self, key, future, token):
+        self.key = key
+        self.future = future
+        self.token = token
+
+
+# Speculative background generation of one session's per-chapter artifacts.
+# Jobs run at the scheduler's prefetch priority (only while nothing interactive is queued or
+# running) and their results wait in a holding area, keyed by artifact and chapter, until the
+# user asks for that artifact: then the held text is stored at once instead of calling the API.
+# A held result is only used if it was made from the exact request the click would send
+# (same request key); otherwise, or if the artifact gets generated some other way, it is wasted.
+# A job whose request failed is counted as failed, not wasted.
+class Prefetcher:
+    def __init__(self, session):
+        self.session = session
+        self.stats = {"calls": 0, "hits": 0, "misses": 0, "wasted": 0, "failed": 0}
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    # Queue the given (artifact, index) targets that are not generated, held or running yet.
+    # Payloads are built here, on the caller's thread; workers only call the API.
+    def schedule(self, state, targets, use_cache=True):
+        self.sweep(state)
+        for artifact, index in targets:
+            state_key = novel_engine.CHAPTER_ARTIFACTS[artifact][0]
+            if index in state[state_key]:
+                continue
+            payload = novel_engine.chapter_payload(state, artifact, index)
+            key = response_cache.request_key(payload)
+            with self._lock:
+                job = self._jobs.get((artifact, index))
+                if job is not None and job.key == key and not failed(job):
+                    continue
+                if job is not None:
+                    self._discard(job)
+                with request_scheduler.context(self.session, request_scheduler.PREFETCH):
+                    run = contextvars.copy_context().run
+                token = cancellation.Token()
+                future = _executor.submit(run, run_job, token, payload, use_cache, f"chapter_{artifact}_{index}")
+                self._jobs[(artifact, index)] = Job(key, future, token)
+                self.stats["calls"] += 1
+            telemetry.increment("llm_prefetch_total", outcome="scheduled")
+
+    # Throw away held results for artifacts that now exist (e.g. from a bulk run)
+    def sweep(self, state):
+        with self._lock:
+            for (artifact, index), job in list(self._jobs.items()):
+                if index in state[novel_engine.CHAPTER_ARTIFACTS[artifact][0]]:
+                    del self._jobs[(artifact, index)]
+                    self._discard(job)
+
+    # Called with the lock held. A job that never started costs nothing; one that failed is
+    # counted as such; any other that ran was wasted (if it is still running, its request is aborted).
+    def _discard(self, job):
+        if job.future.cancel():
+            self.stats["calls"] -= 1
+            return
+        if failed(job):
+            self._count_failure()
+            return
+        job.token.cancel()
+        self.stats["wasted"] += 1
+        telemetry.increment("llm_prefetch_total", outcome="wasted")
+
+    # Cancel the jobs that have not started, e.g. when the user starts an interactive generation
+    # (they are queued again on the next schedule)
+    def cancel_pending(self):
+        with self._lock:
+            for target, job in list(self._jobs.items()):
+                if job.future.cancel():
+                    del self._jobs[target]
+                    self.stats["calls"] -= 1
+
+    # The prefetched text for an artifact the user asked for, or None (a miss). A job still
+    # waiting for the API is moved up to interactive priority and waited for.
+    def claim(self, state, artifact, index):
+        if artifact not in PREFETCH_ARTIFACTS:
+            return None
+        key = response_cache.request_key(novel_engine.chapter_payload(state, artifact, index))
+        with self._lock:
+            job = self._jobs.pop((artifact, index), None)
+            if job is not None and job.key != key:
+                self._discard(job)
+                job = None
+        content = None
+        # A job that has not started yet is cancelled: the click makes the request itself
+        if job is not None and not job.future.cancel():
+            request_scheduler.scheduler.promote(self.session)
+            while not job.future.done():
+                cancellation.check()
+                wait([job.future], timeout=cancellation.POLL_SECONDS)
+            content = None if failed(job) else job.future.result()
+        with self._lock:
+            if job is not None and failed(job):
+                self._count_failure()
+            self.stats["hits" if content is not None else "misses"] += 1
+        telemetry.increment("llm_prefetch_total", outcome="hit" if content is not None else "miss")
+        return content
+
+    # Called with the lock held
+    def _count_failure(self):
+        self.stats["failed"] += 1
+        telemetry.increment("llm_prefetch_total", outcome="failed")
+
+    def close(self):
+        with self._lock:
+            for job in self._jobs.values():
+                self._discard(job)
+            self._jobs.clear()
+
+    def summary(self):
+        with self._lock:
+            held = sum(1 for job in self._jobs.values() if job.future.done() and not failed(job))
+            pending = sum(1 for job in self._jobs.values() if not job.future.done())
+            # Failed jobs not discarded yet are counted too
+            failures = self.stats["failed"] + sum(1 for job in self._jobs.values() if failed(job))
+            claims = self.stats["hits"] + self.stats["misses"]
+            return {**self.stats, "failed": failures, "held": held, "pending": pending,
+                    "hit_rate": self.stats["hits"] / claims if claims else None}
+
+
+# Helper function to run one job under its token, with the generation deadline from its start
+def run_job(token, payload, use_cache, stage):
+    with cancellation.scope(token), cancellation.deadline_scope():
+        return novel_engine.request_content(payload, use_cache=use_cache, stage=stage)
+
+
+def failed(job):
+    return job.future.done() and job.future.exception() is not None
+
+
+# The next `ahead` chapters from `start` that lack a prefetchable artifact, as (artifact, index) targets
+def targets_ahead(state, start, ahead=DEFAULT_AHEAD):
+    chapters = state["chapters_data"]
+    targets = []
+    for index in range(start, len(chapters) if isinstance(chapters, list) else 0):
+        missing = [(artifact, index) for artifact in PREFETCH_ARTIFACTS
+                   if index not in state[novel_engine.CHAPTER_ARTIFACTS[artifact][0]]]
+        if missing:
+            targets.extend(missing)
+            ahead -= 1
+            if ahead == 0:
+                break
+    return targets
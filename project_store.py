@@ -0,0 +1,192 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import chapter_store
+import dependency_graph
+import novel_engine
+
+DEFAULT_PATH = os.path.join(".cache", "projects.sqlite3")
+# State keys kept in the chapter store rather than as state rows
+CHAPTER_STATE_KEYS = [state_key for state_key, *_ in novel_engine.CHAPTER_ARTIFACTS.values()]
+# Every other key of the engine state is saved; dict-valued ones (artifact_inputs,
+# context_summaries, context_reports) one entry per row, so they are never rewritten whole
+STATE_KEYS = [key for key in novel_engine.new_state() if key not in CHAPTER_STATE_KEYS]
+ENTRY_KEYS = {key for key, value in novel_engine.new_state().items() if isinstance(value, dict) and key in STATE_KEYS}
+
+
+# Durable store of novel projects, shared by every session of the process.
+# One SQLite database in WAL mode: a row per project, a row per saved state value
+# (or dict entry) and a row per chapter text, each written as soon as it changes, so a
+# refresh, a server restart or a crash in the middle of a bulk generation loses at most
+# the call that was in flight.
+class ProjectStore:
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS projects (
+                id TEXT PRIMARY KEY,
+                title TEXT NOT NULL,
+                created REAL NOT NULL,
+                updated REAL NOT NULL,
+                pending_job TEXT
+            );
+            CREATE TABLE IF NOT EXISTS state_values (
+                project TEXT NOT NULL,
+                key TEXT NOT NULL,
+                entry TEXT NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (project, key, entry)
+            );
+            CREATE TABLE IF NOT EXISTS chapter_texts (
+                project TEXT NOT NULL,
+                artifact TEXT NOT NULL,
+                chapter INTEGER NOT NULL,
+                body BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                digest TEXT NOT NULL,
+                PRIMARY KEY (project, artifact, chapter)
+            );
+        """)
+        self._conn.commit()
+
+    # A new project; its row is only written once it has something worth keeping
+    def create_project(self, cache_size=chapter_store.DEFAULT_CACHE_SIZE):
+        return Project(self, uuid.uuid4().hex[:12], cache_size, exists=False)
+
+    # The saved project with this id, or None
+    def open_project(self, project_id, cache_size=chapter_store.DEFAULT_CACHE_SIZE):
+        with self._lock:
+            row = self._conn.execute("SELECT id FROM projects WHERE id = ?", (project_id,)).fetchone()
+        return Project(self, project_id, cache_size, exists=True) if row else None
+
+    # The saved projects among `project_ids`, most recently updated first. The store is shared
+    # by every visitor, so callers list only the ids their own session knows.
+    def list_projects(self, project_ids):
+        project_ids = list(project_ids)
+        if not project_ids:
+            return []
+        with self._lock:
+            rows = self._conn.execute(f"""
+                SELECT p.id, p.title, p.updated, p.pending_job IS NOT NULL,
+                       (SELECT COUNT(*) FROM chapter_texts t WHERE t.project = p.id AND t.artifact = 'chapter_contents')
+                FROM projects p WHERE p.id IN ({", ".join("?" * len(project_ids))}) ORDER BY p.updated DESC
+            """, project_ids).fetchall()
+        return [{"id": row[0], "title": row[1], "updated": row[2], "interrupted": bool(row[3]), "chapters_written": row[4]}
+                for row in rows]
+
+    def delete_project(self, project_id):
+        with self._lock:
+            for table, column in (("chapter_texts", "project"), ("state_values", "project"), ("projects", "id")):
+                self._conn.execute(f"DELETE FROM {table} WHERE {column} = ?", (project_id,))
+            self._conn.commit()
+
+
+class Project:
+    def __init__(self, store, project_id, cache_size, exists):
+        self.store = store
+        self.id = project_id
+        self.exists = exists
+        self.chapters = chapter_store.ChapterStore(store._conn, store._lock, project_id, cache_size)
+        # Fingerprints of what is on disk, by (key, entry), so a save only writes what changed
+        self._saved = {}
+
+    # Fill a state mapping from the project: saved values over new_state() defaults,
+    # chapter keys as views of the chapter store
+    def load(self, state):
+        values = novel_engine.new_state()
+        with self.store._lock:
+            rows = self.store._conn.execute("SELECT key, entry, value FROM state_values WHERE project = ?",
+                                            (self.id,)).fetchall()
+        for key, entry, encoded in rows:
+            if key not in values:
+                continue
+            value = json.loads(encoded)
+            if key in ENTRY_KEYS:
+                values[key][entry] = value
+            else:
+                values[key] = value
+            self._saved[(key, entry)] = dependency_graph.fingerprint(value)
+        for key in STATE_KEYS:
+            state[key] = values[key]
+        for key in CHAPTER_STATE_KEYS:
+            state[key] = self.chapters.texts(key)
+
+    # Write the state values that changed since the last save, one row each.
+    # Nothing is written for a project that has not produced any artifact yet.
+    def save(self, state):
+        if not self.exists and not any(state.get(key) for key in novel_engine.ARTIFACT_GENERATORS):
+            return 0
+        current = {}
+        for key in STATE_KEYS:
+            value = state.get(key)
+            if key in ENTRY_KEYS:
+                current.update({(key, str(entry)): item for entry, item in (value or {}).items()})
+            else:
+                current[(key, "")] = value
+        fingerprints = {row: dependency_graph.fingerprint(value) for row, value in current.items()}
+        changed = [row for row, fp in fingerprints.items() if self._saved.get(row) != fp or row not in self._saved]
+        removed = [row for row in self._saved if row not in current]
+        if not (changed or removed or not self.exists):
+            return 0
+        now = time.time()
+        with self.store._lock:
+            conn = self.store._conn
+            conn.execute("INSERT INTO projects (id, title, created, updated) VALUES (?, ?, ?, ?) "
+                         "ON CONFLICT (id) DO UPDATE SET title = excluded.title, updated = excluded.updated",
+                         (self.id, project_title(state), now, now))
+            conn.executemany("INSERT OR REPLACE INTO state_values (project, key, entry, value) VALUES (?, ?, ?, ?)",
+                             [(self.id, key, entry, json.dumps(current[(key, entry)], ensure_ascii=False))
+                              for key, entry in changed])
+            conn.executemany("DELETE FROM state_values WHERE project = ? AND key = ? AND entry = ?",
+                             [(self.id, key, entry) for key, entry in removed])
+            conn.commit()
+        self.exists = True
+        for row in changed:
+            self._saved[row] = fingerprints[row]
+        for row in removed:
+            del self._saved[row]
+        return len(changed) + len(removed)
+
+    # A bulk generation in progress ({"include_details": ...}), recorded so it can be resumed
+    # after an interruption; None when the last one finished
+    def pending_job(self):
+        with self.store._lock:
+            row = self.store._conn.execute("SELECT pending_job FROM projects WHERE id = ?", (self.id,)).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def set_pending_job(self, job):
+        if not self.exists:
+            return
+        with self.store._lock:
+            self.store._conn.execute("UPDATE projects SET pending_job = ? WHERE id = ?",
+                                     (json.dumps(job) if job is not None else None, self.id))
+            self.store._conn.commit()
+
+
+def project_title(state):
+    return (state.get("user_theme") or "").strip()[:80] or "Sin título"
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+# Process-wide project store (created on first use)
+def get_store(path=DEFAULT_PATH):
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = ProjectStore(path)
+    return _store
@@ -0,0 +1,39 @@
+# Providers that only cache a prompt prefix when it is marked with a cache_control breakpoint
+# (OpenRouter passes it through); OpenAI, DeepSeek, Grok and others cache long prefixes on their own
+CACHE_CONTROL_MODEL_PREFIXES = ("anthropic/", "google/gemini")
+
+
+def uses_cache_control(model):
+    return (model or "").startswith(CACHE_CONTROL_MODEL_PREFIXES)
+
+
+# Chat messages for a prompt, with the text shared by many calls first.
+# Providers reuse the work done on a prompt prefix they have already seen (prompt caching), but
+# only for an exact, byte-identical match from the first token, so everything that is the same
+# for every call goes in the system message and the call-specific text in the user message after it.
+def layout(prompt, prefix=None):
+    messages = [{"role": "system", "content": prefix}] if prefix else []
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+
+# The messages with an ephemeral cache_control breakpoint on the system prefix, for the
+# providers that need one (see uses_cache_control)
+def with_cache_hint(messages):
+    return [{**message, "content": [{"type": "text", "text": message["content"], "cache_control": {"type": "ephemeral"}}]}
+            if message["role"] == "system" and isinstance(message["content"], str) else message
+            for message in messages]
+
+
+# Text of a message, whether its content is a string or a list of content parts
+def message_text(message):
+    content = message.get("content")
+    if isinstance(content, list):
+        return "".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content or ""
+
+
+# Whole prompt text of a chat payload
+def prompt_text(payload):
+    return "\n".join(message_text(message) for message in payload.get("messages", []))
+
@@ -0,0 +1,236 @@
+import contextlib
+import contextvars
+import threading
+import time
+from collections import OrderedDict, deque
+
+import cancellation
+import telemetry
+
+# Priority classes: interactive clicks are always dispatched before bulk chapter jobs, and
+# speculative prefetches only when nothing else is waiting
+INTERACTIVE = "interactive"
+BULK = "bulk"
+PREFETCH = "prefetch"
+PRIORITIES = (INTERACTIVE, BULK, PREFETCH)
+
+DEFAULT_MAX_IN_FLIGHT = 32
+DEFAULT_MAX_PREFETCH_IN_FLIGHT = 2
+
+# Who is calling: (session id, priority class). Set with `context`; carried into worker
+# threads by bulk_generation.
+_current = contextvars.ContextVar("request_scheduler_context", default=("default", INTERACTIVE))
+# Class the current slot was granted under (a promoted prefetch runs as interactive)
+_granted = contextvars.ContextVar("request_scheduler_granted", default=INTERACTIVE)
+
+
+@contextlib.contextmanager
+def context(session, priority=INTERACTIVE):
+    token = _current.set((session, priority))
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def current_priority():
+    return _current.get()[1]
+
+
+# Token bucket: `rate` requests per second on average, bursts of up to `capacity`.
+# rate None means unlimited.
+class TokenBucket:
+    def __init__(self, rate=None, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or 1
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        if not self.rate:
+            return True
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    # Seconds until the next token is available
+    def wait_time(self):
+        if not self.rate:
+            return 0.0
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class Ticket:
+    def __init__(self, session, priority):
+        self.session = session
+        self.priority = priority
+        self.enqueued = time.perf_counter()
+        self.granted = False
+
+
+# Process-wide scheduler every LLM request attempt goes through.
+# A request is dispatched when fewer than `max_in_flight` are running and the token
+# bucket (the provider's requests-per-minute limit) has a token. Waiting requests are
+# served by priority class, and within a class round-robin across sessions, so one
+# session's 30-chapter bulk run cannot starve the others: each session gets its turn
+# no matter how many requests it has queued.
+# Prefetch requests are held back while any interactive request is queued or running, or any
+# bulk one is queued, and at most `max_prefetch_in_flight` of them run at once, so speculative
+# work only uses the capacity a user is not waiting for.
+class Scheduler:
+    def __init__(self, max_in_flight=DEFAULT_MAX_IN_FLIGHT, requests_per_minute=None, burst=None,
+                 max_prefetch_in_flight=DEFAULT_MAX_PREFETCH_IN_FLIGHT):
+        self.max_in_flight = max_in_flight
+        self.max_prefetch_in_flight = max_prefetch_in_flight
+        self.bucket = TokenBucket()
+        self.in_flight = 0
+        self.in_flight_by_priority = {priority: 0 for priority in PRIORITIES}
+        # priority -> OrderedDict(session -> deque of tickets); session order is the round-robin order
+        self._queues = {priority: OrderedDict() for priority in PRIORITIES}
+        self._cond = threading.Condition()
+        self.set_rate(requests_per_minute, burst)
+
+    def set_rate(self, requests_per_minute, burst=None):
+        with self._cond:
+            rate = requests_per_minute / 60 if requests_per_minute else None
+            self.bucket = TokenBucket(rate, burst or (max(1, round(requests_per_minute / 6)) if rate else None))
+            self._cond.notify_all()
+
+    def queue_depth(self, priority=None):
+        return sum(len(tickets) for p in ([priority] if priority else PRIORITIES)
+                   for tickets in self._queues[p].values())
+
+    # The priority class to serve next, or None if nothing may be dispatched
+    def _ready_priority(self):
+        for priority in PRIORITIES:
+            if not self._queues[priority]:
+                continue
+            if priority == PREFETCH and (self.queue_depth(INTERACTIVE) or self.queue_depth(BULK) or
+                                         self.in_flight_by_priority[INTERACTIVE] or
+                                         self.in_flight_by_priority[PREFETCH] >= self.max_prefetch_in_flight):
+                return None
+            return priority
+        return None
+
+    def _next_ticket(self, priority):
+        sessions = self._queues[priority]
+        session, tickets = next(iter(sessions.items()))
+        ticket = tickets.popleft()
+        del sessions[session]
+        if tickets:
+            sessions[session] = tickets
+        return ticket
+
+    # Grant queued tickets while there is capacity; called with the condition held
+    def _dispatch(self):
+        granted = False
+        while self.in_flight < self.max_in_flight:
+            priority = self._ready_priority()
+            if priority is None or not self.bucket.take():
+                break
+            ticket = self._next_ticket(priority)
+            ticket.granted = True
+            self.in_flight += 1
+            self.in_flight_by_priority[ticket.priority] += 1
+            granted = True
+        if granted:
+            self._cond.notify_all()
+        self._publish()
+
+    def _publish(self):
+        for priority in PRIORITIES:
+            telemetry.set_gauge("llm_scheduler_queue_depth", self.queue_depth(priority), priority=priority)
+        telemetry.set_gauge("llm_scheduler_in_flight", self.in_flight)
+
+    # Block until the calling context's request may be sent. A cancelled request leaves the queue.
+    def acquire(self):
+        session, priority = _current.get()
+        ticket = Ticket(session, priority)
+        token = cancellation.current()
+        with self._cond:
+            self._queues[priority].setdefault(session, deque()).append(ticket)
+            self._dispatch()
+            while not ticket.granted:
+                # Wake up when the bucket refills, in case no release comes first
+                timeout = self.bucket.wait_time() or None
+                if token is not None:
+                    timeout = min(timeout or cancellation.POLL_SECONDS, cancellation.POLL_SECONDS)
+                self._cond.wait(timeout)
+                if not ticket.granted:
+                    self._dispatch()
+                if not ticket.granted and token is not None:
+                    try:
+                        token.poll()
+                    except cancellation.Cancelled:
+                        self._withdraw(ticket)
+                        raise
+        _granted.set(ticket.priority)
+        telemetry.observe("llm_scheduler_wait_seconds", time.perf_counter() - ticket.enqueued, priority=priority)
+
+    # Take a ticket that was not granted out of its queue; called with the condition held
+    def _withdraw(self, ticket):
+        sessions = self._queues[ticket.priority]
+        tickets = sessions.get(ticket.session)
+        if tickets is not None and ticket in tickets:
+            tickets.remove(ticket)
+            if not tickets:
+                del sessions[ticket.session]
+        self._publish()
+
+    # Called in the context that acquired the slot
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self.in_flight_by_priority[_granted.get()] -= 1
+            self._dispatch()
+
+    # Move a session's queued prefetch requests up to interactive, e.g. when the user asks
+    # for something a prefetch is still waiting to fetch
+    def promote(self, session):
+        with self._cond:
+            tickets = self._queues[PREFETCH].pop(session, None)
+            if tickets:
+                for ticket in tickets:
+                    ticket.priority = INTERACTIVE
+                self._queues[INTERACTIVE].setdefault(session, deque()).extend(tickets)
+                self._dispatch()
+
+    @contextlib.contextmanager
+    def slot(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    # Hold a slot for as long as a stream is being read; it is released when the stream
+    # is exhausted, fails or is closed
+    def hold_stream(self, chunks):
+        try:
+            yield from chunks
+        finally:
+            self.release()
+
+
+scheduler = Scheduler()
+
+
+def configure(max_in_flight=None, requests_per_minute=None, burst=None, max_prefetch_in_flight=None):
+    if max_in_flight is not None or max_prefetch_in_flight is not None:
+        with scheduler._cond:
+            if max_in_flight is not None:
+                scheduler.max_in_flight = max_in_flight
+            if max_prefetch_in_flight is not None:
+                scheduler.max_prefetch_in_flight = max_prefetch_in_flight
+            scheduler._dispatch()
+    if requests_per_minute is not None:
+        scheduler.set_rate(requests_per_minute, burst)
@@ -0,0 +1,238 @@
+import contextlib
+import contextvars
+import email.utils
+import random
+import threading
+import time
+
+import requests
+
+import cancellation
+import telemetry
+
+# Retry settings (see configure)
+max_attempts = 4
+base_delay = 1.0
+max_delay = 30.0
+# A Retry-After longer than this is not waited out: the call fails instead
+max_retry_after = 120.0
+
+# Attempts allowed in the current context when lower than max_attempts (see limit_attempts)
+_attempt_limit = contextvars.ContextVar("retry_attempt_limit", default=None)
+
+# Statuses worth retrying: timeouts, conflicts, rate limits and provider-side failures.
+# Everything else (400 bad request, 401/403 auth, 402 credits, 404, 413, 422...) fails at once.
+RETRYABLE_STATUSES = {408, 409, 425, 429, 500, 502, 503, 504, 520, 522, 524, 529}
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    pass
+
+
+def error_status(err):
+    response = getattr(err, "response", None)
+    return response.status_code if response is not None else None
+
+
+# Short reason label for metrics: the HTTP status, or the error class for transport errors
+def error_reason(err):
+    status = error_status(err)
+    return str(status) if status is not None else type(err).__name__
+
+
+# Whether an error is transient: connection problems, timeouts, truncated bodies and retryable statuses.
+# JSON decode errors, invalid requests and an open circuit are not retried.
+def is_retryable(err):
+    if isinstance(err, CircuitOpenError):
+        return False
+    if isinstance(err, requests.exceptions.HTTPError):
+        return error_status(err) in RETRYABLE_STATUSES
+    return isinstance(err, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                            requests.exceptions.ChunkedEncodingError))
+
+
+# Seconds the provider asked us to wait: Retry-After (seconds or HTTP date), or on a
+# 429 OpenRouter's X-RateLimit-Reset (epoch milliseconds). None if it did not say.
+def retry_after_seconds(err):
+    response = getattr(err, "response", None)
+    if response is None:
+        return None
+    value = response.headers.get("Retry-After")
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    reset = response.headers.get("X-RateLimit-Reset")
+    if response.status_code == 429 and reset:
+        try:
+            return max(0.0, float(reset) / 1000 - time.time())
+        except ValueError:
+            pass
+    return None
+
+
+# Exponential backoff with full jitter, so concurrent callers do not retry in lockstep
+def backoff_delay(attempt):
+    return random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+
+
+# Process-wide circuit breaker.
+# After `failure_threshold` consecutive provider failures (retryable errors) the circuit opens
+# and calls fail fast for `cooldown` seconds; then one trial call is let through (half-open)
+# and its outcome closes or reopens the circuit. A Retry-After from a 429 also holds every
+# caller until it expires, instead of each one discovering the limit on its own.
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, cooldown=30.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.hold_until = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def _transition(self, state):
+        if state != self.state:
+            self.state = state
+            telemetry.increment("llm_circuit_transitions_total", state=state)
+            telemetry.set_gauge("llm_circuit_open", 1 if state == "open" else 0)
+
+    # Wait out a shared rate-limit hold, then fail fast if the circuit is open
+    def before_call(self):
+        with self._lock:
+            wait = self.hold_until - time.monotonic()
+        if wait > 0:
+            cancellation.sleep(wait)
+        with self._lock:
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < self.cooldown:
+                    telemetry.increment("llm_circuit_rejected_total")
+                    raise CircuitOpenError("El proveedor no responde correctamente; se reintentará en unos segundos.")
+                self._transition("half_open")
+            if self.state == "half_open":
+                if self._trial_in_flight:
+                    telemetry.increment("llm_circuit_rejected_total")
+                    raise CircuitOpenError("El proveedor no responde correctamente; se reintentará en unos segundos.")
+                self._trial_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._trial_in_flight = False
+            self._transition("closed")
+
+    def record_failure(self, err):
+        retry_after = retry_after_seconds(err)
+        with self._lock:
+            self._trial_in_flight = False
+            if retry_after:
+                self.hold_until = max(self.hold_until, time.monotonic() + min(retry_after, max_retry_after))
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self._transition("open")
+
+    # A call that failed for a non-provider reason (e.g. a 400) says nothing about provider health
+    def record_neutral(self):
+        with self._lock:
+            self._trial_in_flight = False
+
+
+breaker = CircuitBreaker()
+
+
+def configure(attempts=None, initial_delay=None, delay_cap=None, failure_threshold=None, cooldown=None):
+    global max_attempts, base_delay, max_delay
+    if attempts is not None:
+        max_attempts = attempts
+    if initial_delay is not None:
+        base_delay = initial_delay
+    if delay_cap is not None:
+        max_delay = delay_cap
+    if failure_threshold is not None:
+        breaker.failure_threshold = failure_threshold
+    if cooldown is not None:
+        breaker.cooldown = cooldown
+
+
+# Allow at most `attempts` attempts for calls made inside the block (None = no limit),
+# e.g. when another model can take over after a couple of failures
+@contextlib.contextmanager
+def limit_attempts(attempts):
+    token = _attempt_limit.set(attempts)
+    try:
+        yield
+    finally:
+        _attempt_limit.reset(token)
+
+
+# Run one attempt of `send` under the breaker, recording the outcome
+def guarded_call(send):
+    breaker.before_call()
+    try:
+        result = send()
+    except Exception as err:
+        if is_retryable(err):
+            breaker.record_failure(err)
+        else:
+            breaker.record_neutral()
+        raise
+    breaker.record_success()
+    return result
+
+
+# tenacity hooks: retry only transient errors; stop after max_attempts, when the
+# provider asks for a wait longer than max_retry_after or when the retry would end after the
+# deadline; wait for Retry-After if given, otherwise exponential backoff with jitter
+def should_retry(retry_state):
+    outcome = retry_state.outcome
+    return outcome.failed and is_retryable(outcome.exception())
+
+
+def should_stop(retry_state):
+    if retry_state.attempt_number >= min(max_attempts, _attempt_limit.get() or max_attempts):
+        return True
+    outcome = retry_state.outcome
+    retry_after = retry_after_seconds(outcome.exception()) if outcome.failed else None
+    if retry_after is not None and retry_after > max_retry_after:
+        return True
+    # Skip a retry that could not finish before the caller's deadline: the wait plus the
+    # median duration of this stage's calls on this model
+    token = cancellation.current()
+    remaining = token.remaining() if token is not None else None
+    if remaining is not None:
+        call = retry_state.kwargs.get("call")
+        typical = telemetry.typical_seconds(call.stage, call.model) if call is not None else None
+        if (retry_state.upcoming_sleep or 0) + (typical or 0) >= remaining:
+            telemetry.increment("llm_retries_skipped_total", reason="deadline")
+            return True
+    return False
+
+
+def wait_time(retry_state):
+    outcome = retry_state.outcome
+    retry_after = retry_after_seconds(outcome.exception()) if outcome.failed else None
+    if retry_after is not None:
+        return retry_after + random.uniform(0, base_delay)
+    return backoff_delay(retry_state.attempt_number)
+
+
+# Backoff sleep, cut short if the call is cancelled meanwhile
+def sleep(seconds):
+    cancellation.sleep(seconds)
+
+
+def before_sleep(retry_state):
+    telemetry.increment("llm_retry_attempts_total", reason=error_reason(retry_state.outcome.exception()))
+
+
+# Called when should_stop ends the retries: count it and re-raise the last error itself
+# (rather than tenacity's RetryError, which callers do not expect)
+def give_up(retry_state):
+    telemetry.increment("llm_retry_give_ups_total", reason=error_reason(retry_state.outcome.exception()))
+    return retry_state.outcome.result()
@@ -0,0 +1,166 @@
+import contextvars
+import threading
+
+import cancellation
+import telemetry
+
+
+# One upstream call shared by every caller that asked for the same request while it was running.
+# It runs under a cancellation token of its own (with the first caller's deadline), cancelled
+# when every caller has gone away before it finished.
+class Flight:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.chunks = []
+        self.consumers = 0
+        self.finished = False
+        self.complete = False
+        self.result = None
+        self.error = None
+        caller = cancellation.current()
+        self.token = cancellation.Token(deadline=caller.deadline if caller is not None else None)
+
+    def finish(self, complete=False, error=None):
+        with self.cond:
+            self.finished = True
+            self.complete = complete
+            self.error = error
+            self.cond.notify_all()
+
+
+# In-flight deduplication of identical requests (keyed by response_cache.request_key).
+# The first caller starts the request on a background thread; every caller, the first one
+# included, waits for it and shares its result, or its error. A stream is read by the background
+# pump into a shared buffer that every caller replays from the start, so the stream keeps going
+# when the caller that started it goes away (e.g. a Streamlit rerun after a double click) as long
+# as another is still reading.
+# Callers wait under their own cancellation token: a cancelled caller stops waiting at once, and
+# once nobody is waiting the upstream request is aborted.
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def _join(self, key):
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                with flight.cond:
+                    flight.consumers += 1
+                return flight, False
+            flight = self._flights[key] = Flight()
+            flight.consumers = 1
+            return flight, True
+
+    def _leave(self, key, flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    # Called when a caller stops waiting; the last one to go abandons an unfinished flight
+    def _drop(self, key, flight):
+        with flight.cond:
+            flight.consumers -= 1
+            abandoned = flight.consumers == 0 and not flight.finished
+        if abandoned:
+            self._leave(key, flight)
+            flight.token.cancel()
+
+    def _start(self, target, *args):
+        run = contextvars.copy_context().run
+        threading.Thread(target=run, args=(self._run_under, target, *args), name="single-flight", daemon=True).start()
+
+    @staticmethod
+    def _run_under(target, key, flight, *args):
+        with cancellation.scope(flight.token):
+            target(key, flight, *args)
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._flights)
+
+    # Run `send()` once for every concurrent caller of `key`. Returns (result, shared).
+    def call(self, key, send):
+        flight, leader = self._join(key)
+        if leader:
+            self._start(self._send, key, flight, send)
+        else:
+            telemetry.increment("llm_coalesced_requests_total", kind="plain")
+        try:
+            with flight.cond:
+                cancellation.wait_for(flight.cond, lambda: flight.finished)
+        finally:
+            self._drop(key, flight)
+        # Interrupted, or cancelled by callers that went away: this caller is still waiting, so try again
+        if not flight.complete and (flight.error is None or isinstance(flight.error, cancellation.Cancelled)):
+            cancellation.check()
+            return self.call(key, send)
+        if flight.error is not None:
+            raise flight.error
+        return flight.result, not leader
+
+    def _send(self, key, flight, send):
+        try:
+            flight.result = send()
+        except Exception as err:
+            self._leave(key, flight)
+            flight.finish(error=err)
+            return
+        except BaseException:
+            self._leave(key, flight)
+            flight.finish()
+            raise
+        self._leave(key, flight)
+        flight.finish(complete=True)
+
+    # Iterator over the chunks of `open_chunks()`, opened once for every concurrent caller of
+    # `key`. Returns (chunks, shared). on_complete(text) runs once if the stream completes.
+    def stream(self, key, open_chunks, on_complete=None):
+        flight, leader = self._join(key)
+        if leader:
+            self._start(self._pump, key, flight, open_chunks, on_complete)
+        else:
+            telemetry.increment("llm_coalesced_requests_total", kind="stream")
+        return self._replay(key, flight), not leader
+
+    def _pump(self, key, flight, open_chunks, on_complete):
+        chunks = open_chunks()
+        try:
+            for chunk in chunks:
+                with flight.cond:
+                    flight.chunks.append(chunk)
+                    flight.cond.notify_all()
+                    if flight.consumers == 0:
+                        break
+            else:
+                if on_complete is not None:
+                    on_complete("".join(flight.chunks))
+                self._leave(key, flight)
+                flight.finish(complete=True)
+                return
+        except Exception as err:
+            self._leave(key, flight)
+            flight.finish(error=err)
+            return
+        finally:
+            chunks.close()
+        # Every reader went away: stop reading (this closes the upstream response)
+        self._leave(key, flight)
+        flight.finish()
+
+    def _replay(self, key, flight):
+        position = 0
+        try:
+            while True:
+                with flight.cond:
+                    cancellation.wait_for(flight.cond, lambda: position < len(flight.chunks) or flight.finished)
+                    pending = flight.chunks[position:]
+                    finished = flight.finished
+                position += len(pending)
+                yield from pending
+                if finished:
+                    break
+            if flight.error is not None:
+                raise flight.error
+        finally:
+            self._drop(key, flight)
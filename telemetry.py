@@ -0,0 +1,316 @@
+import json
+import re
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cancellation
+
+# Histogram bucket upper bounds in seconds (Prometheus-style, cumulative; +Inf is implicit)
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+# Per-stage samples kept for percentiles, and individual calls kept for inspection
+SAMPLE_SIZE = 1000
+RECENT_CALLS = 200
+# Rough text length of a token, to estimate what a cancelled stream had received
+CHARS_PER_TOKEN = 4
+
+_lock = threading.Lock()
+_stages = {}
+_recent = deque(maxlen=RECENT_CALLS)
+# Process-wide event counters and gauges (retries, circuit breaker...): {(name, labels): value}
+_counters = {}
+_gauges = {}
+# Process-wide histograms of other timings (scheduler queue wait...): {(name, labels): Histogram}
+_histograms = {}
+
+
+# Aggregation label for a stage: per-chapter stages ("chapter_content_7") share one label
+def stage_label(stage):
+    return re.sub(r"_\d+$", "", stage or "unknown")
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.samples = deque(maxlen=SAMPLE_SIZE)
+
+    def observe(self, value):
+        position = next((i for i, bound in enumerate(LATENCY_BUCKETS) if value <= bound), len(LATENCY_BUCKETS))
+        self.counts[position] += 1
+        self.total += value
+        self.samples.append(value)
+
+    def percentile(self, fraction):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class StageStats:
+    def __init__(self):
+        self.wall = Histogram()
+        self.ttft = Histogram()
+        self.counters = {"calls": 0, "errors": 0, "retries": 0, "cache_hits": 0, "prompt_tokens": 0,
+                         "completion_tokens": 0, "cached_tokens": 0, "cost": 0.0, "coalesced": 0, "cancelled": 0}
+
+    # Mean completion tokens of the calls that completed upstream
+    def typical_completion_tokens(self):
+        counters = self.counters
+        completed = (counters["calls"] - counters["errors"] - counters["cache_hits"] - counters["coalesced"] -
+                     counters["cancelled"])
+        return counters["completion_tokens"] / completed if completed > 0 else 0
+
+
+# One LLM call. Created by start_call, filled in by the API layer, recorded by finish.
+class Call:
+    def __init__(self, stage, model, streamed):
+        self.stage = stage
+        self.model = model
+        self.streamed = streamed
+        self.started = time.perf_counter()
+        self.attempts = 0
+        self.ttft = None
+        self.usage = {}
+        self.cache_hit = False
+        # Served by another caller's identical in-flight request (see single_flight)
+        self.coalesced = False
+        # Model whose answer the call returned: its own, or a duplicate's that won (see hedging)
+        self.answered_by = model
+        self.finished = False
+        self.wall = None
+        # Text received so far, for streams
+        self.received_chars = 0
+
+    def first_token(self):
+        if self.ttft is None:
+            self.ttft = time.perf_counter() - self.started
+
+    def record_usage(self, usage):
+        if usage:
+            self.usage = usage
+
+    # Record the call once; later calls (e.g. a stream closed after an error) are ignored
+    def finish(self, error=None):
+        if self.finished:
+            return
+        self.finished = True
+        wall = self.wall = time.perf_counter() - self.started
+        if self.ttft is None and error is None:
+            self.ttft = wall
+        usage = self.usage
+        cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+        entry = {
+            "stage": self.stage,
+            "model": self.model,
+            "streamed": self.streamed,
+            "cache_hit": self.cache_hit,
+            "coalesced": self.coalesced,
+            "wall_seconds": round(wall, 4),
+            "ttft_seconds": round(self.ttft, 4) if self.ttft is not None else None,
+            "retries": max(self.attempts - 1, 0),
+            "prompt_tokens": usage.get("prompt_tokens", 0),
+            "completion_tokens": usage.get("completion_tokens", 0),
+            "cached_tokens": cached_tokens,
+            "cost": usage.get("cost") or 0.0,
+            "error": type(error).__name__ if error is not None else None,
+            "time": time.time(),
+        }
+        with _lock:
+            stats = _stages.setdefault((stage_label(self.stage), self.model), StageStats())
+            counters = stats.counters
+            counters["calls"] += 1
+            counters["retries"] += entry["retries"]
+            if isinstance(error, cancellation.Cancelled):
+                # Given up by its caller: not a provider error. An aborted stream stops generating,
+                # so what the stage usually produces beyond what had arrived is counted as saved.
+                counters["cancelled"] += 1
+                label = stage_label(self.stage)
+                _count(_series("llm_cancelled_calls_total", {"stage": label, "reason": cancellation.reason(error)}))
+                if self.streamed and not (self.cache_hit or self.coalesced):
+                    saved = max(0, round(stats.typical_completion_tokens() - self.received_chars / CHARS_PER_TOKEN))
+                    _count(_series("llm_cancelled_tokens_saved_total", {"stage": label}), saved)
+            elif error is not None:
+                counters["errors"] += 1
+            elif self.cache_hit:
+                # Served locally: counted, but kept out of the latency and token figures
+                counters["cache_hits"] += 1
+            elif self.coalesced:
+                # Shared another call's upstream request: its latency and tokens are recorded there
+                counters["coalesced"] += 1
+            else:
+                stats.wall.observe(wall)
+                if self.ttft is not None:
+                    stats.ttft.observe(self.ttft)
+                for key in ("prompt_tokens", "completion_tokens", "cached_tokens", "cost"):
+                    counters[key] += entry[key]
+            _recent.append(entry)
+
+
+def _series(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def increment(name, amount=1, **labels):
+    with _lock:
+        _count(_series(name, labels), amount)
+
+
+# Called with the lock held
+def _count(key, amount=1):
+    _counters[key] = _counters.get(key, 0) + amount
+
+
+# Median wall time of a stage's calls on a model, or None before any
+def typical_seconds(stage, model):
+    with _lock:
+        stats = _stages.get((stage_label(stage), model))
+        return stats.wall.percentile(0.5) if stats is not None else None
+
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        _gauges[_series(name, labels)] = value
+
+
+def observe(name, value, **labels):
+    with _lock:
+        _histograms.setdefault(_series(name, labels), Histogram()).observe(value)
+
+
+def _format_series(name, labels):
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+def start_call(stage, model, streamed=False):
+    return Call(stage, model, streamed)
+
+
+# Pass a stream of text chunks through, timing the first one and recording the call when it ends.
+# A stream its reader closes before the end (a Streamlit rerun, a hedge that lost) was cancelled.
+def instrument_stream(call, chunks):
+    try:
+        for chunk in chunks:
+            call.first_token()
+            call.received_chars += len(chunk)
+            yield chunk
+    except GeneratorExit:
+        call.finish(cancellation.Cancelled())
+        raise
+    except Exception as err:
+        call.finish(err)
+        raise
+    finally:
+        call.finish()
+
+
+def reset():
+    with _lock:
+        _stages.clear()
+        _recent.clear()
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+
+
+# JSON-serialisable view of every stage plus the most recent calls
+def snapshot():
+    with _lock:
+        stages = []
+        for (stage, model), stats in sorted(_stages.items()):
+            stages.append({
+                "stage": stage,
+                "model": model,
+                **stats.counters,
+                "wall_p50": stats.wall.percentile(0.5),
+                "wall_p95": stats.wall.percentile(0.95),
+                "wall_p99": stats.wall.percentile(0.99),
+                "ttft_p50": stats.ttft.percentile(0.5),
+                "ttft_p95": stats.ttft.percentile(0.95),
+                "wall_seconds_total": stats.wall.total,
+            })
+        events = {_format_series(name, labels): value for (name, labels), value in sorted({**_counters, **_gauges}.items())}
+        histograms = {_format_series(name, labels): {"count": sum(histogram.counts), "sum": histogram.total,
+                                                     "p50": histogram.percentile(0.5), "p95": histogram.percentile(0.95)}
+                      for (name, labels), histogram in sorted(_histograms.items())}
+        return {"stages": stages, "events": events, "histograms": histograms, "recent_calls": list(_recent)}
+
+
+def prometheus_text():
+    lines = []
+    with _lock:
+        items = sorted(_stages.items())
+        for name, help_text in (("llm_call_seconds", "Wall time of LLM calls"),
+                                ("llm_time_to_first_token_seconds", "Time to first token of LLM calls")):
+            lines += [f"# HELP {name} {help_text}.", f"# TYPE {name} histogram"]
+            for (stage, model), stats in items:
+                histogram = stats.wall if name == "llm_call_seconds" else stats.ttft
+                labels = f'stage="{stage}",model="{model}"'
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f"{name}_sum{{{labels}}} {histogram.total}")
+                lines.append(f"{name}_count{{{labels}}} {cumulative}")
+        for counter in ("calls", "errors", "retries", "cache_hits", "coalesced", "cancelled", "prompt_tokens",
+                        "completion_tokens", "cached_tokens", "cost"):
+            name = f"llm_{counter}_total"
+            lines += [f"# TYPE {name} counter"]
+            for (stage, model), stats in items:
+                lines.append(f'{name}{{stage="{stage}",model="{model}"}} {stats.counters[counter]}')
+        for name in sorted({name for name, _ in _histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (series_name, labels), histogram in sorted(_histograms.items()):
+                if series_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append(_format_series(f"{name}_bucket", labels + (("le", bound),)) + f" {cumulative}")
+                lines.append(f"{_format_series(name + '_sum', labels)} {histogram.total}")
+                lines.append(f"{_format_series(name + '_count', labels)} {cumulative}")
+        for kind, series in (("counter", _counters), ("gauge", _gauges)):
+            for name in sorted({name for name, _ in series}):
+                lines.append(f"# TYPE {name} {kind}")
+                lines += [f"{_format_series(name, labels)} {value}"
+                          for (series_name, labels), value in sorted(series.items()) if series_name == name]
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body, content_type = prometheus_text(), "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body, content_type = json.dumps(snapshot(), ensure_ascii=False), "application/json"
+        else:
+            self.send_error(404)
+            return
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+# Serve /metrics (Prometheus text) and /metrics.json on a background thread, once per process
+def serve(port, host="0.0.0.0"):
+    global _server
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((host, port), MetricsHandler)
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, daemon=True).start()
+    return _server